@@ -1,9 +1,19 @@
-from flask import Flask, request, jsonify,send_from_directory
+from flask import Flask, request, jsonify,send_from_directory,send_file
 from flask_cors import CORS
 import csv
+import io
 import os
-import zipfile
-import subprocess
+
+import numpy as np
+import torch
+from PIL import Image
+
+from unet import Unet
+from utils.utils_distributed import BACKENDS
+from utils.utils_jobs import TrainJobManager, count_gpus
+from utils.utils_serving import MicroBatcher, ModelPool
+from utils.utils_upload import ExtractManager, UploadManager
+
 app = Flask(__name__)
 CORS(app)  # 启用 CORS
 # 设置dataset文件夹的路径
@@ -11,12 +21,48 @@ DATASET_FOLDER = os.path.join(os.getcwd(), 'dataset')
 
 # 确保dataset文件夹存在
 os.makedirs(DATASET_FOLDER, exist_ok=True)
+# 分块上传过程中的临时文件夹
+UPLOAD_FOLDER = os.path.join(DATASET_FOLDER, '.uploads')
+uploads = UploadManager(UPLOAD_FOLDER)
+extractions = ExtractManager()
 # 配置静态文件夹
 app.config['SEGIMAGE_FOLDER'] = 'outcome/segimage'
+BACKEND_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+# 训练任务保存的文件夹，每个任务对应其中一个以任务id命名的子文件夹
+# 训练进程在BACKEND_FOLDER中运行，使用绝对路径使应用与训练进程读写同一个文件夹
+app.config['JOBS_FOLDER'] = os.path.join(BACKEND_FOLDER, 'outcome', 'jobs')
+# 同时运行的训练数上限，默认每张GPU一个，只有CPU时为1
+app.config['MAX_TRAIN_JOBS'] = int(os.environ['MAX_TRAIN_JOBS']) if 'MAX_TRAIN_JOBS' in os.environ else None
+
+train_jobs = TrainJobManager(max_jobs=app.config['MAX_TRAIN_JOBS'], cwd=BACKEND_FOLDER)
+
+# 常驻内存的推理模型数上限，以及加载新模型前要求的最少剩余内存（MB）
+app.config['MAX_SERVING_MODELS'] = int(os.environ.get('MAX_SERVING_MODELS', 2))
+app.config['SERVING_MIN_FREE_MB'] = int(os.environ.get('SERVING_MIN_FREE_MB', 1024))
+
+def load_serving_model(model_path, num_classes):
+    return Unet(model_path=model_path, num_classes=num_classes, cuda=torch.cuda.is_available())
+
+model_pool = ModelPool(load_serving_model, max_models=app.config['MAX_SERVING_MODELS'],
+                       min_free_mb=app.config['SERVING_MIN_FREE_MB'], cuda=torch.cuda.is_available())
+
+# 并发的推理请求最多等待SERVING_BATCH_DELAY_MS毫秒，凑满SERVING_MAX_BATCH张后一起前向传播
+app.config['SERVING_MAX_BATCH'] = int(os.environ.get('SERVING_MAX_BATCH', 8))
+app.config['SERVING_BATCH_DELAY_MS'] = float(os.environ.get('SERVING_BATCH_DELAY_MS', 10))
+
+batcher = MicroBatcher(max_batch_size=app.config['SERVING_MAX_BATCH'], max_delay_ms=app.config['SERVING_BATCH_DELAY_MS'])
 
 # 创建路由
 @app.route('/image/<path:filename>')
 def serve_image(filename):
+    # 有训练任务时返回最近一次训练的可视化结果，
+    # 该任务还没有生成这张图片时返回原来segimage文件夹中的图片
+    job = train_jobs.latest_started()
+    if job is not None:
+        job_folder = os.path.join(job.save_dir, 'segimage')
+        if os.path.isfile(os.path.join(job_folder, filename)):
+            return send_from_directory(job_folder, filename)
     return send_from_directory(app.config['SEGIMAGE_FOLDER'], filename)
 @app.route('/hello', methods=['POST'])
 def hello():
@@ -63,7 +109,7 @@ def list_folders():
     # 假设您的文件夹存储在项目的dataset目录下
     directory = os.path.join(os.getcwd(), 'dataset')
     # 获取所有的文件夹
-    folders = [f for f in os.listdir(directory) if os.path.isdir(os.path.join(directory, f))]
+    folders = [f for f in os.listdir(directory) if os.path.isdir(os.path.join(directory, f)) and not f.startswith('.')]
     return jsonify({'folders': folders})
 
 @app.route('/upload', methods=['POST'])
@@ -101,13 +147,73 @@ def upload_zip_file():
 
 @app.route('/unzip-datasets', methods=['GET'])
 def unzip_datasets():
+    # 在后台依次解压，通过/extractions查询进度
+    jobs = []
     for item in os.listdir(DATASET_FOLDER):
         if item.endswith('.zip'):
-            zip_path = os.path.join(DATASET_FOLDER, item)
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(DATASET_FOLDER)
-            os.remove(zip_path)
-    return jsonify({'message': '所有zip文件已解压并删除'}), 200
+            jobs.append(extractions.submit(os.path.join(DATASET_FOLDER, item), DATASET_FOLDER))
+    return jsonify({'message': '已开始在后台解压{}个zip文件'.format(len(jobs)), 'jobs': [job.to_dict() for job in jobs]}), 202
+
+@app.route('/extractions', methods=['GET'])
+def list_extractions():
+    return jsonify({'jobs': [job.to_dict() for job in extractions.list()]})
+
+@app.route('/extractions/<job_id>', methods=['GET'])
+def get_extraction(job_id):
+    job = extractions.get(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(job.to_dict())
+
+# 分块上传：POST /uploads创建上传，PUT /uploads/<id>?offset=N写入一块，
+# 断线后GET /uploads/<id>得到已上传的offset继续上传，
+# 最后POST /uploads/<id>/finalize校验sha256，zip文件可以直接在后台解压
+@app.route('/uploads', methods=['POST'])
+def init_upload():
+    data = request.get_json(silent=True) or {}
+    try:
+        session = uploads.init(data.get('filename', ''), data.get('size'))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(session.to_dict()), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    session = uploads.get(upload_id)
+    if session is None:
+        return jsonify({'error': '上传不存在'}), 404
+    return jsonify(session.to_dict())
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def put_upload_chunk(upload_id):
+    session = uploads.get(upload_id)
+    if session is None:
+        return jsonify({'error': '上传不存在'}), 404
+    try:
+        offset = int(request.args.get('offset', session.received))
+    except ValueError:
+        return jsonify({'error': 'offset必须为整数'}), 400
+    try:
+        # 直接从请求流写入磁盘，不把分块读入内存
+        uploads.write_chunk(session, offset, request.stream)
+    except ValueError as e:
+        return jsonify({'error': str(e), 'offset': session.received}), 409
+    return jsonify(session.to_dict())
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    session = uploads.get(upload_id)
+    if session is None:
+        return jsonify({'error': '上传不存在'}), 404
+    data = request.get_json(silent=True) or {}
+    try:
+        path = uploads.finalize(session, DATASET_FOLDER, data.get('sha256'))
+    except ValueError as e:
+        return jsonify({'error': str(e), 'offset': session.received}), 409
+    result = {'message': '文件上传成功', 'path': path}
+    if path.endswith('.zip') and data.get('extract', True):
+        result['extraction'] = extractions.submit(path, DATASET_FOLDER).to_dict()
+    return jsonify(result), 200
 @app.route('/train', methods=['POST'])
 def train():
     # 打印接收到的所有参数
@@ -124,25 +230,111 @@ def train():
     freeze_batch_size = request.json.get('Freeze_batch_size', '2')
     unfreeze_epoch = request.json.get('UnFreeze_Epoch', '50')
     unfreeze_batch_size = request.json.get('Unfreeze_batch_size', '2')
-    # 构建运行脚本的命令，确保路径使用正斜杠，并且不添加额外的引号
-    command = f"python train_medical2.py --dataset ./dataset/{dataset}"
+    # 分布式训练的进程数，大于1时GPU上每张卡一个进程，CPU上进程平分CPU核心
+    try:
+        nproc = int(request.json.get('nproc', 1))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'nproc必须为整数'}), 400
+    backend = request.json.get('backend', 'auto')
+    max_nproc = count_gpus() or os.cpu_count() or 1
+    if nproc < 1 or nproc > max_nproc:
+        return jsonify({'error': f'nproc必须在1到{max_nproc}之间'}), 400
+    if backend not in BACKENDS:
+        return jsonify({'error': f'backend必须为{BACKENDS}之一'}), 400
+
+    # 构建运行脚本的参数列表，不经过shell，避免参数中的特殊字符被解释
+    # 数据集使用上传文件夹的绝对路径，与应用的启动目录无关
+    args = ['train_medical2.py', '--dataset', os.path.join(DATASET_FOLDER, dataset)]
+    args += ['--num_classes', str(num_classes), '--Init_Epoch', str(init_epoch), '--save_period', str(save_period)]
+    args += ['--pretrained', str(pretrained)]
+    args += ['--Freeze_Train', str(freeze_train), '--Freeze_Epoch', str(freeze_epoch), '--Freeze_batch_size', str(freeze_batch_size)]
+    args += ['--UnFreeze_Epoch', str(unfreeze_epoch), '--Unfreeze_batch_size', str(unfreeze_batch_size)]
+    if model_path:
+        args += ['--model_path', str(model_path)]
+    if nproc > 1:
+        args += ['--backend', backend]
+
+    try:
+        # 每个训练任务使用单独的保存文件夹，避免同时运行的训练互相覆盖result.csv
+        job = train_jobs.submit(args, app.config['JOBS_FOLDER'], total_epochs=int(unfreeze_epoch), nproc=nproc)
+    except ValueError as e:
+        return jsonify({'error': 'Failed to start training', 'details': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'error': 'Failed to start training', 'details': str(e)}), 429
+    print(' '.join(job.command))
+    return jsonify({'message': 'Training job submitted', 'job_id': job.id, 'status_url': f'/jobs/{job.id}'}), 202
 
-    # 从请求中获取其他参数并添加到命令中
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({'jobs': [job.to_dict() for job in train_jobs.list()]})
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = train_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(job.to_dict())
 
-    # 组装命令
-    command += f" --num_classes {num_classes} --Init_Epoch {init_epoch} --save_period {save_period}"
-    command += f" --pretrained {pretrained} "
-    command += f" --Freeze_Train {freeze_train} --Freeze_Epoch {freeze_epoch} --Freeze_batch_size {freeze_batch_size}"
-    command += f" --UnFreeze_Epoch {unfreeze_epoch} --Unfreeze_batch_size {unfreeze_batch_size}"
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = train_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(job.to_dict())
 
+@app.route('/predict', methods=['POST'])
+def predict():
+    # file为模态A的图片，fileB为模态B的图片，融合网络需要两种模态同时输入
+    if 'file' not in request.files:
+        return jsonify({'error': '没有文件部分'}), 400
+    if 'fileB' not in request.files:
+        return jsonify({'error': '缺少模态B的图片fileB'}), 400
+    model_path = request.form.get('model_path', Unet._defaults['model_path'])
+    num_classes = request.form.get('num_classes', Unet._defaults['num_classes'])
     try:
-        print(command)
-        # 运行命令
-        subprocess.run(command, shell=True, check=True)
-        return jsonify({'message': 'Training started successfully'}), 200
-    except subprocess.CalledProcessError as e:
-        return jsonify({'error': 'Failed to start training', 'details': str(e)}), 500
-    
+        num_classes = int(num_classes)
+    except ValueError:
+        return jsonify({'error': 'num_classes必须为整数'}), 400
+
+    # 只允许加载后端目录下的权值文件
+    model_path = os.path.realpath(os.path.join(BACKEND_FOLDER, model_path))
+    if os.path.commonpath([model_path, BACKEND_FOLDER]) != BACKEND_FOLDER or not os.path.isfile(model_path):
+        return jsonify({'error': '权值文件不存在'}), 404
+
+    try:
+        image = Image.open(request.files['file'].stream)
+        image_B = Image.open(request.files['fileB'].stream)
+        # 在请求线程中完成解码，批处理线程只负责前向传播
+        image.load()
+        image_B.load()
+    except OSError:
+        return jsonify({'error': '无法读取图片'}), 400
+
+    try:
+        model = model_pool.get(model_path, num_classes)
+    except (RuntimeError, ValueError, OSError) as e:
+        # 例如num_classes与权值文件不一致
+        return jsonify({'error': 'Failed to load model', 'details': str(e)}), 400
+    try:
+        mask = batcher.submit(model, image, image_B)
+    except (RuntimeError, ValueError) as e:
+        return jsonify({'error': 'Prediction failed', 'details': str(e)}), 500
+
+    # 返回调色板模式的PNG，像素值即为种类序号，同时可以直接以彩色显示
+    mask = mask.convert('P')
+    mask.putpalette(np.array(model.colors, np.uint8).flatten().tolist())
+    buffer = io.BytesIO()
+    mask.save(buffer, format='PNG')
+    buffer.seek(0)
+    return send_file(buffer, mimetype='image/png')
+
+@app.route('/predict/models', methods=['GET'])
+def list_serving_models():
+    return jsonify(model_pool.stats())
+
+@app.route('/predict/metrics', methods=['GET'])
+def serving_metrics():
+    return jsonify({'models': model_pool.stats(), 'batching': batcher.stats()})
+
 if __name__ == '__main__':
     app.run(debug=True)
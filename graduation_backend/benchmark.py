@@ -0,0 +1,281 @@
+#--------------------------------------------#
+#   该部分代码用于比较不同训练设置下的速度与内存
+#   每种设置在单独的子进程中运行，峰值内存互不影响
+#
+#   python benchmark.py --precision fp32 fp16 bf16
+#   python benchmark.py --precision fp32 bf16 --cpu --input_shape 256 256
+#   python benchmark.py --cpu --infer --execution eager channels_last compile channels_last_compile
+#   python benchmark.py --precision fp16 --checkpoint none encoder decoder all --batch_size 2 8
+#   python benchmark.py --precision fp32 --cpu --world_size 1 2 4 --input_shape 256 256
+#--------------------------------------------#
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+import socket
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from nets.unet import Unet
+from nets.unet_training import Dice_loss, Focal_Loss
+from utils.utils import preprocess_input_tensor
+from utils.utils_compile import optimize_model, to_channels_last
+from utils.utils_distributed import (BACKENDS, cleanup_distributed,
+                                     init_distributed, wrap_ddp)
+from utils.utils_fit import autocast_context, get_grad_scaler
+
+
+#---------------------------------------------------#
+#   读取/proc/self/status中的内存项（MB），非Linux系统返回None
+#---------------------------------------------------#
+def proc_status_mb(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+#---------------------------------------------------#
+#   在计时开始前重置峰值内存，返回CPU上当前的常驻内存作为基准
+#   CPU上向/proc/self/clear_refs写入5可以把VmHWM重置为当前的VmRSS，
+#   不支持时返回None，峰值内存记为nan
+#---------------------------------------------------#
+def reset_peak_memory(cuda):
+    if cuda:
+        torch.cuda.reset_peak_memory_stats()
+        return None
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return None
+    return proc_status_mb('VmRSS')
+
+#---------------------------------------------------#
+#   计时的步骤中的峰值内存（MB）
+#   GPU上为显存的峰值分配量，包含模型参数；
+#   CPU上为峰值常驻内存相对于模型建立后基准的增量，不包含模型参数与导入的库，
+#   进程整个生命周期的ru_maxrss包含导入和建立模型时的峰值，不能用于比较
+#---------------------------------------------------#
+def peak_memory_mb(cuda, baseline=None):
+    if cuda:
+        return torch.cuda.max_memory_allocated() / 1024 / 1024
+    peak = proc_status_mb('VmHWM')
+    if baseline is None or peak is None:
+        return float('nan')
+    return max(peak - baseline, 0.0)
+
+#---------------------------------------------------#
+#   执行方式，对应(channels_last, compile)
+#---------------------------------------------------#
+EXECUTIONS = {
+    'eager'                 : (False, False),
+    'channels_last'         : (True, False),
+    'compile'               : (False, True),
+    'channels_last_compile' : (True, True),
+}
+
+#---------------------------------------------------#
+#   在子进程中运行一种设置，返回平均每步用时与峰值内存
+#   first_step_ms为第一步的用时，compile时包含编译时间
+#   world_size大于1时为分布式训练中的一个进程，每个进程的batch_size不变，
+#   images_per_s为所有进程合计的吞吐量
+#---------------------------------------------------#
+def run_config(config):
+    cuda        = config['cuda']
+    world_size  = config.get('world_size', 1)
+    if world_size > 1:
+        device, _, rank, world_size = init_distributed(config['backend'], cuda)
+    else:
+        device, rank = torch.device('cuda' if cuda else 'cpu'), 0
+    precision   = config['precision']
+    num_classes = config['num_classes']
+    h, w        = config['input_shape']
+    n           = config['batch_size']
+    torch.manual_seed(config['seed'])
+
+    channels_last, compile = EXECUTIONS[config['execution']]
+    model       = Unet(num_classes=num_classes, pretrained=False).train(not config['infer']).to(device)
+    model.set_checkpointing(config['checkpoint'])
+    model       = optimize_model(model, channels_last=channels_last, compile=compile, cache_dir=config['compile_cache_dir'])
+    find_unused = None
+    if world_size > 1 and not config['infer']:
+        model, find_unused = wrap_ddp(model, device, config['input_shape'])
+    optimizer   = torch.optim.Adam(model.parameters(), 1e-4)
+    scaler      = get_grad_scaler(precision, cuda)
+    weights     = torch.ones(num_classes, device=device)
+
+    #---------------------------------------------------#
+    #   每个进程使用不同的随机数据，相当于DistributedSampler划分后的数据
+    #---------------------------------------------------#
+    torch.manual_seed(config['seed'] + rank)
+    imgs_A      = torch.randint(0, 256, (n, 3, h, w), dtype=torch.uint8, device=device)
+    imgs_B      = torch.randint(0, 256, (n, 3, h, w), dtype=torch.uint8, device=device)
+    pngs        = torch.randint(0, num_classes, (n, h, w), device=device)
+    baseline    = reset_peak_memory(cuda)
+
+    times = []
+    for step in range(config['warmup'] + config['steps']):
+        if cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        inputs = [to_channels_last(preprocess_input_tensor(images), channels_last) for images in (imgs_A, imgs_B)]
+        if config['infer']:
+            with torch.no_grad(), autocast_context(precision, cuda):
+                loss = model(*inputs).float().mean()
+        else:
+            optimizer.zero_grad()
+            with autocast_context(precision, cuda):
+                outputs = model(*inputs)
+                loss    = Focal_Loss(outputs, pngs, weights, num_classes=num_classes) + Dice_loss(outputs, pngs)
+            if scaler is not None:
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                loss.backward()
+                optimizer.step()
+        if cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    first_step  = times[0]
+    step_time   = float(np.mean(times[config['warmup']:]))
+    #---------------------------------------------------#
+    #   以最慢的进程为准
+    #---------------------------------------------------#
+    if world_size > 1:
+        step_time   = torch.tensor([step_time, first_step], dtype=torch.float64, device=device)
+        dist.all_reduce(step_time, op=dist.ReduceOp.MAX)
+        step_time, first_step = step_time.tolist()
+        cleanup_distributed()
+
+    return {
+        'precision'     : precision,
+        'execution'     : config['execution'],
+        'mode'          : 'infer' if config['infer'] else 'train',
+        'checkpoint'    : '+'.join(config['checkpoint']) if config['checkpoint'] else 'none',
+        'device'        : device.type,
+        'batch_size'    : n,
+        'world_size'    : world_size,
+        'find_unused'   : find_unused,
+        'step_ms'       : step_time * 1000,
+        'images_per_s'  : n * world_size / step_time,
+        'first_step_ms' : float(first_step * 1000),
+        'peak_mem_mb'   : peak_memory_mb(cuda, baseline),
+        'loss'          : float(loss.item()),
+    }
+
+def run_isolated(config):
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(run_config, (config,))
+
+def run_rank(config, rank, world_size, port, results):
+    os.environ.update({
+        'MASTER_ADDR'       : '127.0.0.1',
+        'MASTER_PORT'       : str(port),
+        'RANK'              : str(rank),
+        'LOCAL_RANK'        : str(rank),
+        'WORLD_SIZE'        : str(world_size),
+        'LOCAL_WORLD_SIZE'  : str(world_size),
+    })
+    result = run_config(config)
+    if rank == 0:
+        results.put(result)
+
+#---------------------------------------------------#
+#   在本机上启动world_size个进程进行分布式训练，返回0号进程的结果
+#---------------------------------------------------#
+def run_distributed(config, world_size):
+    if world_size == 1:
+        return run_isolated(config)
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    ctx         = mp.get_context('spawn')
+    results     = ctx.SimpleQueue()
+    config      = dict(config, world_size=world_size)
+    processes   = [ctx.Process(target=run_rank, args=(config, rank, world_size, port, results)) for rank in range(world_size)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    if any(p.exitcode != 0 for p in processes):
+        raise RuntimeError("Distributed benchmark with world_size {} failed.".format(world_size))
+    return results.get()
+
+#---------------------------------------------------#
+#   扩展效率，与同一设置下进程数最少的结果比较
+#   每个进程的吞吐量 / 基准的每个进程的吞吐量，1.0为线性扩展
+#---------------------------------------------------#
+def add_scaling_efficiency(results):
+    groups = {}
+    for r in results:
+        key = (r['precision'], r['execution'], r['mode'], r['checkpoint'], r['device'], r['batch_size'])
+        groups.setdefault(key, []).append(r)
+    for group in groups.values():
+        base = min(group, key=lambda r: r['world_size'])
+        for r in group:
+            r['scaling_eff'] = (r['images_per_s'] / r['world_size']) / (base['images_per_s'] / base['world_size'])
+
+def print_results(results):
+    print('{:<10s}{:<24s}{:<7s}{:<24s}{:<6s}{:>7s}{:>7s}{:>12s}{:>12s}{:>12s}{:>16s}{:>16s}'.format('precision', 'execution', 'mode', 'checkpoint', 'device', 'batch', 'world', 'step (ms)', 'images / s', 'scaling eff', 'first step (ms)', 'peak mem (MB)'))
+    for r in results:
+        print('{:<10s}{:<24s}{:<7s}{:<24s}{:<6s}{:>7d}{:>7d}{:>12.1f}{:>12.2f}{:>12.2f}{:>16.1f}{:>16.1f}'.format(r['precision'], r['execution'], r['mode'], r['checkpoint'], r['device'], r['batch_size'], \
+            r['world_size'], r['step_ms'], r['images_per_s'], r['scaling_eff'], r['first_step_ms'], r['peak_mem_mb']))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="比较不同训练设置下每一步的用时与峰值内存")
+    parser.add_argument("--precision", type=str, nargs='+', default=['fp32', 'fp16', 'bf16'], choices=['fp32', 'fp16', 'bf16'], help="需要比较的训练精度")
+    parser.add_argument("--execution", type=str, nargs='+', default=['eager'], choices=list(EXECUTIONS.keys()), help="需要比较的执行方式，默认为'eager'")
+    parser.add_argument("--infer", action='store_true', help="只测试前向传播的推理速度，默认测试训练的一步")
+    parser.add_argument("--compile_cache_dir", type=str, default='model_data/compile_cache', help="torch.compile编译结果的缓存文件夹")
+    parser.add_argument("--cpu", action='store_true', help="在CPU上运行，默认有GPU时使用GPU")
+    parser.add_argument("--num_classes", type=int, default=2, help="分类个数+1，默认为'2'")
+    parser.add_argument("--checkpoint", type=str, nargs='+', default=['none'], help="需要比较的重计算设置，每项为none、all或用逗号分隔的encoder、fuse、decoder，默认为'none'")
+    parser.add_argument("--batch_size", type=int, nargs='+', default=[2], help="需要比较的batch_size，默认为'2'")
+    parser.add_argument("--world_size", type=int, nargs='+', default=[1], help="需要比较的分布式训练进程数，每个进程的batch_size不变，默认为'1'")
+    parser.add_argument("--backend", type=str, default='auto', choices=BACKENDS, help="分布式训练的通信后端，默认为'auto'")
+    parser.add_argument("--input_shape", type=int, nargs=2, default=[512, 512], help="输入图片的大小，默认为'512 512'")
+    parser.add_argument("--steps", type=int, default=10, help="计时的步数，默认为'10'")
+    parser.add_argument("--warmup", type=int, default=3, help="不计时的预热步数，默认为'3'")
+    parser.add_argument("--seed", type=int, default=11, help="随机种子，默认为'11'")
+    parser.add_argument("--output", type=str, default='', help="把结果保存为json文件，默认为''不保存")
+    args = parser.parse_args()
+
+    cuda    = torch.cuda.is_available() and not args.cpu
+    results = []
+    for precision in args.precision:
+        if precision == 'fp16' and not cuda:
+            print("Skipping fp16: requires CUDA.")
+            continue
+        for execution, checkpoint, batch_size, world_size in itertools.product(args.execution, args.checkpoint, args.batch_size, args.world_size):
+            config = {
+                'cuda'          : cuda,
+                'precision'     : precision,
+                'execution'     : execution,
+                'infer'         : args.infer,
+                'checkpoint'    : [] if checkpoint == 'none' else checkpoint.split(','),
+                'compile_cache_dir' : args.compile_cache_dir,
+                'num_classes'   : args.num_classes,
+                'batch_size'    : batch_size,
+                'input_shape'   : args.input_shape,
+                'steps'         : args.steps,
+                'warmup'        : args.warmup,
+                'seed'          : args.seed,
+                'backend'       : args.backend,
+            }
+            results.append(run_distributed(config, world_size))
+
+    add_scaling_efficiency(results)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
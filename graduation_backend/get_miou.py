@@ -32,8 +32,13 @@ if __name__ == "__main__":
     #-------------------------------------------------------#
     #   指向VOC数据集所在的文件夹
     #   默认指向根目录下的VOC数据集
+    #   融合网络需要模态B，模态B图片放在VOC2007/JPEGImagesB下，与JPEGImages中的同名
     #-------------------------------------------------------#
     VOCdevkit_path  = 'VOCdevkit'
+    #-------------------------------------------------------#
+    #   batch_size      获得预测结果时每次送入网络的图片数量
+    #-------------------------------------------------------#
+    batch_size      = 8
 
     image_ids       = open(os.path.join(VOCdevkit_path, "VOC2007/ImageSets/Segmentation/val.txt"),'r').read().splitlines() 
     gt_dir          = os.path.join(VOCdevkit_path, "VOC2007/SegmentationClass/")
@@ -49,15 +54,17 @@ if __name__ == "__main__":
         print("Load model done.")
 
         print("Get predict result.")
-        for image_id in tqdm(image_ids):
-            image_path  = os.path.join(VOCdevkit_path, "VOC2007/JPEGImages/"+image_id+".jpg")
-            image       = Image.open(image_path)
-            image       = unet.get_miou_png(image)
-            image.save(os.path.join(pred_dir, image_id + ".png"))
+        for start in tqdm(range(0, len(image_ids), batch_size)):
+            batch_ids   = image_ids[start : start + batch_size]
+            images      = [Image.open(os.path.join(VOCdevkit_path, "VOC2007/JPEGImages/"+image_id+".jpg")) for image_id in batch_ids]
+            images_B    = [Image.open(os.path.join(VOCdevkit_path, "VOC2007/JPEGImagesB/"+image_id+".jpg")) for image_id in batch_ids]
+            images      = unet.get_miou_png_batch(images, batch_size=batch_size, images_B=images_B)
+            for image_id, image in zip(batch_ids, images):
+                image.save(os.path.join(pred_dir, image_id + ".png"))
         print("Get predict result done.")
 
     if miou_mode == 0 or miou_mode == 2:
         print("Get miou.")
-        hist, IoUs, PA_Recall, Precision = compute_mIoU(gt_dir, pred_dir, image_ids, num_classes, name_classes)  # 执行计算mIoU的函数
+        hist, IoUs, PA_Recall, Precision = compute_mIoU(gt_dir, pred_dir, image_ids, num_classes, name_classes, per_image_path=os.path.join(miou_out_path, "per_image_iou.csv"))  # 执行计算mIoU的函数
         print("Get miou done.")
         show_results(miou_out_path, hist, IoUs, PA_Recall, Precision, name_classes)
\ No newline at end of file
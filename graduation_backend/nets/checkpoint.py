@@ -0,0 +1,36 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+
+#---------------------------------------------------#
+#   重计算时冻结BatchNorm的统计量
+#   checkpoint在反向传播时会再执行一次前向传播，
+#   不冻结的话running_mean、running_var会被更新两次
+#---------------------------------------------------#
+@contextlib.contextmanager
+def frozen_bn_stats(module):
+    bns     = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    states  = [(m.momentum, None if m.num_batches_tracked is None else m.num_batches_tracked.clone()) for m in bns]
+    for m in bns:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(bns, states):
+            m.momentum = momentum
+            if num_batches_tracked is not None:
+                m.num_batches_tracked.copy_(num_batches_tracked)
+
+#---------------------------------------------------#
+#   以checkpoint的方式执行module
+#   前向传播时不保存module内部的激活值，反向传播时重新计算，用计算换显存
+#   只在训练且需要梯度时生效，推理时与直接调用相同
+#---------------------------------------------------#
+def checkpoint_module(module, *inputs):
+    if not (module.training and torch.is_grad_enabled()):
+        return module(*inputs)
+    return checkpoint(module, *inputs, use_reentrant=False,
+                      context_fn=lambda: (contextlib.nullcontext(), frozen_bn_stats(module)))
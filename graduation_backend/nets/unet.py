@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from nets.checkpoint import checkpoint_module
 from nets.resnet import resnet50
 from nets.vgg import VGG16
 
@@ -21,6 +22,7 @@ class FuseConv(nn.Module):
 # 以下是multimodal的unet
 
 class Unet(nn.Module):
+    CHECKPOINT_STAGES = ("encoder", "fuse", "decoder")
 
     def __init__(self, num_classes=21, pretrained=False):
         super(Unet, self).__init__()
@@ -53,32 +55,64 @@ class Unet(nn.Module):
         # 定义最终的卷积层来映射到类别数
         self.final = nn.Conv2d(out_filters[0], num_classes, kernel_size=1)
 
-    def forward(self, input_A, input_B=None):
-        # 分别对两种模态的输入进行特征提取,input_A和input_B分别是模态A和模态B的输入数据。
-        feats_A = self.encoder_A(input_A)
-        if input_B is not None:
-            # feats_A = self.encoder_A(input_A)
-            feats_B = self.encoder_B(input_B)
-            
-
+        self.checkpoint_stages = set()
+
+    #---------------------------------------------------#
+    #   按stage开启激活值重计算（gradient checkpointing）
+    #   stages可以包含"encoder"、"fuse"、"decoder"，或者为"all"
+    #   encoder     两个VGG16编码器的每个stage
+    #   fuse        四个FuseConv融合层
+    #   decoder     四个unetUp上采样层，其中up_concat4/3的激活值最大
+    #   开启后显存占用降低、每一步的计算量增加，可以使用更大的batch_size
+    #---------------------------------------------------#
+    def set_checkpointing(self, stages=()):
+        if isinstance(stages, str):
+            stages = [stages]
+        stages = set(self.CHECKPOINT_STAGES) if "all" in stages else set(stages)
+        unknown = stages - set(self.CHECKPOINT_STAGES)
+        if unknown:
+            raise ValueError("Unsupported checkpoint stages %s, use 'encoder', 'fuse', 'decoder' or 'all'." % sorted(unknown))
+        self.checkpoint_stages      = stages
+        self.encoder_A.checkpoint   = "encoder" in stages
+        self.encoder_B.checkpoint   = "encoder" in stages
+
+    def run_stage(self, stage, module, *inputs):
+        if stage in self.checkpoint_stages:
+            return checkpoint_module(module, *inputs)
+        return module(*inputs)
+
+    #---------------------------------------------------#
+    #   分阶段推理接口
+    #   encode_A / encode_B 分别提取两种模态的特征金字塔，
+    #   decode 根据特征金字塔完成融合与上采样。
+    #   拆开后可以缓存某一模态的特征，重复使用时跳过对应的编码器
+    #---------------------------------------------------#
+    def encode_A(self, input_A):
+        return self.encoder_A(input_A)
+
+    def encode_B(self, input_B):
+        return self.encoder_B(input_B)
+
+    def decode(self, feats_A, feats_B=None):
+        if feats_B is not None:
             # 跳跃连接 特征融合
-            fuse_feat1 = self.fuse1(torch.cat((feats_A[0], feats_B[0]), dim=1))
-            fuse_feat2 = self.fuse2(torch.cat((feats_A[1], feats_B[1]), dim=1))
-            fuse_feat3 = self.fuse3(torch.cat((feats_A[2], feats_B[2]), dim=1))
-            fuse_feat4 = self.fuse4(torch.cat((feats_A[3], feats_B[3]), dim=1))
+            fuse_feat1 = self.run_stage("fuse", self.fuse1, torch.cat((feats_A[0], feats_B[0]), dim=1))
+            fuse_feat2 = self.run_stage("fuse", self.fuse2, torch.cat((feats_A[1], feats_B[1]), dim=1))
+            fuse_feat3 = self.run_stage("fuse", self.fuse3, torch.cat((feats_A[2], feats_B[2]), dim=1))
+            fuse_feat4 = self.run_stage("fuse", self.fuse4, torch.cat((feats_A[3], feats_B[3]), dim=1))
             
             # 特征上采样并进一步融合
             # 修改后: 使用torch.cat在通道维度上融合feats_A[4]和feats_B[4]
-            up4 = self.up_concat4(fuse_feat4, torch.cat((feats_A[4], feats_B[4]), dim=1))
-            up3 = self.up_concat3(fuse_feat3, up4)
-            up2 = self.up_concat2(fuse_feat2, up3)
-            up1 = self.up_concat1(fuse_feat1, up2)
+            up4 = self.run_stage("decoder", self.up_concat4, fuse_feat4, torch.cat((feats_A[4], feats_B[4]), dim=1))
+            up3 = self.run_stage("decoder", self.up_concat3, fuse_feat3, up4)
+            up2 = self.run_stage("decoder", self.up_concat2, fuse_feat2, up3)
+            up1 = self.run_stage("decoder", self.up_concat1, fuse_feat1, up2)
         
         else:
-            up4 = self.up_concat4(feats_A[3], feats_A[4])
-            up3 = self.up_concat3(feats_A[2], up4)
-            up2 = self.up_concat2(feats_A[1], up3)
-            up1 = self.up_concat1(feats_A[0], up2)
+            up4 = self.run_stage("decoder", self.up_concat4, feats_A[3], feats_A[4])
+            up3 = self.run_stage("decoder", self.up_concat3, feats_A[2], up4)
+            up2 = self.run_stage("decoder", self.up_concat2, feats_A[1], up3)
+            up1 = self.run_stage("decoder", self.up_concat1, feats_A[0], up2)
         # if self.up_conv != None:
         #     up1 = self.up_conv(up1)
         
@@ -86,6 +120,12 @@ class Unet(nn.Module):
         final = self.final(up1)
         
         return final
+
+    def forward(self, input_A, input_B=None):
+        # 分别对两种模态的输入进行特征提取,input_A和input_B分别是模态A和模态B的输入数据。
+        feats_A = self.encode_A(input_A)
+        feats_B = self.encode_B(input_B) if input_B is not None else None
+        return self.decode(feats_A, feats_B)
     
     def freeze_backbone(self):
         # 冻结模态A的编码器参数
@@ -6,6 +6,14 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+#--------------------------------------------#
+#   把(n,h,w)的种类图转换为(n,h,w,num_classes+1)的one_hot标签
+#   最后一个通道对应需要忽略的像素，与数据集中np.eye(num_classes + 1)的结果一致
+#   直接在标签所在的设备上计算，DataLoader只需要传输种类图
+#--------------------------------------------#
+def labels_to_one_hot(target, num_classes, dtype=torch.float32):
+    return F.one_hot(target.long(), num_classes + 1).to(dtype)
+
 def CE_Loss(inputs, target, cls_weights, num_classes=21):
     n, c, h, w = inputs.size()
     nt, ht, wt = target.size()
@@ -13,7 +21,7 @@ def CE_Loss(inputs, target, cls_weights, num_classes=21):
         inputs = F.interpolate(inputs, size=(ht, wt), mode="bilinear", align_corners=True)
 
     temp_inputs = inputs.transpose(1, 2).transpose(2, 3).contiguous().view(-1, c)
-    temp_target = target.view(-1)
+    temp_target = target.view(-1).long()
 
     CE_loss  = nn.CrossEntropyLoss(weight=cls_weights, ignore_index=num_classes)(temp_inputs, temp_target)
     return CE_loss
@@ -25,7 +33,7 @@ def Focal_Loss(inputs, target, cls_weights, num_classes=21, alpha=0.5, gamma=2):
         inputs = F.interpolate(inputs, size=(ht, wt), mode="bilinear", align_corners=True)
 
     temp_inputs = inputs.transpose(1, 2).transpose(2, 3).contiguous().view(-1, c)
-    temp_target = target.view(-1)
+    temp_target = target.view(-1).long()
 
     logpt  = -nn.CrossEntropyLoss(weight=cls_weights, ignore_index=num_classes, reduction='none')(temp_inputs, temp_target)
     pt = torch.exp(logpt)
@@ -36,7 +44,17 @@ def Focal_Loss(inputs, target, cls_weights, num_classes=21, alpha=0.5, gamma=2):
     return loss
 
 def Dice_loss(inputs, target, beta=1, smooth = 1e-5):
+    #--------------------------------------------#
+    #   混合精度训练时在fp32下计算softmax与求和，
+    #   CPU上的bf16 autocast不会自动提升softmax的精度
+    #--------------------------------------------#
+    inputs = inputs.float()
     n, c, h, w = inputs.size()
+    #--------------------------------------------#
+    #   target可以是one_hot标签，也可以是(n,h,w)的种类图
+    #--------------------------------------------#
+    if target.dim() == 3:
+        target = labels_to_one_hot(target, c, inputs.dtype)
     nt, ht, wt, ct = target.size()
     if h != ht and w != wt:
         inputs = F.interpolate(inputs, size=(ht, wt), mode="bilinear", align_corners=True)
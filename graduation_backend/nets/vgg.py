@@ -1,11 +1,17 @@
 import torch.nn as nn
 from torch.hub import load_state_dict_from_url
 
+from nets.checkpoint import checkpoint_module
+
 
 class VGG(nn.Module):
     def __init__(self, features, num_classes=1000):
         super(VGG, self).__init__()
         self.features = features
+        #---------------------------------------------------#
+        #   checkpoint为True时训练中每个stage的激活值在反向传播时重新计算
+        #---------------------------------------------------#
+        self.checkpoint = False
         self.avgpool = nn.AdaptiveAvgPool2d((7, 7))
         self.classifier = nn.Sequential(
             nn.Linear(512 * 7 * 7, 4096),
@@ -23,11 +29,12 @@ class VGG(nn.Module):
         # x = self.avgpool(x)
         # x = torch.flatten(x, 1)
         # x = self.classifier(x)
-        feat1 = self.features[  :4 ](x)
-        feat2 = self.features[4 :9 ](feat1)
-        feat3 = self.features[9 :16](feat2)
-        feat4 = self.features[16:23](feat3)
-        feat5 = self.features[23:-1](feat4)
+        run   = checkpoint_module if self.checkpoint else (lambda stage, inputs: stage(inputs))
+        feat1 = run(self.features[  :4 ], x)
+        feat2 = run(self.features[4 :9 ], feat1)
+        feat3 = run(self.features[9 :16], feat2)
+        feat4 = run(self.features[16:23], feat3)
+        feat5 = run(self.features[23:-1], feat4)
         return [feat1, feat2, feat3, feat4, feat5]
 
     def _initialize_weights(self):
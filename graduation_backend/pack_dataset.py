@@ -0,0 +1,32 @@
+import argparse
+import os
+
+from utils.dataloader_medical import UnetDataset, pack_dataset
+
+#----------------------------------------------------------------------#
+#   把数据集预先解码并打包成一个.bin文件与一个.json索引
+#   打包一次之后，训练时通过--packed指定打包文件，每个epoch不再重复解码图片
+#
+#   python pack_dataset.py --dataset ./dataset/CHASEDB1
+#   默认对ImageSets/Segmentation/trainval.txt中的样本打包，
+#   结果保存为数据集文件夹下的packed/trainval.bin与packed/trainval.json
+#----------------------------------------------------------------------#
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="预先解码并打包数据集")
+    parser.add_argument("--dataset", type=str, default='./dataset/CHASEDB1', help="数据集路径，默认为'./dataset/CHASEDB1'")
+    parser.add_argument("--split", type=str, default='trainval', help="ImageSets/Segmentation下的txt文件名，默认为'trainval'")
+    parser.add_argument("--output", type=str, default='', help="打包文件的路径（不含扩展名），默认为数据集下的packed/<split>")
+    args = parser.parse_args()
+
+    with open(os.path.join(args.dataset, "ImageSets/Segmentation", args.split + ".txt"), "r") as f:
+        names = [line.split()[0] for line in f.readlines() if line.strip()]
+
+    pack_path = args.output if args.output else os.path.join(args.dataset, "packed", args.split)
+    os.makedirs(os.path.dirname(os.path.abspath(pack_path)), exist_ok=True)
+
+    #---------------------------------------------------#
+    #   只借用UnetDataset读取原始图片，input_shape与num_classes不影响打包结果
+    #---------------------------------------------------#
+    dataset = UnetDataset(names, [512, 512], 2, False, args.dataset)
+    nbytes  = pack_dataset(dataset, names, pack_path)
+    print("Packed {} samples ({:.1f} MB) to {}.bin".format(len(names), nbytes / 1024 / 1024, pack_path))
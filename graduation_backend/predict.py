@@ -20,6 +20,7 @@ if __name__ == "__main__":
     #   'video'             表示视频检测，可调用摄像头或者视频进行检测，详情查看下方注释。
     #   'fps'               表示测试fps，使用的图片是img里面的street.jpg，详情查看下方注释。
     #   'dir_predict'       表示遍历文件夹进行检测并保存。默认遍历img文件夹，保存img_out文件夹，详情查看下方注释。
+    #   'dir_predict_pair'  表示多模态遍历检测。遍历dir_origin_path下Images与ImagesB中同名的图片对，保存img_out文件夹。
     #   'export_onnx'       表示将模型导出为onnx，需要pytorch1.7.1以上。
     #   'predict_onnx'      表示利用导出的onnx模型进行预测，相关参数的修改在unet.py_346行左右处的Unet_ONNX
     #----------------------------------------------------------------------------------------------------------#
@@ -31,6 +32,18 @@ if __name__ == "__main__":
     #   count、name_classes仅在mode='predict'时有效
     #-------------------------------------------------------------------------#
     count           = False
+    #-------------------------------------------------------------------------#
+    #   tiled               指定了是否使用滑窗推理，用于分辨率远大于input_shape的图片
+    #                       为True时不对原图缩放，按input_shape大小的窗口逐块预测后拼接
+    #   tile_overlap        相邻窗口之间的重叠像素数
+    #   tile_batch_size     每次送入网络的窗口数量
+    #
+    #   tiled、tile_overlap、tile_batch_size仅在mode='predict'和'dir_predict'时有效
+    #   mode='predict'且tiled=True时会再输入一张同名大小的模态B图片
+    #-------------------------------------------------------------------------#
+    tiled           = False
+    tile_overlap    = 128
+    tile_batch_size = 4
     name_classes    = ["background","aeroplane", "bicycle", "bird", "boat", "bottle", "bus", "car", "cat", "chair", "cow", "diningtable", "dog", "horse", "motorbike", "person", "pottedplant", "sheep", "sofa", "train", "tvmonitor"]
     # name_classes    = ["background","cat","dog"]
     #----------------------------------------------------------------------------------------------------------#
@@ -56,12 +69,19 @@ if __name__ == "__main__":
     fps_image_path  = "img/street.jpg"
     #-------------------------------------------------------------------------#
     #   dir_origin_path     指定了用于检测的图片的文件夹路径
+    #   dir_origin_path_B   指定了模态B图片的文件夹路径，图片与dir_origin_path中的同名
     #   dir_save_path       指定了检测完图片的保存路径
     #   
-    #   dir_origin_path和dir_save_path仅在mode='dir_predict'时有效
+    #   dir_batch_size      指定了遍历文件夹检测时，每次送入网络的图片数量
+    #   
+    #   dir_origin_path、dir_save_path和dir_batch_size仅在mode='dir_predict'或'dir_predict_pair'时有效
+    #   dir_origin_path_B仅在mode='dir_predict'时有效
+    #   mode='dir_predict_pair'时dir_origin_path应指向包含Images与ImagesB文件夹的数据集目录
     #-------------------------------------------------------------------------#
     dir_origin_path = "img/"
+    dir_origin_path_B = "imgB/"
     dir_save_path   = "img_out/"
+    dir_batch_size  = 8
     #-------------------------------------------------------------------------#
     #   simplify            使用Simplify onnx
     #   onnx_save_path      指定了onnx的保存路径
@@ -96,7 +116,16 @@ if __name__ == "__main__":
                 print('Open Error! Try again!')
                 continue
             else:
-                r_image = unet.detect_image(image, count=count, name_classes=name_classes)
+                if tiled:
+                    img_B = input('Input image B filename:')
+                    try:
+                        image_B = Image.open(img_B)
+                    except:
+                        print('Open Error! Try again!')
+                        continue
+                    r_image = unet.detect_image_tiled(image, image_B=image_B, tile_overlap=tile_overlap, batch_size=tile_batch_size, count=count, name_classes=name_classes)
+                else:
+                    r_image = unet.detect_image(image, count=count, name_classes=name_classes)
                 r_image.show()
 
     elif mode == "video":
@@ -154,15 +183,39 @@ if __name__ == "__main__":
         import os
         from tqdm import tqdm
 
-        img_names = os.listdir(dir_origin_path)
-        for img_name in tqdm(img_names):
-            if img_name.lower().endswith(('.bmp', '.dib', '.png', '.jpg', '.jpeg', '.pbm', '.pgm', '.ppm', '.tif', '.tiff')):
-                image_path  = os.path.join(dir_origin_path, img_name)
-                image       = Image.open(image_path)
-                r_image     = unet.detect_image(image)
-                if not os.path.exists(dir_save_path):
-                    os.makedirs(dir_save_path)
+        img_names = [img_name for img_name in os.listdir(dir_origin_path) \
+            if img_name.lower().endswith(('.bmp', '.dib', '.png', '.jpg', '.jpeg', '.pbm', '.pgm', '.ppm', '.tif', '.tiff'))]
+        if not os.path.exists(dir_save_path):
+            os.makedirs(dir_save_path)
+        #-------------------------------------------------------------------------#
+        #   每dir_batch_size对图片进行一次批量检测
+        #   融合网络需要模态B，模态B图片从dir_origin_path_B中按同名读取
+        #-------------------------------------------------------------------------#
+        for start in tqdm(range(0, len(img_names), dir_batch_size)):
+            batch_names = img_names[start : start + dir_batch_size]
+            pairs       = [(Image.open(os.path.join(dir_origin_path, img_name)), Image.open(os.path.join(dir_origin_path_B, img_name))) for img_name in batch_names]
+            if tiled:
+                r_images = [unet.detect_image_tiled(image, image_B=image_B, tile_overlap=tile_overlap, batch_size=tile_batch_size) for image, image_B in pairs]
+            else:
+                r_images = unet.detect_pair_batch(pairs, batch_size=dir_batch_size)
+            for img_name, r_image in zip(batch_names, r_images):
                 r_image.save(os.path.join(dir_save_path, img_name))
+    elif mode == "dir_predict_pair":
+        import os
+        from tqdm import tqdm
+
+        from utils.utils import load_image_pair
+
+        img_names = [os.path.splitext(img_name)[0] for img_name in os.listdir(os.path.join(dir_origin_path, "Images")) \
+            if img_name.lower().endswith(('.bmp', '.dib', '.png', '.jpg', '.jpeg', '.pbm', '.pgm', '.ppm', '.tif', '.tiff'))]
+        if not os.path.exists(dir_save_path):
+            os.makedirs(dir_save_path)
+        for start in tqdm(range(0, len(img_names), dir_batch_size)):
+            batch_names = img_names[start : start + dir_batch_size]
+            pairs       = [load_image_pair(dir_origin_path, img_name) for img_name in batch_names]
+            r_images    = unet.detect_pair_batch(pairs, batch_size=dir_batch_size)
+            for img_name, r_image in zip(batch_names, r_images):
+                r_image.save(os.path.join(dir_save_path, img_name + ".png"))
     elif mode == "export_onnx":
         unet.convert_to_onnx(simplify, onnx_save_path)
                 
@@ -178,4 +231,4 @@ if __name__ == "__main__":
                 r_image = yolo.detect_image(image)
                 r_image.show()
     else:
-        raise AssertionError("Please specify the correct mode: 'predict', 'video', 'fps' or 'dir_predict'.")
+        raise AssertionError("Please specify the correct mode: 'predict', 'video', 'fps', 'dir_predict' or 'dir_predict_pair'.")
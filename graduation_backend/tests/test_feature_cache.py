@@ -0,0 +1,68 @@
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nets.unet import Unet as UnetNet
+from unet import Unet
+from utils.utils_cache import FeatureCache
+
+
+def make_predictor():
+    torch.manual_seed(0)
+    predictor               = Unet.__new__(Unet)
+    predictor.net           = UnetNet(num_classes=2, pretrained=False).eval()
+    predictor.feature_cache = FeatureCache(64)
+    calls                   = []
+    encode_A                = predictor.net.encode_A
+    def counted_encode_A(images):
+        calls.append(images.size(0))
+        return encode_A(images)
+    predictor.net.encode_A  = counted_encode_A
+    return predictor, calls
+
+
+def test_identical_images_A_are_encoded_once():
+    predictor, calls = make_predictor()
+    n           = 4
+    image_A     = np.random.RandomState(0).rand(3, 32, 32).astype(np.float32)
+    image_data  = np.stack([image_A] * n)
+    images_A    = torch.from_numpy(image_data)
+    images_B    = torch.rand(n, 3, 32, 32)
+
+    with torch.no_grad():
+        expected    = predictor.net(images_A, images_B)
+        del calls[:]
+        outputs     = predictor.forward_cached(images_A, images_B, image_data)
+
+    assert calls == [1]
+    assert torch.allclose(outputs, expected, atol=1e-5)
+    stats = predictor.feature_cache.stats()
+    assert stats['entries'] == 1
+    assert predictor.feature_cache.misses == 1
+
+    with torch.no_grad():
+        predictor.forward_cached(images_A, images_B, image_data)
+    assert calls == [1]
+    assert predictor.feature_cache.hits == 1
+
+
+def test_mixed_batch_encodes_each_unique_image_once():
+    predictor, calls = make_predictor()
+    rng         = np.random.RandomState(1)
+    a, b        = rng.rand(3, 32, 32).astype(np.float32), rng.rand(3, 32, 32).astype(np.float32)
+    image_data  = np.stack([a, b, a, b, a])
+    images_A    = torch.from_numpy(image_data)
+    images_B    = torch.rand(5, 3, 32, 32)
+
+    with torch.no_grad():
+        expected    = predictor.net(images_A, images_B)
+        del calls[:]
+        outputs     = predictor.forward_cached(images_A, images_B, image_data)
+
+    assert calls == [2]
+    assert torch.allclose(outputs, expected, atol=1e-5)
+    assert predictor.feature_cache.misses == 2
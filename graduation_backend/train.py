@@ -215,6 +215,13 @@ if __name__ == "__main__":
     #------------------------------------------------------------------#
     eval_flag           = True
     eval_period         = 5
+    #------------------------------------------------------------------#
+    #   eval_cache_mb   验证集预处理后的uint8缓存不超过该大小（MB）时放在内存中
+    #   eval_cache_dir  超过eval_cache_mb时在该文件夹下用mmap缓存，
+    #                   为None时每次评估都从磁盘重新读取验证集
+    #------------------------------------------------------------------#
+    eval_cache_mb       = 2048
+    eval_cache_dir      = None
     
     #------------------------------#
     #   数据集路径
@@ -444,7 +451,7 @@ if __name__ == "__main__":
         #----------------------#
         if local_rank == 0:
             eval_callback   = EvalCallback(model, input_shape, num_classes, val_lines, VOCdevkit_path, log_dir, Cuda, \
-                                            eval_flag=eval_flag, period=eval_period)
+                                            eval_flag=eval_flag, period=eval_period, cache_max_mb=eval_cache_mb, cache_dir=eval_cache_dir)
         else:
             eval_callback   = None
         
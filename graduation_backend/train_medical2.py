@@ -15,10 +15,16 @@ from nets.unet_training import get_lr_scheduler, set_optimizer_lr, weights_init
 from utils.callbacks import LossHistory
 # from utils.dataloader_medical import UnetDataset, unet_dataset_collate
 # 如果Label标签是两个
-from utils.dataloader_medical import UnetDataset, unet_dataset_collate
+from utils.dataloader_medical import (PackedUnetDataset, UnetDataset,
+                                      unet_dataset_collate)
 from utils.utils import (download_weights, seed_everything, show_config,
-                         worker_init_fn)
-from utils.utils_fit import fit_one_epoch_no_val
+                         str2bool, worker_init_fn)
+from utils.utils_augment import GPUAugmenter
+from utils.utils_autobatch import find_batch_size
+from utils.utils_compile import optimize_model
+from utils.utils_distributed import (BACKENDS, cleanup_distributed,
+                                     init_distributed, wrap_ddp)
+from utils.utils_fit import fit_one_epoch_no_val, get_grad_scaler
 
 
 '''
@@ -48,35 +54,56 @@ if __name__ == "__main__":
 
     #---------------------------------#
     #   Cuda    是否使用Cuda
-    #           没有GPU可以设置成False
+    #           没有GPU时自动为False，在CPU上训练
     #---------------------------------#
-    Cuda = True
+    Cuda = torch.cuda.is_available()
     #----------------------------------------------#
     #   Seed    用于固定随机种子
     #           使得每次独立训练都可以获得一样的结果
     #----------------------------------------------#
     seed            = 11
     #---------------------------------------------------------------------#
-    #   distributed     用于指定是否使用单机多卡分布式运行
-    #                   终端指令仅支持Ubuntu。CUDA_VISIBLE_DEVICES用于在Ubuntu下指定显卡。
-    #                   Windows系统下默认使用DP模式调用所有显卡，不支持DDP。
+    #   distributed     用于指定是否使用多进程分布式运行（DDP），GPU与CPU上都可以使用
+    #                   每个进程训练数据集的一部分，梯度在进程间求平均
+    #   backend         进程间通信的后端，auto时GPU上使用nccl，CPU上使用gloo
     #   DP模式：
-    #       设置            distributed = False
-    #       在终端中输入    CUDA_VISIBLE_DEVICES=0,1 python train_medical.py
-    #   DDP模式：
-    #       设置            distributed = True
-    #       在终端中输入    CUDA_VISIBLE_DEVICES=0,1 python -m torch.distributed.launch --nproc_per_node=2 train_medical.py
+    #       在终端中输入    CUDA_VISIBLE_DEVICES=0,1 python train_medical2.py
+    #   DDP模式（多卡，每张卡一个进程）：
+    #       在终端中输入    CUDA_VISIBLE_DEVICES=0,1 python -m torch.distributed.run --standalone --nproc_per_node 2 train_medical2.py --distributed
+    #   DDP模式（CPU，进程平分CPU核心）：
+    #       在终端中输入    python -m torch.distributed.run --standalone --nproc_per_node 4 train_medical2.py --distributed --backend gloo
+    #   多台机器时把--standalone换成--nnodes、--node_rank与--rdzv_endpoint
+    #   不同进程数的扩展效率可以用benchmark.py --world_size 1 2 4比较
     #---------------------------------------------------------------------#
-    distributed     = False
+    parser.add_argument("--distributed", action='store_true', help="使用多进程分布式训练，需要用torch.distributed.run启动")
+    parser.add_argument("--backend", type=str, default='auto', choices=BACKENDS, help="分布式训练的通信后端，默认为'auto'")
     #---------------------------------------------------------------------#
     #   sync_bn     是否使用sync_bn，DDP模式多卡可用
     #---------------------------------------------------------------------#
     sync_bn         = False
     #---------------------------------------------------------------------#
-    #   fp16        是否使用混合精度训练
-    #               可减少约一半的显存、需要pytorch1.7.1以上
+    #   precision   训练精度，可选"fp32"、"fp16"、"bf16"
+    #               fp16只能在GPU上使用，可减少约一半的显存，会自动使用GradScaler
+    #               bf16在GPU（Ampere及以上）与CPU上都可以使用，不需要GradScaler
+    #               需要pytorch1.10以上
     #---------------------------------------------------------------------#
-    fp16            = False
+    #---------------------------------------------------------------------#
+    #   channels_last   模型与输入使用channels_last内存格式，卷积较多的VGG在x86 CPU与较新的GPU上更快
+    #   compile         使用torch.compile编译模型（需要pytorch2.2以上），第一个epoch的前几步需要编译
+    #   compile_mode    torch.compile的mode，可选default、reduce-overhead、max-autotune
+    #   compile_cache_dir   编译结果的缓存文件夹，再次训练时命中缓存可以跳过大部分编译时间
+    #---------------------------------------------------------------------#
+    #---------------------------------------------------------------------#
+    #   checkpoint  对哪些stage使用激活值重计算（gradient checkpointing），可选encoder、fuse、decoder、all
+    #               例如--checkpoint encoder decoder，显存占用大幅降低，可以把Unfreeze_batch_size调大4~8倍，
+    #               代价是每一步多一次对应stage的前向传播，可以用benchmark.py --checkpoint比较
+    #---------------------------------------------------------------------#
+    parser.add_argument("--checkpoint", type=str, nargs='*', default=[], choices=['encoder', 'fuse', 'decoder', 'all'], help="使用激活值重计算的stage，默认不使用")
+    parser.add_argument("--channels_last", action='store_true', help="使用channels_last内存格式")
+    parser.add_argument("--compile", action='store_true', help="使用torch.compile编译模型")
+    parser.add_argument("--compile_mode", type=str, default=None, help="torch.compile的mode，默认为None")
+    parser.add_argument("--compile_cache_dir", type=str, default='model_data/compile_cache', help="编译结果的缓存文件夹，默认为'model_data/compile_cache'")
+    parser.add_argument("--precision", type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'], help="训练精度，可选fp32、fp16、bf16，默认为'fp32'")
     #-----------------------------------------------------#
     #   num_classes     训练自己的数据集必须要修改的
     #                   自己需要的分类个数+1，如2+1
@@ -96,7 +123,7 @@ if __name__ == "__main__":
     #                   如果不设置model_path，pretrained = False，Freeze_Train = Fasle，此时从0开始训练，且没有冻结主干的过程。
     #----------------------------------------------------------------------------------------------------------------------------#
     # pretrained  = True
-    parser.add_argument("--pretrained", type=bool, default=True, help="是否使用主干网络的预训练权重，默认为'True'")
+    parser.add_argument("--pretrained", type=str2bool, default=True, help="是否使用主干网络的预训练权重，默认为'True'")
     #----------------------------------------------------------------------------------------------------------------------------#
     #   权值文件的下载请看README，可以通过网盘下载。模型的 预训练权重 对不同数据集是通用的，因为特征是通用的。
     #   模型的 预训练权重 比较重要的部分是 主干特征提取网络的权值部分，用于进行特征提取。
@@ -181,13 +208,26 @@ if __name__ == "__main__":
     # Unfreeze_batch_size = 2
     parser.add_argument("--UnFreeze_Epoch", type=int, default=50, help="模型总共训练的epoch，默认为'50'")
     parser.add_argument("--Unfreeze_batch_size", type=int, default=2, help="模型在解冻后的batch_size，默认为'2'")
+    #------------------------------------------------------------------#
+    #   accumulation_steps      梯度累积的步数，每accumulation_steps个batch更新一次参数，
+    #                           等效的batch_size为batch_size * accumulation_steps，学习率按等效batch_size调整
+    #   effective_batch_size    大于0时根据batch_size自动计算accumulation_steps，
+    #                           例如16与batch_size 4对应accumulation_steps 4
+    #   auto_batch_size         训练开始前二分查找能放进显存（CPU上为内存）的最大batch_size，
+    #                           并以此替换Freeze_batch_size与Unfreeze_batch_size
+    #   max_batch_size          auto_batch_size查找的上限
+    #------------------------------------------------------------------#
+    parser.add_argument("--accumulation_steps", type=int, default=1, help="梯度累积的步数，默认为'1'")
+    parser.add_argument("--effective_batch_size", type=int, default=0, help="等效的batch_size，大于0时自动计算accumulation_steps，默认为'0'")
+    parser.add_argument("--auto_batch_size", action='store_true', help="训练前自动查找能放进内存的最大batch_size")
+    parser.add_argument("--max_batch_size", type=int, default=64, help="auto_batch_size查找的上限，默认为'64'")
 
     #------------------------------------------------------------------#
     #   Freeze_Train    是否进行冻结训练
     #                   默认先冻结主干训练后解冻训练。
     #------------------------------------------------------------------#
     # Freeze_Train        = False
-    parser.add_argument("--Freeze_Train", type=bool, default=False, help="是否进行冻结训练，默认为'False'")
+    parser.add_argument("--Freeze_Train", type=str2bool, default=False, help="是否进行冻结训练，默认为'False'")
 
     #------------------------------------------------------------------#
     #   其它训练参数：学习率、优化器、学习率下降有关
@@ -226,7 +266,8 @@ if __name__ == "__main__":
     # save_dir            = 'ABNORMAL'
     # save_dir            = 'DRIVElogs'
     # save_dir            = 'IDRiDlogs'
-    save_dir            = 'outcome'
+    # save_dir            = 'outcome'
+    parser.add_argument("--save_dir", type=str, default='outcome', help="权值与日志文件保存的文件夹，默认为'outcome'")
     
     #------------------------------#
     #   数据集路径
@@ -237,11 +278,19 @@ if __name__ == "__main__":
     # VOCdevkit_path  = 'Medical_Datasets/CHASEDB1'
   
     parser.add_argument("--dataset", type=str, default='./dataset/CHASEDB1', help="数据集路径，默认为'./dataset/CHASEDB1'")
+    #------------------------------------------------------------------#
+    #   packed      pack_dataset.py生成的打包文件路径（不含扩展名）
+    #               指定后从预先解码的打包文件中读取样本，不再每个epoch解码图片
+    #------------------------------------------------------------------#
+    parser.add_argument("--packed", type=str, default='', help="pack_dataset.py生成的打包文件路径（不含扩展名），默认为''不使用")
     # 解析命令行参数
     args = parser.parse_args()
     # 使用命令行参数
     VOCdevkit_path = args.dataset
     num_classes= args.num_classes
+    precision= args.precision
+    distributed= args.distributed
+    channels_last= args.channels_last
     pretrained= args.pretrained
     model_path= args.model_path
     Init_Epoch= args.Init_Epoch
@@ -251,6 +300,7 @@ if __name__ == "__main__":
     Unfreeze_batch_size= args.Unfreeze_batch_size
     Freeze_Train= args.Freeze_Train
     save_period    = args.save_period    
+    save_dir       = args.save_dir
     
     #------------------------------------------------------------------#
     #   建议选项：
@@ -278,24 +328,55 @@ if __name__ == "__main__":
     #                   在IO为瓶颈的时候再开启多线程，即GPU运算速度远大于读取图片的速度。
     #------------------------------------------------------------------#
     num_workers         = 4
+    #------------------------------------------------------------------#
+    #   compact_labels  数据集只返回uint8的种类图，不再在DataLoader中构建one_hot标签
+    #                   one_hot在损失函数与指标中于设备上计算，结果与原来一致，
+    #                   但进程间与主机到设备的传输量减少一个数量级
+    #------------------------------------------------------------------#
+    compact_labels      = True
+    #------------------------------------------------------------------#
+    #   uint8_images    数据集返回uint8的CHW图像，在设备上再除以255，
+    #                   工作进程内存与主机到设备的传输量均大幅减少
+    #   input_mean      设备上归一化后可选的标准化均值与方差，如[0.485, 0.456, 0.406]
+    #   input_std       为None时与原来一样只除以255，预测时需要在Unet中设置相同的值
+    #------------------------------------------------------------------#
+    uint8_images        = True
+    input_mean          = None
+    input_std           = None
+    #------------------------------------------------------------------#
+    #   fast_augment    使用PairedAugmenter进行数据增强，每个样本只计算一次仿射矩阵，
+    #                   三张图各进行一次warpAffine，并真正应用HSV色域变换
+    #                   增强参数由(seed, epoch, 样本序号)决定，可以复现
+    #------------------------------------------------------------------#
+    fast_augment        = True
+    #------------------------------------------------------------------#
+    #   gpu_augment     在训练设备上对整个batch进行数据增强（缩放、扭曲、翻转、平移、
+    #                   亮度/对比度/饱和度），DataLoader只负责解码与letterbox，
+    #                   CPU核心较少、num_workers无法喂饱GPU时开启。
+    #                   超出原图的标签区域设置为忽略，不参与损失计算
+    #------------------------------------------------------------------#
+    gpu_augment         = False
+    #------------------------------------------------------------------#
+    #   log_interval    损失与指标在设备上累加，每隔log_interval步才同步一次并刷新进度条，
+    #                   epoch结束时记录整个epoch的平均值
+    #------------------------------------------------------------------#
+    log_interval        = 10
 
     seed_everything(seed)
     #------------------------------------------------------#
     #   设置用到的显卡
+    #   world_size为参与训练的进程数，batch_size在进程间平分
     #------------------------------------------------------#
-    ngpus_per_node  = torch.cuda.device_count()
     if distributed:
-        dist.init_process_group(backend="nccl")
-        local_rank  = int(os.environ["LOCAL_RANK"])
-        rank        = int(os.environ["RANK"])
-        device      = torch.device("cuda", local_rank)
+        device, local_rank, rank, world_size = init_distributed(args.backend, Cuda)
         if local_rank == 0:
             print(f"[{os.getpid()}] (rank = {rank}, local_rank = {local_rank}) training...")
-            print("Gpu Device Count : ", ngpus_per_node)
+            print("Backend : {}, World Size : {}".format(dist.get_backend(), world_size))
     else:
         device          = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         local_rank      = 0
         rank            = 0
+        world_size      = 1
 
     #----------------------------------------------------#
     #   下载预训练权重
@@ -312,6 +393,7 @@ if __name__ == "__main__":
     # model = Unet(num_classes=num_classes, pretrained=pretrained, backbone=backbone).train()
     if not pretrained:
         weights_init(model)
+    model.set_checkpointing(args.checkpoint)
     if  model_path!= '':
         #------------------------------------------------------#
         #   权值文件
@@ -353,35 +435,65 @@ if __name__ == "__main__":
         loss_history = None
 
     #------------------------------------------------------------------#
-    #   torch 1.2不支持amp，建议使用torch 1.7.1及以上正确使用fp16
-    #   因此torch1.2这里显示"could not be resolve"
+    #   只有GPU上的fp16需要GradScaler，bf16与fp32直接反向传播
     #------------------------------------------------------------------#
-    if fp16:
-        from torch.cuda.amp import GradScaler as GradScaler
-        scaler = GradScaler()
-    else:
-        scaler = None
+    scaler = get_grad_scaler(precision, Cuda)
 
     model_train     = model.train()
     #----------------------------#
     #   多卡同步Bn
     #----------------------------#
-    if sync_bn and ngpus_per_node > 1 and distributed:
+    if sync_bn and Cuda and distributed and world_size > 1:
         model_train = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model_train)
     elif sync_bn:
         print("Sync_bn is not support in one gpu or not distributed.")
+    #----------------------------#
+    #   channels_last与torch.compile
+    #   compile为原地编译，保存的权值与eager模式相同
+    #----------------------------#
+    model_train = optimize_model(model_train, channels_last=channels_last, compile=args.compile, compile_mode=args.compile_mode, \
+        cache_dir=args.compile_cache_dir)
 
-    if Cuda:
-        if distributed:
-            #----------------------------#
-            #   多卡平行运行
-            #----------------------------#
-            model_train = model_train.cuda(local_rank)
-            model_train = torch.nn.parallel.DistributedDataParallel(model_train, device_ids=[local_rank], find_unused_parameters=True)
-        else:
-            model_train = torch.nn.DataParallel(model)
+    if distributed:
+        #----------------------------#
+        #   多进程平行运行
+        #   没有未使用的参数时关闭find_unused_parameters，
+        #   冻结的参数requires_grad为False，不影响判断
+        #   DDP只同步包装时需要梯度的参数，因此冻结训练时先冻结再包装，解冻后重新包装
+        #----------------------------#
+        if Freeze_Train:
+            model.freeze_backbone()
+        if Cuda:
             cudnn.benchmark = True
-            model_train = model_train.cuda()
+        model_train = model_train.to(device)
+        model_train, find_unused = wrap_ddp(model_train, device, input_shape)
+        if local_rank == 0:
+            print("find_unused_parameters : {}".format(find_unused))
+    elif Cuda:
+        model_train = torch.nn.DataParallel(model)
+        cudnn.benchmark = True
+        model_train = model_train.cuda()
+    
+    #----------------------------------------------------------#
+    #   自动查找batch_size，分布式训练时每个进程分别查找后取最小值
+    #   DDP的反向传播会在进程间同步梯度，因此对包装前的模型进行探测
+    #----------------------------------------------------------#
+    if args.auto_batch_size:
+        probe_batch_size = find_batch_size(model_train.module if distributed else model_train, input_shape, num_classes, precision=precision, cuda=Cuda, channels_last=channels_last, \
+            max_batch_size=args.max_batch_size, local_rank=local_rank)
+        if distributed:
+            probe_batch_size = torch.tensor(probe_batch_size, device=device)
+            dist.all_reduce(probe_batch_size, op=dist.ReduceOp.MIN)
+            probe_batch_size = int(probe_batch_size.item()) * world_size
+        Freeze_batch_size = Unfreeze_batch_size = probe_batch_size
+        if local_rank == 0:
+            print("Auto batch size: {}".format(probe_batch_size))
+    #----------------------------------------------------------#
+    #   根据等效batch_size计算梯度累积的步数
+    #----------------------------------------------------------#
+    accumulation_steps = args.accumulation_steps
+    if args.effective_batch_size > 0:
+        accumulation_steps = max(1, -(-args.effective_batch_size // Unfreeze_batch_size))
     
     #---------------------------#
     #   读取数据集对应的txt
@@ -395,7 +507,8 @@ if __name__ == "__main__":
             num_classes = num_classes, backbone = backbone, model_path = model_path, input_shape = input_shape, \
             Init_Epoch = Init_Epoch, Freeze_Epoch = Freeze_Epoch, UnFreeze_Epoch = UnFreeze_Epoch, Freeze_batch_size = Freeze_batch_size, Unfreeze_batch_size = Unfreeze_batch_size, Freeze_Train = Freeze_Train, \
             Init_lr = Init_lr, Min_lr = Min_lr, optimizer_type = optimizer_type, momentum = momentum, lr_decay_type = lr_decay_type, \
-            save_period = save_period, save_dir = save_dir, num_workers = num_workers, num_train = num_train
+            save_period = save_period, save_dir = save_dir, num_workers = num_workers, num_train = num_train, precision = precision, \
+            channels_last = channels_last, compile = args.compile, checkpoint = args.checkpoint, accumulation_steps = accumulation_steps
         )
     #------------------------------------------------------#
     #   主干特征提取网络特征通用，冻结训练可以加快训练速度
@@ -419,13 +532,13 @@ if __name__ == "__main__":
         batch_size = Unfreeze_batch_size if Freeze_Train else Unfreeze_batch_size #不冻结试试
 
         #-------------------------------------------------------------------#
-        #   判断当前batch_size，自适应调整学习率
+        #   判断当前的等效batch_size，自适应调整学习率
         #-------------------------------------------------------------------#
         nbs             = 16
         lr_limit_max    = 1e-4 if optimizer_type == 'adam' else 1e-1
         lr_limit_min    = 1e-4 if optimizer_type == 'adam' else 5e-4
-        Init_lr_fit     = min(max(batch_size / nbs * Init_lr, lr_limit_min), lr_limit_max)
-        Min_lr_fit      = min(max(batch_size / nbs * Min_lr, lr_limit_min * 1e-2), lr_limit_max * 1e-2)
+        Init_lr_fit     = min(max(batch_size * accumulation_steps / nbs * Init_lr, lr_limit_min), lr_limit_max)
+        Min_lr_fit      = min(max(batch_size * accumulation_steps / nbs * Min_lr, lr_limit_min * 1e-2), lr_limit_max * 1e-2)
 
         #---------------------------------------#
         #   根据optimizer_type选择优化器
@@ -442,17 +555,27 @@ if __name__ == "__main__":
         
         #---------------------------------------#
         #   判断每一个世代的长度
+        #   取accumulation_steps的整数倍，每次参数更新都使用完整的等效batch
         #---------------------------------------#
-        epoch_step      = num_train // batch_size
+        epoch_step      = num_train // batch_size // accumulation_steps * accumulation_steps
         
         if epoch_step == 0:
             raise ValueError("数据集过小，无法继续进行训练，请扩充数据集。")
 
-        train_dataset   = UnetDataset(train_lines, input_shape, num_classes, True, VOCdevkit_path)
+        if args.packed:
+            train_dataset   = PackedUnetDataset(train_lines, input_shape, num_classes, not gpu_augment, VOCdevkit_path, args.packed, compact_labels=compact_labels, uint8_images=uint8_images,
+                                                fast_augment=fast_augment, seed=seed)
+        else:
+            train_dataset   = UnetDataset(train_lines, input_shape, num_classes, not gpu_augment, VOCdevkit_path, compact_labels=compact_labels, uint8_images=uint8_images,
+                                          fast_augment=fast_augment, seed=seed)
         
+        batch_augmenter = GPUAugmenter(ignore_index=num_classes, seed=seed) if gpu_augment else None
+
         if distributed:
-            train_sampler   = torch.utils.data.distributed.DistributedSampler(train_dataset, shuffle=True,)
-            batch_size      = batch_size // ngpus_per_node
+            if batch_size < world_size:
+                raise ValueError("batch_size不能小于分布式训练的进程数{}。".format(world_size))
+            train_sampler   = torch.utils.data.distributed.DistributedSampler(train_dataset, shuffle=True, seed=seed)
+            batch_size      = batch_size // world_size
             shuffle         = False
         else:
             train_sampler   = None
@@ -479,22 +602,24 @@ if __name__ == "__main__":
                 nbs             = 16
                 lr_limit_max    = 1e-4 if optimizer_type == 'adam' else 1e-1
                 lr_limit_min    = 1e-4 if optimizer_type == 'adam' else 5e-4
-                Init_lr_fit     = min(max(batch_size / nbs * Init_lr, lr_limit_min), lr_limit_max)
-                Min_lr_fit      = min(max(batch_size / nbs * Min_lr, lr_limit_min * 1e-2), lr_limit_max * 1e-2)
+                Init_lr_fit     = min(max(batch_size * accumulation_steps / nbs * Init_lr, lr_limit_min), lr_limit_max)
+                Min_lr_fit      = min(max(batch_size * accumulation_steps / nbs * Min_lr, lr_limit_min * 1e-2), lr_limit_max * 1e-2)
                 #---------------------------------------#
                 #   获得学习率下降的公式
                 #---------------------------------------#
                 lr_scheduler_func = get_lr_scheduler(lr_decay_type, Init_lr_fit, Min_lr_fit, UnFreeze_Epoch)
                     
                 model.unfreeze_backbone()
+                if distributed:
+                    model_train, _ = wrap_ddp(model_train.module, device, input_shape)
                             
-                epoch_step      = num_train // batch_size
+                epoch_step      = num_train // batch_size // accumulation_steps * accumulation_steps
 
                 if epoch_step == 0:
                     raise ValueError("数据集过小，无法继续进行训练，请扩充数据集。")
 
                 if distributed:
-                    batch_size = batch_size // ngpus_per_node
+                    batch_size = batch_size // world_size
 
                 gen             = DataLoader(train_dataset, shuffle = shuffle, batch_size = batch_size, num_workers = num_workers, pin_memory=True,
                                             drop_last = True, collate_fn = unet_dataset_collate, sampler=train_sampler, 
@@ -504,10 +629,11 @@ if __name__ == "__main__":
 
             if distributed:
                 train_sampler.set_epoch(epoch)
+            train_dataset.set_epoch(epoch)
 
             set_optimizer_lr(optimizer, lr_scheduler_func, epoch)
 
-            fit_one_epoch_no_val(model_train, model, loss_history, optimizer, epoch, epoch_step, gen, UnFreeze_Epoch, Cuda, dice_loss, focal_loss, cls_weights, num_classes, fp16, scaler, save_period, save_dir, local_rank)
+            fit_one_epoch_no_val(model_train, model, loss_history, optimizer, epoch, epoch_step, gen, UnFreeze_Epoch, Cuda, dice_loss, focal_loss, cls_weights, num_classes, precision, scaler, save_period, save_dir, local_rank, input_mean, input_std, batch_augmenter, log_interval, channels_last, accumulation_steps)
             
             
             # name_classes    = ["background","aeroplane", "bicycle", "bird", "boat", "bottle", "bus", "car", "cat", "chair", "cow", "diningtable", "dog", "horse", "motorbike", "person", "pottedplant", "sheep", "sofa", "train", "tvmonitor"]
@@ -518,4 +644,7 @@ if __name__ == "__main__":
                 dist.barrier()
 
         if local_rank == 0:
-            loss_history.writer.close()
\ No newline at end of file
+            loss_history.writer.close()
+
+    if distributed:
+        cleanup_distributed()
\ No newline at end of file
@@ -2,7 +2,6 @@ import colorsys
 import copy
 import time
 
-import cv2
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -10,7 +9,12 @@ from PIL import Image
 from torch import nn
 
 from nets.unet import Unet as unet
-from utils.utils import cvtColor, preprocess_input, resize_image, show_config
+from utils.utils import (cvtColor, get_tile_starts, get_tile_window,
+                         postprocess_output, preprocess_input,
+                         preprocess_input_tensor, resize_image,
+                         resize_image_pair, show_config)
+from utils.utils_cache import FeatureCache
+from utils.utils_compile import optimize_model, to_channels_last
 
 
 #--------------------------------------------#
@@ -52,6 +56,35 @@ class Unet(object):
         #   没有GPU可以设置成False
         #--------------------------------#
         "cuda"          : True,
+        #-------------------------------------------------------------------#
+        #   feature_cache_mb    多模态推理时模态A编码器特征的缓存大小（MB）
+        #                       同一张模态A图片与多张模态B图片配对时可跳过模态A的编码器
+        #                       单张512x512图片的特征金字塔约占120MB，设置为0时不使用缓存
+        #-------------------------------------------------------------------#
+        "feature_cache_mb"  : 0,
+        #-------------------------------------------------------------------#
+        #   postprocess     网络输出的后处理方式
+        #   "fast"          不计算softmax，在设备上裁剪并上采样logits后取argmax
+        #   "label"         先取argmax，再对种类图做最近邻resize，速度最快
+        #   "legacy"        softmax后在CPU上对所有通道resize，与原先结果逐位一致
+        #-------------------------------------------------------------------#
+        "postprocess"       : "fast",
+        #-------------------------------------------------------------------#
+        #   input_mean、input_std   在设备上除以255之后可选的标准化参数
+        #                           需要与训练时train_medical2.py中的设置一致，None时只除以255
+        #-------------------------------------------------------------------#
+        "input_mean"        : None,
+        "input_std"         : None,
+        #-------------------------------------------------------------------#
+        #   channels_last       模型与输入使用channels_last内存格式
+        #   compile             使用torch.compile编译模型，需要pytorch2.2以上，
+        #                       第一次预测（以及每种新的batch大小）需要编译
+        #                       feature_cache_mb大于0时分别编译两个编码器与decode，特征缓存的前向传播同样经过编译
+        #   compile_cache_dir   编译结果的缓存文件夹，重启服务后命中缓存可以跳过大部分编译时间
+        #-------------------------------------------------------------------#
+        "channels_last"     : False,
+        "compile"           : False,
+        "compile_cache_dir" : 'model_data/compile_cache',
     # 这个是unet纯卷积网络，只能通过标记好的数据集训练，可以识别边缘
     #---------------------------------------------------#
     #   初始化UNET
@@ -80,22 +113,38 @@ class Unet(object):
         #   获得模型
         #---------------------------------------------------#
         self.generate()
+        self.feature_cache = FeatureCache(self.feature_cache_mb) if self.feature_cache_mb > 0 else None
         
         show_config(**self._defaults)
 
+    #---------------------------------------------------#
+    #   将uint8的NCHW图像传到设备上再进行归一化
+    #   主机到设备只传输uint8数据
+    #---------------------------------------------------#
+    def to_input(self, image_data):
+        images = torch.from_numpy(np.ascontiguousarray(image_data))
+        if self.cuda:
+            images = images.cuda()
+        return to_channels_last(preprocess_input_tensor(images, self.input_mean, self.input_std), self.channels_last)
+
     #---------------------------------------------------#
     #   获得所有的分类
     #---------------------------------------------------#
     def generate(self, onnx=False):
     # 注意：需要提供两种模态的图像路径或图像数据
     # 示例代码需要根据实际情况进行调整
-        self.net = unet(num_classes=self.num_classes, pretrained=True)  # 假设您想要使用预训练的模型
+        #---------------------------------------------------#
+        #   权值随后会被model_path整体覆盖，无需再下载主干网络的预训练权重
+        #---------------------------------------------------#
+        self.net = unet(num_classes=self.num_classes, pretrained=False)
 
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.net.load_state_dict(torch.load(self.model_path, map_location=device))
         self.net = self.net.eval()
         print('{} model, and classes loaded.'.format(self.model_path))
         if not onnx:
+            self.net = optimize_model(self.net, channels_last=self.channels_last, compile=self.compile, cache_dir=self.compile_cache_dir, \
+                compile_stages=self.feature_cache_mb > 0)
             if self.cuda:
                 self.net = nn.DataParallel(self.net)
                 self.net = self.net.cuda()
@@ -160,36 +209,27 @@ class Unet(object):
         #---------------------------------------------------------#
         #   添加上batch_size维度
         #---------------------------------------------------------#
-        image_data  = np.expand_dims(np.transpose(preprocess_input(np.array(image_data, np.float32)), (2, 0, 1)), 0)
+        image_data  = np.expand_dims(np.transpose(np.array(image_data, np.uint8), (2, 0, 1)), 0)
 
         with torch.no_grad():
-            images = torch.from_numpy(image_data)
-            if self.cuda:
-                images = images.cuda()
+            images = self.to_input(image_data)
                 
             #---------------------------------------------------#
             #   图片传入网络进行预测
             #---------------------------------------------------#
             pr = self.net(images)[0]
             #---------------------------------------------------#
-            #   取出每一个像素点的种类
-            # （-----------           -----以下可以直接适用于多模态unet-----             ----------------）
-            #---------------------------------------------------#
-            pr = F.softmax(pr.permute(1,2,0),dim = -1).cpu().numpy()
-            #--------------------------------------#
-            #   将灰条部分截取掉
-            #--------------------------------------#
-            pr = pr[int((self.input_shape[0] - nh) // 2) : int((self.input_shape[0] - nh) // 2 + nh), \
-                    int((self.input_shape[1] - nw) // 2) : int((self.input_shape[1] - nw) // 2 + nw)]
-            #---------------------------------------------------#
-            #   进行图片的resize
-            #---------------------------------------------------#
-            pr = cv2.resize(pr, (orininal_w, orininal_h), interpolation = cv2.INTER_LINEAR)
-            #---------------------------------------------------#
-            #   取出每一个像素点的种类
+            #   将灰条部分截取掉，resize回原图大小并取出每一个像素点的种类
             #---------------------------------------------------#
-            pr = pr.argmax(axis=-1)
+            pr = postprocess_output(pr, (orininal_h, orininal_w, nh, nw), self.input_shape, self.postprocess)
         
+        return self.draw_result(old_img, pr, count=count, name_classes=name_classes)
+
+    #---------------------------------------------------#
+    #   根据每个像素点的种类绘制结果图，并按mix_type进行混合
+    #---------------------------------------------------#
+    def draw_result(self, old_img, pr, count=False, name_classes=None):
+        orininal_h, orininal_w = np.shape(pr)[0], np.shape(pr)[1]
         #---------------------------------------------------------#
         #   计数
         #---------------------------------------------------------#
@@ -259,12 +299,10 @@ class Unet(object):
         #---------------------------------------------------------#
         #   添加上batch_size维度
         #---------------------------------------------------------#
-        image_data  = np.expand_dims(np.transpose(preprocess_input(np.array(image_data, np.float32)), (2, 0, 1)), 0)
+        image_data  = np.expand_dims(np.transpose(np.array(image_data, np.uint8), (2, 0, 1)), 0)
 
         with torch.no_grad():
-            images = torch.from_numpy(image_data)
-            if self.cuda:
-                images = images.cuda()
+            images = self.to_input(image_data)
                 
             #---------------------------------------------------#
             #   图片传入网络进行预测
@@ -354,38 +392,224 @@ class Unet(object):
         #---------------------------------------------------------#
         #   添加上batch_size维度
         #---------------------------------------------------------#
-        image_data  = np.expand_dims(np.transpose(preprocess_input(np.array(image_data, np.float32)), (2, 0, 1)), 0)
+        image_data  = np.expand_dims(np.transpose(np.array(image_data, np.uint8), (2, 0, 1)), 0)
 
         with torch.no_grad():
-            images = torch.from_numpy(image_data)
-            if self.cuda:
-                images = images.cuda()
+            images = self.to_input(image_data)
                 
             #---------------------------------------------------#
             #   图片传入网络进行预测
             #---------------------------------------------------#
             pr = self.net(images)[0]
             #---------------------------------------------------#
-            #   取出每一个像素点的种类
+            #   将灰条部分截取掉，resize回原图大小并取出每一个像素点的种类
             #---------------------------------------------------#
-            pr = F.softmax(pr.permute(1,2,0),dim = -1).cpu().numpy()
-            #--------------------------------------#
-            #   将灰条部分截取掉
-            #--------------------------------------#
-            pr = pr[int((self.input_shape[0] - nh) // 2) : int((self.input_shape[0] - nh) // 2 + nh), \
-                    int((self.input_shape[1] - nw) // 2) : int((self.input_shape[1] - nw) // 2 + nw)]
-            #---------------------------------------------------#
-            #   进行图片的resize
-            #---------------------------------------------------#
-            pr = cv2.resize(pr, (orininal_w, orininal_h), interpolation = cv2.INTER_LINEAR)
-            #---------------------------------------------------#
-            #   取出每一个像素点的种类
-            #---------------------------------------------------#
-            pr = pr.argmax(axis=-1)
+            pr = postprocess_output(pr, (orininal_h, orininal_w, nh, nw), self.input_shape, self.postprocess)
     
         image = Image.fromarray(np.uint8(pr))
         return image
 
+    #---------------------------------------------------#
+    #   批量预处理
+    #   将多张图片分别加灰条resize后拼成一个NCHW的batch，
+    #   同时记录每张图片的原始大小与有效区域大小
+    #   传入images_B时为多模态输入，模态B与模态A共用同一次letterbox计算
+    #---------------------------------------------------#
+    def preprocess_batch(self, images, images_B=None):
+        image_datas     = []
+        image_datas_B   = []
+        metas           = []
+        for i, image in enumerate(images):
+            image       = cvtColor(image)
+            orininal_w, orininal_h = image.size
+            if images_B is None:
+                image_data, nw, nh  = resize_image(image, (self.input_shape[1],self.input_shape[0]))
+            else:
+                image_data, image_data_B, nw, nh = resize_image_pair(image, cvtColor(images_B[i]), (self.input_shape[1],self.input_shape[0]))
+                image_datas_B.append(np.transpose(np.array(image_data_B, np.uint8), (2, 0, 1)))
+            image_datas.append(np.transpose(np.array(image_data, np.uint8), (2, 0, 1)))
+            metas.append((orininal_h, orininal_w, nh, nw))
+        image_datas_B = np.stack(image_datas_B, 0) if images_B is not None else None
+        return np.stack(image_datas, 0), image_datas_B, metas
+
+    #---------------------------------------------------#
+    #   将一张图片的网络输出还原到原图大小，得到每个像素点的种类
+    #---------------------------------------------------#
+    def decode_prediction(self, pr, meta):
+        return postprocess_output(pr, meta, self.input_shape, self.postprocess)
+
+    #---------------------------------------------------#
+    #   批量预测，每batch_size张图片只进行一次前向传播
+    #   融合网络需要模态A与模态B同时输入，images_B不能为None
+    #   返回每张图片对应的种类图（原图大小）
+    #---------------------------------------------------#
+    def predict_batch(self, images, batch_size=8, images_B=None):
+        if images_B is None:
+            raise ValueError("融合网络需要模态A与模态B同时输入，请传入images_B。")
+        if len(images_B) != len(images):
+            raise ValueError("模态A与模态B的图片数量不一致。")
+        prs = []
+        for start in range(0, len(images), batch_size):
+            image_data, image_data_B, metas = self.preprocess_batch(images[start : start + batch_size], images_B[start : start + batch_size])
+
+            with torch.no_grad():
+                batch   = self.to_input(image_data)
+                batch_B = self.to_input(image_data_B)
+                #---------------------------------------------------#
+                #   图片传入网络进行预测
+                #---------------------------------------------------#
+                if self.feature_cache is not None:
+                    outputs = self.forward_cached(batch, batch_B, image_data)
+                else:
+                    outputs = self.net(batch, batch_B)
+                for i, meta in enumerate(metas):
+                    prs.append(self.decode_prediction(outputs[i], meta))
+        return prs
+
+    #---------------------------------------------------#
+    #   使用特征缓存的多模态前向传播
+    #   模态A的特征金字塔按图片内容哈希缓存，命中时跳过encoder_A
+    #   同一batch中相同的模态A图片只查询缓存、只编码一次，
+    #   例如一张模态A基线图与N张模态B图片时encoder_A只运行一次
+    #---------------------------------------------------#
+    def forward_cached(self, images_A, images_B, image_data_A):
+        net     = self.net.module if isinstance(self.net, nn.DataParallel) else self.net
+        keys    = [self.feature_cache.hash_image(image_data) for image_data in image_data_A]
+        #---------------------------------------------------#
+        #   每个不同的key在batch中第一次出现的位置
+        #---------------------------------------------------#
+        first   = {}
+        for i, key in enumerate(keys):
+            first.setdefault(key, i)
+        cached  = {key: self.feature_cache.get(key) for key in first}
+        misses  = [key for key, feats in cached.items() if feats is None]
+        if len(misses) > 0:
+            feats_miss = net.encode_A(images_A[[first[key] for key in misses]])
+            for j, key in enumerate(misses):
+                #---------------------------------------------------#
+                #   clone后再缓存，避免切片持有整个batch的显存
+                #---------------------------------------------------#
+                cached[key] = [feat[j : j + 1].clone() for feat in feats_miss]
+                self.feature_cache.put(key, cached[key])
+        feats_A = [torch.cat([cached[key][level] for key in keys], 0) for level in range(len(cached[keys[0]]))]
+        feats_B = net.encode_B(images_B)
+        return net.decode(feats_A, feats_B)
+
+    #---------------------------------------------------#
+    #   批量检测图片，结果与逐张调用detect_image一致
+    #---------------------------------------------------#
+    def detect_batch(self, images, batch_size=8, count=False, name_classes=None, images_B=None):
+        images  = [cvtColor(image) for image in images]
+        prs     = self.predict_batch(images, batch_size=batch_size, images_B=images_B)
+        return [self.draw_result(copy.deepcopy(image), pr, count=count, name_classes=name_classes) for image, pr in zip(images, prs)]
+
+    #---------------------------------------------------#
+    #   批量获得用于计算miou的预测结果
+    #---------------------------------------------------#
+    def get_miou_png_batch(self, images, batch_size=8, images_B=None):
+        prs = self.predict_batch(images, batch_size=batch_size, images_B=images_B)
+        return [Image.fromarray(np.uint8(pr)) for pr in prs]
+
+    #---------------------------------------------------#
+    #   多模态检测图片
+    #   image_A为模态A的图片，image_B为模态B的图片，
+    #   两者经过相同的letterbox后送入融合网络，结果绘制在模态A上
+    #---------------------------------------------------#
+    def detect_image_pair(self, image_A, image_B, count=False, name_classes=None):
+        return self.detect_batch([image_A], batch_size=1, count=count, name_classes=name_classes, images_B=[image_B])[0]
+
+    #---------------------------------------------------#
+    #   多模态批量检测，pairs为(模态A, 模态B)图片对的列表
+    #---------------------------------------------------#
+    def detect_pair_batch(self, pairs, batch_size=8, count=False, name_classes=None):
+        images_A = [pair[0] for pair in pairs]
+        images_B = [pair[1] for pair in pairs]
+        return self.detect_batch(images_A, batch_size=batch_size, count=count, name_classes=name_classes, images_B=images_B)
+
+    #---------------------------------------------------#
+    #   多模态获得用于计算miou的预测结果
+    #---------------------------------------------------#
+    def get_miou_png_pair(self, image_A, image_B):
+        return self.get_miou_png_batch([image_A], batch_size=1, images_B=[image_B])[0]
+
+    def get_miou_png_pair_batch(self, pairs, batch_size=8):
+        images_A = [pair[0] for pair in pairs]
+        images_B = [pair[1] for pair in pairs]
+        return self.get_miou_png_batch(images_A, batch_size=batch_size, images_B=images_B)
+
+    #---------------------------------------------------#
+    #   滑窗（tile）推理，用于大尺寸眼底图、病理切片等
+    #   不对原图进行缩放，而是以input_shape为窗口大小、tile_overlap为重叠宽度
+    #   逐行滑动，每batch_size个窗口进行一次前向传播。
+    #   重叠部分的logits按窗口权重累加，只保留一行窗口高度的累加缓存，
+    #   某些行不会再被后续窗口覆盖时立即取argmax写入结果，
+    #   因此不会生成整幅图大小的float概率图，内存占用与图片高度无关
+    #---------------------------------------------------#
+    def predict_tiled(self, image, image_B=None, tile_overlap=128, batch_size=4, window="gaussian"):
+        if image_B is None:
+            raise ValueError("融合网络需要模态A与模态B同时输入，请传入image_B。")
+        tile_h, tile_w = self.input_shape
+        if not 0 <= tile_overlap < min(tile_h, tile_w):
+            raise ValueError("tile_overlap必须大于等于0且小于窗口大小。")
+        image       = cvtColor(image)
+        image_B     = cvtColor(image_B)
+        if image_B.size != image.size:
+            image_B = image_B.resize(image.size, Image.BICUBIC)
+        image_datas = [np.array(image, np.uint8), np.array(image_B, np.uint8)]
+        orininal_h, orininal_w = image_datas[0].shape[:2]
+        #---------------------------------------------------#
+        #   小于窗口大小的边用灰条补齐
+        #---------------------------------------------------#
+        pad_h = max(tile_h - orininal_h, 0)
+        pad_w = max(tile_w - orininal_w, 0)
+        if pad_h > 0 or pad_w > 0:
+            image_datas = [np.pad(image_data, ((0, pad_h), (0, pad_w), (0, 0)), constant_values=128) for image_data in image_datas]
+        h, w    = image_datas[0].shape[:2]
+        ys      = get_tile_starts(h, tile_h, tile_h - tile_overlap)
+        xs      = get_tile_starts(w, tile_w, tile_w - tile_overlap)
+
+        with torch.no_grad():
+            weight  = torch.from_numpy(get_tile_window(tile_h, tile_w, window))
+            acc     = torch.zeros((self.num_classes, tile_h, w))
+            if self.cuda:
+                weight  = weight.cuda()
+                acc     = acc.cuda()
+            labels  = np.zeros((h, w), np.uint8)
+
+            for row, y in enumerate(ys):
+                for start in range(0, len(xs), batch_size):
+                    batch_xs    = xs[start : start + batch_size]
+                    inputs      = []
+                    for image_data in image_datas:
+                        tiles = np.stack([image_data[y : y + tile_h, x : x + tile_w] for x in batch_xs], 0)
+                        inputs.append(self.to_input(np.transpose(tiles, (0, 3, 1, 2))))
+                    #---------------------------------------------------#
+                    #   窗口传入网络进行预测，logits按权重累加
+                    #---------------------------------------------------#
+                    outputs = self.net(*inputs)
+                    for i, x in enumerate(batch_xs):
+                        acc[:, :, x : x + tile_w] += outputs[i].float() * weight
+                #---------------------------------------------------#
+                #   当前行中不会被下一行窗口覆盖的部分已经累计完成
+                #   权重对所有种类相同，直接对累加结果取argmax即可
+                #---------------------------------------------------#
+                done = ys[row + 1] - y if row + 1 < len(ys) else tile_h
+                labels[y : y + done] = acc[:, :done].argmax(dim=0).cpu().numpy()
+                if row + 1 < len(ys):
+                    acc[:, :tile_h - done] = acc[:, done:].clone()
+                    acc[:, tile_h - done:] = 0
+
+        return labels[:orininal_h, :orininal_w]
+
+    def detect_image_tiled(self, image, image_B=None, tile_overlap=128, batch_size=4, window="gaussian", count=False, name_classes=None):
+        image   = cvtColor(image)
+        pr      = self.predict_tiled(image, image_B=image_B, tile_overlap=tile_overlap, batch_size=batch_size, window=window)
+        return self.draw_result(copy.deepcopy(image), pr, count=count, name_classes=name_classes)
+
+    def get_miou_png_tiled(self, image, image_B=None, tile_overlap=128, batch_size=4, window="gaussian"):
+        pr = self.predict_tiled(image, image_B=image_B, tile_overlap=tile_overlap, batch_size=batch_size, window=window)
+        return Image.fromarray(pr)
+
 class Unet_ONNX(object):
     _defaults = {
         #--------------------------------------------------------------------------#
@@ -412,6 +636,11 @@ class Unet_ONNX(object):
         #   mix_type = 2的时候代表仅扣去背景，仅保留原图中的目标
         #-------------------------------------------------#
         "mix_type"      : 0,
+        #-------------------------------------------------#
+        #   postprocess     网络输出的后处理方式，可选"fast"、"label"、"legacy"
+        #                   "legacy"与原先的softmax+多通道resize结果逐位一致
+        #-------------------------------------------------#
+        "postprocess"   : "fast",
     }
     
     @classmethod
@@ -518,28 +747,10 @@ class Unet_ONNX(object):
         input_feed  = self.get_input_feed(image_data)
         pr          = self.onnx_session.run(output_names=self.output_name, input_feed=input_feed)[0][0]
 
-        def softmax(x, axis):
-            x -= np.max(x, axis=axis, keepdims=True)
-            f_x = np.exp(x) / np.sum(np.exp(x), axis=axis, keepdims=True)
-            return f_x
-        print(np.shape(pr))
-        #---------------------------------------------------#
-        #   取出每一个像素点的种类
-        #---------------------------------------------------#
-        pr = softmax(np.transpose(pr, (1, 2, 0)), -1)
-        #--------------------------------------#
-        #   将灰条部分截取掉
-        #--------------------------------------#
-        pr = pr[int((self.input_shape[0] - nh) // 2) : int((self.input_shape[0] - nh) // 2 + nh), \
-                int((self.input_shape[1] - nw) // 2) : int((self.input_shape[1] - nw) // 2 + nw)]
-        #---------------------------------------------------#
-        #   进行图片的resize
-        #---------------------------------------------------#
-        pr = cv2.resize(pr, (orininal_w, orininal_h), interpolation = cv2.INTER_LINEAR)
         #---------------------------------------------------#
-        #   取出每一个像素点的种类
+        #   将灰条部分截取掉，resize回原图大小并取出每一个像素点的种类
         #---------------------------------------------------#
-        pr = pr.argmax(axis=-1)
+        pr = postprocess_output(pr, (orininal_h, orininal_w, nh, nw), self.input_shape, self.postprocess)
         
         #---------------------------------------------------------#
         #   计数
@@ -2,21 +2,19 @@ import os
 
 import matplotlib
 import torch
-import torch.nn.functional as F
 
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 import scipy.signal
 
-import cv2
-import shutil
 import numpy as np
 
 from PIL import Image
 from tqdm import tqdm
 from torch.utils.tensorboard import SummaryWriter
-from .utils import cvtColor, preprocess_input, resize_image
-from .utils_metrics import compute_mIoU
+from .utils import (cvtColor, postprocess_output, preprocess_input,
+                    preprocess_input_tensor, resize_image)
+from .utils_metrics import fast_hist, per_class_iu
 
 # ------------------------新加的记录f_score值,不好用---------------------------#
 # class FScoreHistory:
@@ -116,9 +114,82 @@ class LossHistory():
         plt.cla()
         plt.close("all")
 
+#---------------------------------------------------------#
+#   读取单通道的种类图
+#   调色板与灰度的标签直接使用，RGB等多通道的标签（例如另存为RGB的灰度图）
+#   取第一个通道，与训练时只使用一个通道的标签保持一致
+#---------------------------------------------------------#
+def load_label(path):
+    label = np.array(Image.open(path))
+    if label.ndim == 3:
+        label = label[..., 0]
+    return label
+
+#---------------------------------------------------------#
+#   验证集缓存
+#   所有letterbox后的图片保存在一个(N,3,h,w)的uint8数组中，
+#   大小不一的标签拼接成一个一维uint8数组，按offsets与shapes切分，
+#   letterbox的几何信息保存为(N,4)的数组。
+#   可以放在内存中，也可以放在mmap文件中
+#---------------------------------------------------------#
+class ValidationCache(object):
+    def __init__(self, images, metas, labels, offsets, shapes):
+        self.images     = images
+        self.metas      = metas
+        self.labels     = labels
+        self.offsets    = offsets
+        self.shapes     = shapes
+
+    #---------------------------------------------------------#
+    #   load_sample     读取一张图片，返回(图片, 几何信息, 标签)
+    #   label_sizes     每个标签的像素数
+    #   估计大小不超过max_mb时缓存在内存中，否则在cache_dir下使用mmap，
+    #   cache_dir为None时返回None，由调用者从磁盘读取
+    #---------------------------------------------------------#
+    @classmethod
+    def build(cls, load_sample, image_ids, input_shape, label_sizes, max_mb, cache_dir=None):
+        h, w    = input_shape
+        offsets = np.concatenate([[0], np.cumsum(label_sizes)]).astype(np.int64)
+        nbytes  = len(image_ids) * 3 * h * w + int(offsets[-1])
+        if nbytes <= max_mb * 1024 * 1024:
+            images  = np.empty((len(image_ids), 3, h, w), np.uint8)
+            labels  = np.empty((int(offsets[-1]),), np.uint8)
+            print("Cache {} validation images ({:.1f} MB) in memory.".format(len(image_ids), nbytes / 1024 / 1024))
+        elif cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            images  = np.memmap(os.path.join(cache_dir, "images.bin"), np.uint8, mode='w+', shape=(len(image_ids), 3, h, w))
+            labels  = np.memmap(os.path.join(cache_dir, "labels.bin"), np.uint8, mode='w+', shape=(max(int(offsets[-1]), 1),))
+            print("Cache {} validation images ({:.1f} MB) in {}.".format(len(image_ids), nbytes / 1024 / 1024, cache_dir))
+        else:
+            print("Validation set ({:.1f} MB) exceeds the cache limit, read from disk.".format(nbytes / 1024 / 1024))
+            return None
+
+        metas   = np.zeros((len(image_ids), 4), np.int64)
+        shapes  = np.zeros((len(image_ids), 2), np.int64)
+        for i, image_id in enumerate(image_ids):
+            image_data, meta, label = load_sample(image_id)
+            #---------------------------------------------------------#
+            #   不小于255的种类都会在计算hist时被忽略，截断后再以uint8保存
+            #---------------------------------------------------------#
+            label       = np.minimum(label, 255).astype(np.uint8)
+            images[i]   = image_data
+            metas[i]    = meta
+            shapes[i]   = label.shape
+            labels[offsets[i] : offsets[i + 1]] = label.reshape(-1)
+        if isinstance(images, np.memmap):
+            images.flush()
+            labels.flush()
+        return cls(images, metas, labels, offsets, shapes)
+
+    def get_batch(self, start, end):
+        end     = min(end, len(self.images))
+        metas   = [tuple(int(x) for x in meta) for meta in self.metas[start : end]]
+        labels  = [np.asarray(self.labels[self.offsets[i] : self.offsets[i + 1]]).reshape(self.shapes[i]) for i in range(start, end)]
+        return self.images[start : end], metas, labels
+
 class EvalCallback():
     def __init__(self, net, input_shape, num_classes, image_ids, dataset_path, log_dir, cuda, \
-            miou_out_path=".temp_miou_out", eval_flag=True, period=1):
+            miou_out_path=".temp_miou_out", eval_flag=True, period=1, postprocess="fast", batch_size=8, save_png=False, cache_max_mb=2048, cache_dir=None):
         super(EvalCallback, self).__init__()
         
         self.net                = net
@@ -131,6 +202,29 @@ class EvalCallback():
         self.miou_out_path      = miou_out_path
         self.eval_flag          = eval_flag
         self.period             = period
+        #---------------------------------------------------------#
+        #   postprocess     网络输出的后处理方式，可选"fast"、"label"、"legacy"
+        #                   "legacy"与原先的softmax+多通道resize结果逐位一致
+        #---------------------------------------------------------#
+        self.postprocess        = postprocess
+        #---------------------------------------------------------#
+        #   batch_size      验证时每次前向传播的图片数量
+        #   save_png        为True时把预测结果保存到miou_out_path中并保留，
+        #                   为False时预测结果直接累加到内存中的混淆矩阵，不读写磁盘
+        #---------------------------------------------------------#
+        self.batch_size         = batch_size
+        self.save_png           = save_png
+        #---------------------------------------------------------#
+        #   验证集的图片在各个epoch之间不变，第一次验证时把letterbox后的
+        #   uint8图片、letterbox的几何信息与标签缓存起来，之后的验证只做前向传播
+        #   cache_max_mb    缓存不超过该大小时放在内存中，为None时不缓存
+        #   cache_dir       超过cache_max_mb时在该文件夹下用mmap缓存，
+        #                   为None时不缓存，每次验证都从磁盘读取
+        #---------------------------------------------------------#
+        self.cache_max_mb       = cache_max_mb
+        self.cache_dir          = cache_dir
+        self.cache              = None
+        self.cache_built        = False
         
         self.image_ids          = [image_id.split()[0] for image_id in image_ids]
         self.mious      = [0]
@@ -168,50 +262,89 @@ class EvalCallback():
             #---------------------------------------------------#
             pr = self.net(images)[0]
             #---------------------------------------------------#
-            #   取出每一个像素点的种类
-            #---------------------------------------------------#
-            pr = F.softmax(pr.permute(1,2,0),dim = -1).cpu().numpy()
-            #--------------------------------------#
-            #   将灰条部分截取掉
-            #--------------------------------------#
-            pr = pr[int((self.input_shape[0] - nh) // 2) : int((self.input_shape[0] - nh) // 2 + nh), \
-                    int((self.input_shape[1] - nw) // 2) : int((self.input_shape[1] - nw) // 2 + nw)]
-            #---------------------------------------------------#
-            #   进行图片的resize
-            #---------------------------------------------------#
-            pr = cv2.resize(pr, (orininal_w, orininal_h), interpolation = cv2.INTER_LINEAR)
-            #---------------------------------------------------#
-            #   取出每一个像素点的种类
+            #   将灰条部分截取掉，resize回原图大小并取出每一个像素点的种类
             #---------------------------------------------------#
-            pr = pr.argmax(axis=-1)
+            pr = postprocess_output(pr, (orininal_h, orininal_w, nh, nw), self.input_shape, self.postprocess)
     
         image = Image.fromarray(np.uint8(pr))
         return image
     
+    #---------------------------------------------------------#
+    #   读取一张验证图片，返回letterbox后的uint8图片(3,h,w)、
+    #   (原图高, 原图宽, nh, nw)与标签
+    #---------------------------------------------------------#
+    def load_sample(self, image_id):
+        image       = cvtColor(Image.open(os.path.join(self.dataset_path, "VOC2007/JPEGImages/"+image_id+".jpg")))
+        orininal_w, orininal_h = image.size
+        image_data, nw, nh  = resize_image(image, (self.input_shape[1],self.input_shape[0]))
+        image_data  = np.transpose(np.array(image_data, np.uint8), (2, 0, 1))
+        label       = load_label(os.path.join(self.dataset_path, "VOC2007/SegmentationClass/"+image_id+".png"))
+        return image_data, (orininal_h, orininal_w, nh, nw), label
+
+    #---------------------------------------------------------#
+    #   取出第start到end张验证图片
+    #   有缓存时直接切片，没有缓存时从磁盘读取
+    #---------------------------------------------------------#
+    def get_batch(self, start, end):
+        if not self.cache_built:
+            self.cache_built = True
+            if self.cache_max_mb is not None:
+                self.cache = ValidationCache.build(self.load_sample, self.image_ids, self.input_shape, self.label_sizes(), \
+                    self.cache_max_mb, self.cache_dir)
+        if self.cache is not None:
+            return self.cache.get_batch(start, end)
+        samples = [self.load_sample(image_id) for image_id in self.image_ids[start : end]]
+        return np.stack([sample[0] for sample in samples], 0), [sample[1] for sample in samples], [sample[2] for sample in samples]
+
+    #---------------------------------------------------------#
+    #   只读取png文件头得到每个标签的像素数，用于估计缓存大小
+    #---------------------------------------------------------#
+    def label_sizes(self):
+        sizes = []
+        for image_id in self.image_ids:
+            with Image.open(os.path.join(self.dataset_path, "VOC2007/SegmentationClass/"+image_id+".png")) as label:
+                sizes.append(label.size[0] * label.size[1])
+        return sizes
+
+    #---------------------------------------------------------#
+    #   分batch前向传播，预测结果直接累加到混淆矩阵中
+    #---------------------------------------------------------#
+    def get_hist(self, pred_dir=None):
+        hist = np.zeros((self.num_classes, self.num_classes), np.int64)
+        for start in tqdm(range(0, len(self.image_ids), self.batch_size)):
+            batch_ids   = self.image_ids[start : start + self.batch_size]
+            image_data, metas, labels = self.get_batch(start, start + self.batch_size)
+            with torch.no_grad():
+                images = torch.from_numpy(np.ascontiguousarray(image_data))
+                if self.cuda:
+                    images = images.cuda()
+                #---------------------------------------------------#
+                #   图片传入网络进行预测
+                #---------------------------------------------------#
+                outputs = self.net(preprocess_input_tensor(images))
+                for image_id, meta, label, pr in zip(batch_ids, metas, labels, outputs):
+                    #---------------------------------------------------#
+                    #   将灰条部分截取掉，resize回原图大小并取出每一个像素点的种类
+                    #---------------------------------------------------#
+                    pr = postprocess_output(pr, meta, self.input_shape, self.postprocess)
+                    if pred_dir is not None:
+                        Image.fromarray(np.uint8(pr)).save(os.path.join(pred_dir, image_id + ".png"))
+                    # 如果图像分割结果与标签的大小不一样，这张图片就不计算
+                    if label.size != pr.size:
+                        print('Skipping: size of gt != size of pred, {:s}'.format(image_id))
+                        continue
+                    hist += fast_hist(label.reshape(-1), pr.reshape(-1), self.num_classes)
+        return hist
+
     def on_epoch_end(self, epoch, model_eval):
         if epoch % self.period == 0 and self.eval_flag:
             self.net    = model_eval
-            gt_dir      = os.path.join(self.dataset_path, "VOC2007/SegmentationClass/")
-            pred_dir    = os.path.join(self.miou_out_path, 'detection-results')
-            if not os.path.exists(self.miou_out_path):
-                os.makedirs(self.miou_out_path)
-            if not os.path.exists(pred_dir):
-                os.makedirs(pred_dir)
+            pred_dir    = None
+            if self.save_png:
+                pred_dir = os.path.join(self.miou_out_path, 'detection-results')
+                os.makedirs(pred_dir, exist_ok=True)
             print("Get miou.")
-            for image_id in tqdm(self.image_ids):
-                #-------------------------------#
-                #   从文件中读取图像
-                #-------------------------------#
-                image_path  = os.path.join(self.dataset_path, "VOC2007/JPEGImages/"+image_id+".jpg")
-                image       = Image.open(image_path)
-                #------------------------------#
-                #   获得预测txt
-                #------------------------------#
-                image       = self.get_miou_png(image)
-                image.save(os.path.join(pred_dir, image_id + ".png"))
-                        
-            print("Calculate miou.")
-            _, IoUs, _, _ = compute_mIoU(gt_dir, pred_dir, self.image_ids, self.num_classes, None)  # 执行计算mIoU的函数
+            IoUs        = per_class_iu(self.get_hist(pred_dir))
             temp_miou = np.nanmean(IoUs) * 100
 
             self.mious.append(temp_miou)
@@ -235,4 +368,3 @@ class EvalCallback():
             plt.close("all")
 
             print("Get miou done.")
-            shutil.rmtree(self.miou_out_path)
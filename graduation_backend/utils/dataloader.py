@@ -10,7 +10,11 @@ from utils.utils import cvtColor, preprocess_input
 
 
 class UnetDataset(Dataset):
-    def __init__(self, annotation_lines, input_shape, num_classes, train, dataset_path):
+    #---------------------------------------------------#
+    #   compact_labels为True时只返回uint8的种类图，one_hot在设备上计算
+    #   uint8_images为True时图像以uint8的CHW数组返回，在设备上再除以255
+    #---------------------------------------------------#
+    def __init__(self, annotation_lines, input_shape, num_classes, train, dataset_path, compact_labels=False, uint8_images=False):
         super(UnetDataset, self).__init__()
         self.annotation_lines   = annotation_lines
         self.length             = len(annotation_lines)
@@ -18,6 +22,8 @@ class UnetDataset(Dataset):
         self.num_classes        = num_classes
         self.train              = train
         self.dataset_path       = dataset_path
+        self.compact_labels     = compact_labels
+        self.uint8_images       = uint8_images
 
     def __len__(self):
         return self.length
@@ -36,9 +42,14 @@ class UnetDataset(Dataset):
         #-------------------------------#
         jpg, png    = self.get_random_data(jpg, png, self.input_shape, random = self.train)
 
-        jpg         = np.transpose(preprocess_input(np.array(jpg, np.float64)), [2,0,1])
+        if self.uint8_images:
+            jpg     = np.ascontiguousarray(np.transpose(np.array(jpg, np.uint8), [2,0,1]))
+        else:
+            jpg     = np.transpose(preprocess_input(np.array(jpg, np.float64)), [2,0,1])
         png         = np.array(png)
         png[png >= self.num_classes] = self.num_classes
+        if self.compact_labels:
+            return jpg, png, None
         #-------------------------------------------------------#
         #   转化成one_hot的形式
         #   在这里需要+1是因为voc数据集有些标签具有白边部分
@@ -143,7 +154,12 @@ def unet_dataset_collate(batch):
         images.append(img)
         pngs.append(png)
         seg_labels.append(labels)
-    images      = torch.from_numpy(np.array(images)).type(torch.FloatTensor)
+    images      = torch.from_numpy(np.array(images))
+    if images.dtype != torch.uint8:
+        images  = images.type(torch.FloatTensor)
+    if seg_labels[0] is None:
+        pngs    = torch.from_numpy(np.array(pngs, np.uint8))
+        return images, pngs, None
     pngs        = torch.from_numpy(np.array(pngs)).long()
     seg_labels  = torch.from_numpy(np.array(seg_labels)).type(torch.FloatTensor)
     return images, pngs, seg_labels
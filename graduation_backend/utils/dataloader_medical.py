@@ -1,3 +1,4 @@
+import json
 import os
 
 import cv2
@@ -7,13 +8,21 @@ from PIL import Image
 from torch.utils.data.dataset import Dataset
 
 from utils.utils import cvtColor, preprocess_input
+from utils.utils_augment import PairedAugmenter
 
 # import pandas as pd
 
 
 # -------------------------------这是多模态Unet数据输入（第二版-DR数据集）---------------------------------  #
 class UnetDataset(Dataset):
-    def __init__(self, annotation_lines, input_shape, num_classes, train, dataset_path):
+    #---------------------------------------------------#
+    #   compact_labels为True时不再构建one_hot标签，只返回uint8的种类图，
+    #   one_hot在损失函数与指标中于GPU上计算，减少进程间与主机到设备的传输量
+    #   uint8_images为True时图像以uint8的CHW数组返回，在设备上再除以255
+    #   fast_augment为True时使用PairedAugmenter进行数据增强，
+    #   seed不为None时每个样本的增强参数由(seed, epoch, index)决定
+    #---------------------------------------------------#
+    def __init__(self, annotation_lines, input_shape, num_classes, train, dataset_path, compact_labels=False, uint8_images=False, fast_augment=False, seed=None):
         super(UnetDataset, self).__init__()
         self.annotation_lines = annotation_lines
         self.length = len(annotation_lines)
@@ -21,6 +30,10 @@ class UnetDataset(Dataset):
         self.num_classes = num_classes
         self.train       = train
         self.dataset_path = dataset_path
+        self.compact_labels = compact_labels
+        self.uint8_images = uint8_images
+        self.fast_augment = fast_augment
+        self.augmenter = PairedAugmenter(input_shape, seed=seed) if fast_augment else None
 
         # 假设模态A和模态B的图像分别存储在以下两个文件夹中
         self.images_path_A = os.path.join(self.dataset_path, "Images")
@@ -38,10 +51,17 @@ class UnetDataset(Dataset):
     def __len__(self):
         return self.length
 
-    def __getitem__(self, index):
-        annotation_line = self.annotation_lines[index]
-        name = annotation_line.split()[0]
-
+    #---------------------------------------------------#
+    #   每个epoch开始时调用，使可复现的数据增强在不同epoch间变化
+    #---------------------------------------------------#
+    def set_epoch(self, epoch):
+        if self.augmenter is not None:
+            self.augmenter.set_epoch(epoch)
+
+    #---------------------------------------------------#
+    #   读取一个样本的模态A、模态B与标签图像
+    #---------------------------------------------------#
+    def load_sample(self, name):
         # 分别加载模态A和模态B的图像
         jpg_A = Image.open(os.path.join(self.images_path_A, name + ".jpg"))
         jpg_B = Image.open(os.path.join(self.images_path_B, name + ".jpg"))
@@ -53,16 +73,39 @@ class UnetDataset(Dataset):
         # jpg_B = Image.open(os.path.join(self.images_path_B, name + ".png"))
         # # 加载标签图像
         # jpg = Image.open(os.path.join(self.labels_path, name + ".png"))
+        return jpg_A, jpg_B, jpg
+
+    #---------------------------------------------------#
+    #   以uint8数组的形式读取一个样本，供PairedAugmenter使用
+    #---------------------------------------------------#
+    def load_sample_arrays(self, name):
+        jpg_A, jpg_B, jpg = self.load_sample(name)
+        return np.asarray(cvtColor(jpg_A)), np.asarray(cvtColor(jpg_B)), np.asarray(jpg)
+
+    def __getitem__(self, index):
+        annotation_line = self.annotation_lines[index]
+        name = annotation_line.split()[0]
 
         # 对两种模态的图像以及标签图像进行数据增强
-        jpg_A, jpg_B, jpg = self.get_random_data(jpg_A, jpg_B, jpg, self.input_shape, random=self.train)
+        if self.fast_augment:
+            jpg_A, jpg_B, jpg = self.load_sample_arrays(name)
+            (jpg_A, jpg_B), jpg = self.augmenter([jpg_A, jpg_B], jpg, index, random=self.train)
+        else:
+            jpg_A, jpg_B, jpg = self.load_sample(name)
+            jpg_A, jpg_B, jpg = self.get_random_data(jpg_A, jpg_B, jpg, self.input_shape, random=self.train)
 
-        jpg_A = np.transpose(preprocess_input(np.array(jpg_A, np.float64)), [2, 0, 1])
-        jpg_B = np.transpose(preprocess_input(np.array(jpg_B, np.float64)), [2, 0, 1])
+        if self.uint8_images:
+            jpg_A = np.ascontiguousarray(np.transpose(np.array(jpg_A, np.uint8), [2, 0, 1]))
+            jpg_B = np.ascontiguousarray(np.transpose(np.array(jpg_B, np.uint8), [2, 0, 1]))
+        else:
+            jpg_A = np.transpose(preprocess_input(np.array(jpg_A, np.float64)), [2, 0, 1])
+            jpg_B = np.transpose(preprocess_input(np.array(jpg_B, np.float64)), [2, 0, 1])
         jpg = np.array(jpg)
 
         modify_jpg = np.zeros_like(jpg)
         modify_jpg[jpg <= 127.5] = 1
+        if self.compact_labels:
+            return jpg_A, jpg_B, modify_jpg, None
         seg_labels = modify_jpg
         seg_labels = np.eye(self.num_classes + 1)[seg_labels.reshape([-1])]
         seg_labels = seg_labels.reshape((int(self.input_shape[0]), int(self.input_shape[1]), self.num_classes + 1))
@@ -188,6 +231,66 @@ class UnetDataset(Dataset):
         return image_A, image_B, label
     
 
+#---------------------------------------------------#
+#   预先解码好的数据集
+#   pack_dataset把每个样本解码后的uint8数组依次写入一个.bin文件，
+#   并在同名的.json中记录每个数组的偏移量与形状。
+#   训练时以memmap方式打开，直接切片得到解码后的图像，每个epoch不再重复解码jpg
+#---------------------------------------------------#
+PACK_FIELDS = ("image_A", "image_B", "label")
+
+def pack_dataset(dataset, names, pack_path):
+    index   = {"fields": list(PACK_FIELDS), "samples": {}}
+    offset  = 0
+    with open(pack_path + ".bin", "wb") as f:
+        for name in names:
+            jpg_A, jpg_B, jpg = dataset.load_sample(name)
+            #---------------------------------------------------#
+            #   与get_random_data中一样先转为RGB，标签保持解码后的原样
+            #---------------------------------------------------#
+            arrays  = [np.array(cvtColor(jpg_A), np.uint8), np.array(cvtColor(jpg_B), np.uint8), np.array(jpg, np.uint8)]
+            entry   = []
+            for array in arrays:
+                array = np.ascontiguousarray(array)
+                f.write(array.tobytes())
+                entry.append([offset, list(array.shape)])
+                offset += array.nbytes
+            index["samples"][name] = entry
+    with open(pack_path + ".json", "w") as f:
+        json.dump(index, f)
+    return offset
+
+class PackedUnetDataset(UnetDataset):
+    def __init__(self, annotation_lines, input_shape, num_classes, train, dataset_path, pack_path, compact_labels=False, uint8_images=False, fast_augment=False, seed=None):
+        super(PackedUnetDataset, self).__init__(annotation_lines, input_shape, num_classes, train, dataset_path, compact_labels, uint8_images, fast_augment, seed)
+        self.pack_path  = pack_path
+        with open(pack_path + ".json", "r") as f:
+            self.index  = json.load(f)["samples"]
+        missing = [line.split()[0] for line in annotation_lines if line.split()[0] not in self.index]
+        if len(missing) > 0:
+            raise KeyError("{}中缺少{}个样本，例如{}，请重新运行pack_dataset.py".format(pack_path + ".bin", len(missing), missing[0]))
+        #---------------------------------------------------#
+        #   memmap在每个DataLoader进程中第一次读取时再打开
+        #---------------------------------------------------#
+        self.data       = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
+
+    def load_sample_arrays(self, name):
+        if self.data is None:
+            self.data = np.memmap(self.pack_path + ".bin", dtype=np.uint8, mode="r")
+        arrays = []
+        for offset, shape in self.index[name]:
+            arrays.append(self.data[offset: offset + int(np.prod(shape))].reshape(shape))
+        return tuple(arrays)
+
+    def load_sample(self, name):
+        return tuple(Image.fromarray(np.asarray(array)) for array in self.load_sample_arrays(name))
+
+
 # DataLoader中collate_fn使用
 def unet_dataset_collate(batch):
     images_A = []
@@ -199,8 +302,21 @@ def unet_dataset_collate(batch):
         images_B.append(img_B)
         jpgs.append(jpg)
         seg_labels.append(labels)
-    images_A = torch.from_numpy(np.array(images_A)).type(torch.FloatTensor)
-    images_B = torch.from_numpy(np.array(images_B)).type(torch.FloatTensor)
+    #---------------------------------------------------#
+    #   uint8_images时保持uint8，由训练循环在设备上归一化
+    #---------------------------------------------------#
+    images_A = torch.from_numpy(np.array(images_A))
+    images_B = torch.from_numpy(np.array(images_B))
+    if images_A.dtype != torch.uint8:
+        images_A = images_A.type(torch.FloatTensor)
+        images_B = images_B.type(torch.FloatTensor)
+    #---------------------------------------------------#
+    #   compact_labels时只传输uint8的种类图，seg_labels为None，
+    #   在设备上再转换为long并计算one_hot
+    #---------------------------------------------------#
+    if seg_labels[0] is None:
+        jpgs = torch.from_numpy(np.array(jpgs, np.uint8))
+        return images_A, images_B, jpgs, None
     jpgs = torch.from_numpy(np.array(jpgs)).long()
     seg_labels = torch.from_numpy(np.array(seg_labels)).type(torch.FloatTensor)
     return images_A, images_B, jpgs, seg_labels
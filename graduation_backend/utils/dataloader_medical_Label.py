@@ -13,7 +13,11 @@ from utils.utils import cvtColor, preprocess_input
 
 # -------------------------------这是多模态Unet数据输入（第三版-双标签数据集）---------------------------------  #
 class UnetDataset(Dataset):
-    def __init__(self, annotation_lines, input_shape, num_classes, train, dataset_path):
+    #---------------------------------------------------#
+    #   compact_labels为True时两个标签都只返回uint8的种类图，one_hot在设备上计算
+    #   uint8_images为True时图像以uint8的CHW数组返回，在设备上再除以255
+    #---------------------------------------------------#
+    def __init__(self, annotation_lines, input_shape, num_classes, train, dataset_path, compact_labels=False, uint8_images=False):
         super(UnetDataset, self).__init__()
         self.annotation_lines = annotation_lines
         self.length = len(annotation_lines)
@@ -21,6 +25,8 @@ class UnetDataset(Dataset):
         self.num_classes = num_classes
         self.train = train
         self.dataset_path = dataset_path
+        self.compact_labels = compact_labels
+        self.uint8_images = uint8_images
 
         # 假设模态A和模态B的图像分别存储在以下两个文件夹中
         self.images_path_A = os.path.join(self.dataset_path, "Images")
@@ -47,8 +53,12 @@ class UnetDataset(Dataset):
         # 对两种模态的图像以及标签图像进行数据增强
         jpg_A, jpg_B, label_A, label_B = self.get_random_data(jpg_A, jpg_B, label_A, label_B, self.input_shape, random=self.train)
 
-        jpg_A = np.transpose(preprocess_input(np.array(jpg_A, np.float64)), [2, 0, 1])
-        jpg_B = np.transpose(preprocess_input(np.array(jpg_B, np.float64)), [2, 0, 1])
+        if self.uint8_images:
+            jpg_A = np.ascontiguousarray(np.transpose(np.array(jpg_A, np.uint8), [2, 0, 1]))
+            jpg_B = np.ascontiguousarray(np.transpose(np.array(jpg_B, np.uint8), [2, 0, 1]))
+        else:
+            jpg_A = np.transpose(preprocess_input(np.array(jpg_A, np.float64)), [2, 0, 1])
+            jpg_B = np.transpose(preprocess_input(np.array(jpg_B, np.float64)), [2, 0, 1])
         label_A = np.array(label_A)
         label_B = np.array(label_B)
 
@@ -57,6 +67,8 @@ class UnetDataset(Dataset):
         modify_label_A[label_A <= 127.5] = 1
         modify_label_B = np.zeros_like(label_B)
         modify_label_B[label_B <= 127.5] = 1
+        if self.compact_labels:
+            return jpg_A, jpg_B, modify_label_A, modify_label_B
 
         seg_labels_A = np.eye(self.num_classes + 1)[modify_label_A.reshape([-1])]
         seg_labels_A = seg_labels_A.reshape((int(self.input_shape[0]), int(self.input_shape[1]), self.num_classes + 1))
@@ -207,9 +219,19 @@ def unet_dataset_collate(batch):
         seg_labels_A.append(label_A)
         seg_labels_B.append(label_B)
 
-    images_A = torch.from_numpy(np.array(images_A)).type(torch.FloatTensor)
-    images_B = torch.from_numpy(np.array(images_B)).type(torch.FloatTensor)
+    images_A = torch.from_numpy(np.array(images_A))
+    images_B = torch.from_numpy(np.array(images_B))
+    if images_A.dtype != torch.uint8:
+        images_A = images_A.type(torch.FloatTensor)
+        images_B = images_B.type(torch.FloatTensor)
     # jpgs = torch.from_numpy(np.array(jpgs)).long()
+    #---------------------------------------------------#
+    #   compact_labels时标签为(h,w)的种类图，以uint8传输
+    #---------------------------------------------------#
+    if np.ndim(seg_labels_A[0]) == 2:
+        seg_labels_A = torch.from_numpy(np.array(seg_labels_A, np.uint8))
+        seg_labels_B = torch.from_numpy(np.array(seg_labels_B, np.uint8))
+        return images_A, images_B, seg_labels_A, seg_labels_B
     seg_labels_A = torch.from_numpy(np.array(seg_labels_A)).type(torch.FloatTensor)
     seg_labels_B = torch.from_numpy(np.array(seg_labels_B)).type(torch.FloatTensor)
     return images_A, images_B, seg_labels_A, seg_labels_B
@@ -1,7 +1,10 @@
+import os
 import random
 
+import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
 from PIL import Image
 
 
@@ -32,7 +35,126 @@ def resize_image(image, size):
     new_image.paste(image, ((w-nw)//2, (h-nh)//2))
 
     return new_image, nw, nh
+
+#---------------------------------------------------#
+#   对两种模态的输入图像进行resize
+#   缩放比例只按模态A计算一次，模态B使用相同的几何变换
+#---------------------------------------------------#
+def resize_image_pair(image_A, image_B, size):
+    iw, ih  = image_A.size
+    w, h    = size
+
+    scale   = min(w/iw, h/ih)
+    nw      = int(iw*scale)
+    nh      = int(ih*scale)
+
+    new_images = []
+    for image in [image_A, image_B]:
+        image       = image.resize((nw,nh), Image.BICUBIC)
+        new_image   = Image.new('RGB', size, (128,128,128))
+        new_image.paste(image, ((w-nw)//2, (h-nh)//2))
+        new_images.append(new_image)
+
+    return new_images[0], new_images[1], nw, nh
+
+#---------------------------------------------------#
+#   按名字读取数据集中对应的模态A与模态B图像
+#   模态A位于Images文件夹，模态B位于ImagesB文件夹
+#---------------------------------------------------#
+def load_image_pair(dataset_path, name, suffixes=('.jpg', '.png', '.jpeg', '.tif', '.bmp')):
+    images = []
+    for folder in ["Images", "ImagesB"]:
+        for suffix in suffixes:
+            image_path = os.path.join(dataset_path, folder, name + suffix)
+            if os.path.isfile(image_path):
+                images.append(Image.open(image_path))
+                break
+        else:
+            raise FileNotFoundError("未能在%s中找到%s对应的图像。" % (os.path.join(dataset_path, folder), name))
+    return images[0], images[1]
     
+#---------------------------------------------------#
+#   将一张图片的网络输出(C, H, W)还原为原图大小的种类图
+#   pr可以是torch的Tensor，也可以是onnx输出的numpy数组
+#   meta为(原图高, 原图宽, 有效区域高, 有效区域宽)
+#   mode = "legacy" 与原先的流程逐位一致：
+#                   softmax -> 拷贝到CPU -> 裁剪灰条 -> 对C个通道resize -> argmax
+#   mode = "fast"   不计算softmax，在设备上裁剪logits并双线性上采样后直接argmax，
+#                   只把uint8的种类图拷贝回CPU。softmax单调，结果仅在边界处可能有细微差异
+#   mode = "label"  先在输入分辨率上argmax，再对单通道种类图做最近邻resize，
+#                   速度最快，适合只需要种类图、可以接受最近邻边界的场景
+#---------------------------------------------------#
+def postprocess_output(pr, meta, input_shape, mode="fast"):
+    orininal_h, orininal_w, nh, nw = meta
+    top     = int((input_shape[0] - nh) // 2)
+    left    = int((input_shape[1] - nw) // 2)
+    is_numpy = isinstance(pr, np.ndarray)
+
+    if mode == "legacy":
+        if is_numpy:
+            pr = np.transpose(pr, (1, 2, 0))
+            pr = np.exp(pr - np.max(pr, axis=-1, keepdims=True))
+            pr = pr / np.sum(pr, axis=-1, keepdims=True)
+        else:
+            pr = F.softmax(pr.permute(1,2,0),dim = -1).cpu().numpy()
+        pr = pr[top : top + nh, left : left + nw]
+        pr = cv2.resize(pr, (orininal_w, orininal_h), interpolation = cv2.INTER_LINEAR)
+        return pr.argmax(axis=-1)
+
+    elif mode == "fast":
+        if is_numpy:
+            pr = np.ascontiguousarray(np.transpose(pr[:, top : top + nh, left : left + nw], (1, 2, 0)))
+            pr = cv2.resize(pr, (orininal_w, orininal_h), interpolation = cv2.INTER_LINEAR)
+            if pr.ndim == 2:
+                pr = pr[..., None]
+            return pr.argmax(axis=-1).astype(np.uint8)
+        pr = pr[:, top : top + nh, left : left + nw].unsqueeze(0).float()
+        pr = F.interpolate(pr, size=(orininal_h, orininal_w), mode="bilinear", align_corners=False)
+        return pr[0].argmax(dim=0).to(torch.uint8).cpu().numpy()
+
+    elif mode == "label":
+        if is_numpy:
+            pr = pr[:, top : top + nh, left : left + nw].argmax(axis=0).astype(np.uint8)
+        else:
+            pr = pr[:, top : top + nh, left : left + nw].argmax(dim=0).to(torch.uint8).cpu().numpy()
+        return cv2.resize(pr, (orininal_w, orininal_h), interpolation = cv2.INTER_NEAREST)
+
+    else:
+        raise ValueError("Unsupported postprocess mode '%s', use 'legacy', 'fast' or 'label'." % mode)
+
+#---------------------------------------------------#
+#   滑窗推理时每一行（列）tile的起始坐标
+#   最后一个tile与图像边缘对齐，保证整幅图都被覆盖
+#---------------------------------------------------#
+def get_tile_starts(length, tile, stride):
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile + 1, stride))
+    if starts[-1] + tile < length:
+        starts.append(length - tile)
+    return starts
+
+#---------------------------------------------------#
+#   滑窗推理时用于融合重叠区域的权重窗口
+#   gaussian    中心权重高、边缘权重低的高斯窗口
+#   linear      由中心向边缘线性衰减的窗口
+#   权重保持为正数，保证每个像素都有有效的累计结果
+#---------------------------------------------------#
+def get_tile_window(tile_h, tile_w, mode="gaussian"):
+    def window_1d(n):
+        coords = np.arange(n, dtype=np.float32) - (n - 1) / 2
+        if mode == "gaussian":
+            sigma = n / 8
+            return np.exp(-coords ** 2 / (2 * sigma ** 2))
+        elif mode == "linear":
+            return 1 - np.abs(coords) / (n / 2)
+        else:
+            raise ValueError("Unsupported tile window '%s', use 'gaussian' or 'linear'." % mode)
+
+    window = np.outer(window_1d(tile_h), window_1d(tile_w))
+    window = window / np.max(window)
+    return np.maximum(window, 1e-4).astype(np.float32)
+
 #---------------------------------------------------#
 #   获得学习率
 #---------------------------------------------------#
@@ -65,6 +187,37 @@ def preprocess_input(image):
     image /= 255.0
     return image
 
+#---------------------------------------------------#
+#   在设备上对NCHW的图像batch进行归一化
+#   uint8输入除以255，浮点输入视为已经在数据集中归一化过
+#   mean与std为长度3的序列，设置后再进行标准化
+#---------------------------------------------------#
+def preprocess_input_tensor(images, mean=None, std=None):
+    if images.dtype == torch.uint8:
+        images = images.float().div_(255.0)
+    if mean is not None:
+        images = images - torch.as_tensor(mean, dtype=images.dtype, device=images.device).view(1, -1, 1, 1)
+    if std is not None:
+        images = images / torch.as_tensor(std, dtype=images.dtype, device=images.device).view(1, -1, 1, 1)
+    return images
+
+#---------------------------------------------------#
+#   获得当前可用的内存（MB）
+#   使用GPU时返回显存的剩余量，否则读取系统的MemAvailable
+#---------------------------------------------------#
+def available_memory_mb(cuda=False):
+    if cuda and torch.cuda.is_available():
+        free, _ = torch.cuda.mem_get_info()
+        return free / 1024 / 1024
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
 def show_config(**kwargs):
     print('Configurations:')
     print('-' * 70)
@@ -74,6 +227,19 @@ def show_config(**kwargs):
         print('|%25s | %40s|' % (str(key), str(value)))
     print('-' * 70)
 
+#---------------------------------------------------#
+#   命令行中的布尔参数
+#   argparse的type=bool会把任何非空字符串（包括'False'）当作True
+#---------------------------------------------------#
+def str2bool(value):
+    if isinstance(value, bool):
+        return value
+    if value.lower() in ('true', 't', 'yes', 'y', '1'):
+        return True
+    if value.lower() in ('false', 'f', 'no', 'n', '0', ''):
+        return False
+    raise ValueError("Boolean value expected, got '%s'." % value)
+
 def download_weights(backbone, model_dir="./model_data"):
     import os
     from torch.hub import load_state_dict_from_url
@@ -0,0 +1,207 @@
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+#---------------------------------------------------#
+#   多模态数据增强
+#   每个样本只计算一次仿射矩阵（缩放、长宽扭曲、翻转、平移），
+#   模态A、模态B与标签各用一次warpAffine直接写入预先分配的缓冲区，
+#   色域变换通过查表在HSV上原地完成。
+#   给定seed时，每个样本的随机参数只由(seed, epoch, index)决定，结果可以复现
+#---------------------------------------------------#
+class PairedAugmenter(object):
+    def __init__(self, input_shape, jitter=.3, scale=(0.25, 2), hue=.1, sat=0.7, val=0.3, flip=True, seed=None):
+        self.input_shape    = input_shape
+        self.jitter         = jitter
+        self.scale          = scale
+        self.hsv            = np.array([hue, sat, val])
+        self.flip           = flip
+        self.seed           = seed
+        self.epoch          = 0
+        self.buffers        = {}
+        self.lut_x          = np.arange(0, 256, dtype=np.float64)
+        self.lut            = np.empty((1, 256, 3), np.uint8)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_rng(self, index):
+        if self.seed is None:
+            return np.random
+        return np.random.RandomState([self.seed, self.epoch, index])
+
+    #---------------------------------------------------#
+    #   按名字复用输出缓冲区，返回的数组在下一次调用时会被覆盖
+    #---------------------------------------------------#
+    def get_buffer(self, name, shape):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, np.uint8)
+            self.buffers[name] = buffer
+        return buffer
+
+    #---------------------------------------------------#
+    #   随机参数，与get_random_data中的分布一致
+    #   返回目标区域大小nw、nh，左上角dx、dy，是否翻转与色域变换系数
+    #---------------------------------------------------#
+    def sample_params(self, rng, iw, ih, random=True):
+        h, w = self.input_shape
+        if not random:
+            scale   = min(w/iw, h/ih)
+            nw      = int(iw*scale)
+            nh      = int(ih*scale)
+            return nw, nh, (w-nw)//2, (h-nh)//2, False, None
+
+        rand    = lambda a=0, b=1: rng.rand() * (b - a) + a
+        new_ar  = iw/ih * rand(1-self.jitter, 1+self.jitter) / rand(1-self.jitter, 1+self.jitter)
+        scale   = rand(*self.scale)
+        if new_ar < 1:
+            nh = int(scale*h)
+            nw = int(nh*new_ar)
+        else:
+            nw = int(scale*w)
+            nh = int(nw/new_ar)
+        flip    = self.flip and rand() < .5
+        dx      = int(rand(0, w-nw))
+        dy      = int(rand(0, h-nh))
+        r       = rng.uniform(-1, 1, 3) * self.hsv + 1
+        return nw, nh, dx, dy, flip, r
+
+    #---------------------------------------------------#
+    #   把iw x ih的图像缩放到nw x nh、按需翻转后放到(dx, dy)处的仿射矩阵
+    #   以像素中心对齐，与resize后paste的几何关系一致
+    #---------------------------------------------------#
+    @staticmethod
+    def get_matrix(iw, ih, nw, nh, dx, dy, flip):
+        sx = nw / iw
+        sy = nh / ih
+        if flip:
+            return np.array([[-sx, 0, dx + nw - 0.5 * sx - 0.5], [0, sy, dy + 0.5 * sy - 0.5]])
+        return np.array([[sx, 0, dx + 0.5 * sx - 0.5], [0, sy, dy + 0.5 * sy - 0.5]])
+
+    #---------------------------------------------------#
+    #   在RGB图像上原地进行色域变换
+    #---------------------------------------------------#
+    def apply_hsv(self, image, r, name):
+        hsv = self.get_buffer(name + "_hsv", image.shape)
+        cv2.cvtColor(image, cv2.COLOR_RGB2HSV, dst=hsv)
+        self.lut[0, :, 0] = (self.lut_x * r[0]) % 180
+        self.lut[0, :, 1] = np.clip(self.lut_x * r[1], 0, 255)
+        self.lut[0, :, 2] = np.clip(self.lut_x * r[2], 0, 255)
+        cv2.LUT(hsv, self.lut, dst=hsv)
+        cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB, dst=image)
+
+    #---------------------------------------------------#
+    #   images      uint8的RGB图像列表（HxWx3），可以是不同大小，都会被缩放到相同的区域
+    #   label       uint8的标签图
+    #   返回增强后的图像列表与标签，大小均为input_shape
+    #---------------------------------------------------#
+    def __call__(self, images, label, index=0, random=True):
+        h, w    = self.input_shape
+        rng     = self.get_rng(index)
+        ih, iw  = images[0].shape[:2]
+        nw, nh, dx, dy, flip, r = self.sample_params(rng, iw, ih, random)
+
+        outputs = []
+        for i, image in enumerate(images):
+            out = self.get_buffer("image_%d" % i, (h, w) + image.shape[2:])
+            M   = self.get_matrix(image.shape[1], image.shape[0], nw, nh, dx, dy, flip)
+            cv2.warpAffine(image, M, (w, h), dst=out, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=(128, 128, 128))
+            if r is not None:
+                self.apply_hsv(out, r, "image_%d" % i)
+            outputs.append(out)
+
+        label_out   = self.get_buffer("label", (h, w) + label.shape[2:])
+        M           = self.get_matrix(label.shape[1], label.shape[0], nw, nh, dx, dy, flip)
+        cv2.warpAffine(label, M, (w, h), dst=label_out, flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        return outputs, label_out
+
+
+#---------------------------------------------------#
+#   在训练设备上对整个batch进行数据增强
+#   DataLoader只需要解码并letterbox，缩放、长宽扭曲、翻转与平移由
+#   affine_grid + grid_sample批量完成，模态A与模态B共用同一个几何变换，
+#   标签使用最近邻采样，亮度、对比度与饱和度的扰动逐样本进行。
+#   图像需要是已经除以255的浮点数，超出原图的部分图像填充为灰色，
+#   标签填充为ignore_index，不参与损失与指标的计算
+#---------------------------------------------------#
+class GPUAugmenter(object):
+    def __init__(self, jitter=.3, scale=(0.25, 2), brightness=0.3, contrast=0.3, saturation=0.7, flip=True, ignore_index=None, seed=None):
+        self.jitter         = jitter
+        self.scale          = scale
+        self.brightness     = brightness
+        self.contrast       = contrast
+        self.saturation     = saturation
+        self.flip           = flip
+        self.ignore_index   = ignore_index
+        self.seed           = seed
+        self.generator      = None
+
+    def rand(self, n, device, a=0, b=1):
+        if self.generator is None and self.seed is not None:
+            self.generator = torch.Generator(device=device)
+            self.generator.manual_seed(self.seed)
+        return torch.rand(n, generator=self.generator, device=device) * (b - a) + a
+
+    #---------------------------------------------------#
+    #   每个样本的仿射矩阵，把输出坐标映射回输入坐标
+    #   sw、sh为原图在输出中所占的相对大小，cx、cy为其中心
+    #---------------------------------------------------#
+    def get_theta(self, n, device):
+        ar      = self.rand(n, device, 1 - self.jitter, 1 + self.jitter) / self.rand(n, device, 1 - self.jitter, 1 + self.jitter)
+        scale   = self.rand(n, device, *self.scale)
+        sw      = torch.where(ar >= 1, scale, scale * ar)
+        sh      = torch.where(ar >= 1, scale / ar, scale)
+        cx      = self.rand(n, device, -1, 1) * (1 - sw).abs()
+        cy      = self.rand(n, device, -1, 1) * (1 - sh).abs()
+        sign    = torch.where(self.rand(n, device) < .5, -1.0, 1.0) if self.flip else torch.ones(n, device=device)
+
+        theta           = torch.zeros((n, 2, 3), device=device)
+        theta[:, 0, 0]  = sign / sw
+        theta[:, 0, 2]  = -sign * cx / sw
+        theta[:, 1, 1]  = 1 / sh
+        theta[:, 1, 2]  = -cy / sh
+        return theta
+
+    def color_jitter(self, images, factors):
+        brightness, contrast, saturation = factors
+        images  = images * brightness
+        gray    = (0.299 * images[:, 0:1] + 0.587 * images[:, 1:2] + 0.114 * images[:, 2:3])
+        mean    = gray.mean(dim=(2, 3), keepdim=True)
+        images  = (images - mean) * contrast + mean
+        gray    = gray * contrast + mean * (1 - contrast)
+        images  = (images - gray) * saturation + gray
+        return images.clamp_(0, 1)
+
+    #---------------------------------------------------#
+    #   imgs_A、imgs_B      (n,3,h,w)，取值0~1
+    #   pngs                (n,h,w)的种类图
+    #---------------------------------------------------#
+    def __call__(self, imgs_A, imgs_B, pngs):
+        n, _, h, w  = imgs_A.size()
+        device      = imgs_A.device
+        with torch.no_grad():
+            theta   = self.get_theta(n, device)
+            grid    = F.affine_grid(theta, (n, 1, h, w), align_corners=False).to(imgs_A.dtype)
+            #---------------------------------------------------#
+            #   两种模态拼在一起只采样一次，减0.5使零填充对应灰色
+            #---------------------------------------------------#
+            images  = torch.cat([imgs_A, imgs_B], 1) - 0.5
+            images  = F.grid_sample(images, grid, mode='bilinear', padding_mode='zeros', align_corners=False) + 0.5
+
+            fill    = 0 if self.ignore_index is None else self.ignore_index
+            labels  = (pngs.to(imgs_A.dtype) - fill).unsqueeze(1)
+            labels  = F.grid_sample(labels, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+            labels  = (labels.squeeze(1) + fill).round().to(pngs.dtype)
+
+            view    = (n, 1, 1, 1)
+            factors = [
+                self.rand(n, device, 1 - self.brightness, 1 + self.brightness).view(view).to(imgs_A.dtype),
+                self.rand(n, device, 1 - self.contrast, 1 + self.contrast).view(view).to(imgs_A.dtype),
+                self.rand(n, device, 1 - self.saturation, 1 + self.saturation).view(view).to(imgs_A.dtype),
+            ]
+            imgs_A  = self.color_jitter(images[:, :3], factors)
+            imgs_B  = self.color_jitter(images[:, 3:], factors)
+        return imgs_A.contiguous(), imgs_B.contiguous(), labels
@@ -0,0 +1,112 @@
+import torch
+
+from nets.unet_training import CE_Loss, Dice_loss
+from utils.utils_compile import to_channels_last
+from utils.utils_fit import autocast_context
+from utils.utils import available_memory_mb
+
+
+def is_oom_error(e):
+    return isinstance(e, torch.cuda.OutOfMemoryError) or (isinstance(e, RuntimeError) and "out of memory" in str(e))
+
+#---------------------------------------------------#
+#   用随机数据进行一次与训练相同的前向传播与反向传播
+#---------------------------------------------------#
+def probe_step(model_train, batch_size, input_shape, num_classes, precision, device, channels_last=False):
+    h, w    = input_shape
+    imgs_A  = to_channels_last(torch.rand((batch_size, 3, h, w), device=device), channels_last)
+    imgs_B  = to_channels_last(torch.rand((batch_size, 3, h, w), device=device), channels_last)
+    pngs    = torch.randint(0, num_classes, (batch_size, h, w), device=device)
+    weights = torch.ones(num_classes, device=device)
+    with autocast_context(precision, device.type == 'cuda'):
+        outputs = model_train(imgs_A, imgs_B)
+        loss    = CE_Loss(outputs, pngs, weights, num_classes=num_classes) + Dice_loss(outputs, pngs)
+    loss.backward()
+
+#---------------------------------------------------#
+#   反向传播时内存的峰值相对于保存的激活值的倍数
+#   反向传播到某一层时，该层保存的激活值还没有释放，
+#   同时又要为它分配形状相同的梯度，所以最坏情况下两者同时存在，
+#   峰值不超过保存的激活值的2倍；实际上梯度随反向传播逐层释放，这是一个保守的上界
+#---------------------------------------------------#
+BACKWARD_PEAK_FACTOR = 2
+
+#---------------------------------------------------#
+#   训练时与batch_size无关、需要额外占用的内存相对于参数的倍数
+#   梯度与参数同样大小，adam的exp_avg、exp_avg_sq各与参数同样大小，共3倍（sgd的动量只有1份，按adam保守估计）
+#   参数本身在探测前已经加载到内存中，可用内存里已经扣除，不再重复计入
+#   冻结的主干在解冻后也需要梯度与优化器状态，所以按全部参数计算
+#---------------------------------------------------#
+OPTIMIZER_STATE_FACTOR = 3
+
+def model_state_mb(model_train):
+    nbytes = sum(p.numel() * p.element_size() for p in model_train.parameters())
+    return nbytes * OPTIMIZER_STATE_FACTOR / 1024 / 1024
+
+#---------------------------------------------------#
+#   CPU上无法安全地试出内存不足，
+#   用batch_size为1时反向传播需要保存的激活值估计每个样本需要的内存（MB）
+#---------------------------------------------------#
+def saved_activation_mb(model_train, input_shape, num_classes, precision, device, channels_last=False):
+    nbytes  = [0]
+    seen    = set()
+    def pack(tensor):
+        #---------------------------------------------------#
+        #   不计入参数本身，同一块存储只计一次
+        #---------------------------------------------------#
+        storage = tensor.untyped_storage()
+        if not (tensor.is_leaf and tensor.requires_grad) and storage.data_ptr() not in seen:
+            seen.add(storage.data_ptr())
+            nbytes[0] += storage.nbytes()
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        probe_step(model_train, 1, input_shape, num_classes, precision, device, channels_last)
+    return nbytes[0] / 1024 / 1024
+
+#---------------------------------------------------#
+#   在训练开始前找出能放进内存的最大batch_size
+#   GPU上在[1, max_batch_size]中二分查找，真正执行前向与反向传播，
+#   内存不足时缩小范围；CPU上先从可用内存中扣除梯度与优化器状态，
+#   再按每个样本激活值的估计计算。
+#   safety      结果乘以该系数，为数据加载以及GPU上探测时没有分配的优化器状态留出余量
+#   探测结束后恢复模型的参数与BatchNorm统计量，并清空梯度
+#   参数的快照保存在CPU上，探测时显存中不会有两份权值
+#---------------------------------------------------#
+def find_batch_size(model_train, input_shape, num_classes, precision="fp32", cuda=False, channels_last=False, max_batch_size=64, safety=0.9, local_rank=0):
+    device  = torch.device('cuda', local_rank) if cuda else torch.device('cpu')
+    state   = {k: v.detach().cpu().clone() for k, v in model_train.state_dict().items()}
+    try:
+        if cuda:
+            def fits(batch_size):
+                try:
+                    probe_step(model_train, batch_size, input_shape, num_classes, precision, device, channels_last)
+                    return True
+                except RuntimeError as e:
+                    if not is_oom_error(e):
+                        raise
+                    return False
+                finally:
+                    model_train.zero_grad(set_to_none=True)
+                    torch.cuda.empty_cache()
+
+            if not fits(1):
+                raise RuntimeError("batch_size为1时显存也不足，请减小input_shape或开启--checkpoint。")
+            low, high = 1, max_batch_size
+            while low < high:
+                mid = (low + high + 1) // 2
+                if fits(mid):
+                    low = mid
+                else:
+                    high = mid - 1
+            batch_size = low
+        else:
+            per_sample  = saved_activation_mb(model_train, input_shape, num_classes, precision, device, channels_last) * BACKWARD_PEAK_FACTOR
+            model_train.zero_grad(set_to_none=True)
+            available   = available_memory_mb(False)
+            if available is not None:
+                available   = available - model_state_mb(model_train)
+            batch_size  = max_batch_size if available is None else int(max(available, 0) // max(per_sample, 1e-6))
+            batch_size  = max(1, min(batch_size, max_batch_size))
+    finally:
+        model_train.load_state_dict(state)
+    return max(1, int(batch_size * safety)) if batch_size > 1 else 1
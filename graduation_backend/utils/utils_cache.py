@@ -0,0 +1,77 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+#---------------------------------------------------#
+#   编码器特征金字塔的LRU缓存
+#   以输入图像内容的哈希值为键，保存单张图片的特征金字塔
+#   max_mb      缓存允许占用的最大内存（MB），超过后按最近最少使用淘汰
+#---------------------------------------------------#
+class FeatureCache(object):
+    def __init__(self, max_mb=1024):
+        self.max_bytes  = int(max_mb * 1024 * 1024)
+        self.cur_bytes  = 0
+        self.hits       = 0
+        self.misses     = 0
+        self.entries    = OrderedDict()
+        self.lock       = threading.Lock()
+
+    #---------------------------------------------------#
+    #   对预处理后的输入图像计算内容哈希
+    #---------------------------------------------------#
+    @staticmethod
+    def hash_image(image_data):
+        image_data = np.ascontiguousarray(image_data)
+        digest = hashlib.blake2b(image_data.tobytes(), digest_size=16)
+        digest.update(str(image_data.shape).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def feats_nbytes(feats):
+        return sum(feat.numel() * feat.element_size() for feat in feats)
+
+    def get(self, key):
+        with self.lock:
+            feats = self.entries.get(key)
+            if feats is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return feats
+
+    def put(self, key, feats):
+        feats   = [feat.detach() for feat in feats]
+        nbytes  = self.feats_nbytes(feats)
+        #---------------------------------------------------#
+        #   单个条目就超过内存上限时不进行缓存
+        #---------------------------------------------------#
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.cur_bytes -= self.feats_nbytes(self.entries.pop(key))
+            while self.entries and self.cur_bytes + nbytes > self.max_bytes:
+                _, old_feats    = self.entries.popitem(last=False)
+                self.cur_bytes  -= self.feats_nbytes(old_feats)
+            self.entries[key]   = feats
+            self.cur_bytes      += nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.cur_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries'   : len(self.entries),
+                'memory_mb' : self.cur_bytes / 1024 / 1024,
+                'hits'      : self.hits,
+                'misses'    : self.misses,
+                'hit_rate'  : self.hits / total if total > 0 else 0.0,
+            }
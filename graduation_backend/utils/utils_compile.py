@@ -0,0 +1,54 @@
+import os
+
+import torch
+
+
+#---------------------------------------------------#
+#   torch.compile生成的内核与FX图缓存到cache_dir中，
+#   之后的运行命中缓存时可以跳过大部分编译时间
+#---------------------------------------------------#
+def set_compile_cache(cache_dir):
+    if not cache_dir:
+        return
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] = "1"
+
+#---------------------------------------------------#
+#   把NCHW的输入转换为channels_last内存格式，
+#   与channels_last的模型配合时卷积不需要再转换格式
+#---------------------------------------------------#
+def to_channels_last(images, channels_last=True):
+    if channels_last and images.dim() == 4:
+        return images.contiguous(memory_format=torch.channels_last)
+    return images
+
+#---------------------------------------------------#
+#   可选的执行方式
+#   channels_last   把卷积权重转换为channels_last，x86与较新的GPU上卷积更快
+#   compile         原地调用nn.Module.compile，state_dict的key不变，
+#                   仍然可以用DataParallel、DDP包装，也可以直接保存权值
+#   compile_mode    传给torch.compile的mode，如"reduce-overhead"、"max-autotune"
+#   cache_dir       编译结果的缓存文件夹
+#   compile_stages  不编译整个模型，而是分别编译encoder_A、encoder_B与decode，
+#                   使用特征缓存时直接调用各阶段，只编译forward时这些调用不会经过编译
+#---------------------------------------------------#
+def optimize_model(model, channels_last=False, compile=False, compile_mode=None, cache_dir=None, compile_stages=False):
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if compile:
+        if not hasattr(model, "compile"):
+            raise RuntimeError("torch.compile requires pytorch 2.2 or later.")
+        set_compile_cache(cache_dir)
+        if compile_stages:
+            model.encoder_A.compile(mode=compile_mode)
+            model.encoder_B.compile(mode=compile_mode)
+            #---------------------------------------------------#
+            #   decode不是单独的模块，编译后的函数保存为实例属性，
+            #   forward与特征缓存调用self.decode时都会使用它
+            #---------------------------------------------------#
+            model.decode = torch.compile(model.decode, mode=compile_mode)
+        else:
+            model.compile(mode=compile_mode)
+    return model
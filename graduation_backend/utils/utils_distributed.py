@@ -0,0 +1,74 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+#---------------------------------------------------#
+#   分布式训练使用的通信后端
+#   auto时GPU上使用nccl，CPU上使用gloo
+#---------------------------------------------------#
+BACKENDS = ['auto', 'gloo', 'nccl']
+
+def get_backend(backend, cuda):
+    if backend == 'auto':
+        return 'nccl' if cuda else 'gloo'
+    if backend == 'nccl' and not cuda:
+        raise ValueError("nccl backend requires CUDA, use --backend gloo for CPU training.")
+    return backend
+
+#---------------------------------------------------#
+#   初始化进程组，rank等由torchrun设置的环境变量给出
+#   GPU上每个进程使用local_rank对应的显卡，
+#   CPU上同一台机器的进程平分CPU核心，避免线程数超过核心数
+#   返回device, local_rank, rank, world_size
+#---------------------------------------------------#
+def init_distributed(backend='auto', cuda=False):
+    if "RANK" not in os.environ or "WORLD_SIZE" not in os.environ:
+        raise RuntimeError("Distributed training must be launched with torchrun, "
+                           "e.g. python -m torch.distributed.run --standalone --nproc_per_node 2 train_medical2.py --distributed")
+    backend     = get_backend(backend, cuda)
+    local_rank  = int(os.environ.get("LOCAL_RANK", 0))
+    if cuda:
+        torch.cuda.set_device(local_rank)
+        device  = torch.device("cuda", local_rank)
+    else:
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+        device  = torch.device("cpu")
+    dist.init_process_group(backend=backend)
+    return device, local_rank, dist.get_rank(), dist.get_world_size()
+
+def cleanup_distributed():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+#---------------------------------------------------#
+#   判断模型中是否有不参与前向传播的参数
+#   用一个很小的输入进行一次前向与反向传播，需要梯度却没有得到梯度的参数即为未使用的参数。
+#   没有未使用的参数时DDP可以关闭find_unused_parameters，
+#   省去每一步遍历计算图的开销
+#   判断时使用eval模式，不更新BatchNorm的统计量，结束后清空梯度
+#---------------------------------------------------#
+def has_unused_parameters(model, device, input_shape=(32, 32)):
+    training = model.training
+    model.eval()
+    try:
+        inputs  = [torch.zeros((1, 3) + tuple(input_shape), device=device) for _ in range(2)]
+        outputs = model(*inputs)
+        outputs.float().sum().backward()
+        unused  = [name for name, p in model.named_parameters() if p.requires_grad and p.grad is None]
+    finally:
+        model.zero_grad(set_to_none=True)
+        model.train(training)
+    return len(unused) > 0
+
+#---------------------------------------------------#
+#   用DDP包装模型，find_unused_parameters由has_unused_parameters决定
+#   DDP只同步包装时requires_grad为True的参数，
+#   冻结或解冻主干后需要重新包装
+#---------------------------------------------------#
+def wrap_ddp(model, device, input_shape=(32, 32)):
+    find_unused = has_unused_parameters(model, device, input_shape)
+    device_ids  = [device.index] if device.type == 'cuda' else None
+    return torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=find_unused), find_unused
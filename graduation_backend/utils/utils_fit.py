@@ -1,11 +1,16 @@
+import contextlib
+import csv
 import os
 
 import torch
-from nets.unet_training import CE_Loss, Dice_loss, Focal_Loss
+import torch.distributed as dist
+from nets.unet_training import CE_Loss, Dice_loss, Focal_Loss, labels_to_one_hot
 from tqdm import tqdm
 
-from utils.utils import get_lr, cvtColor, preprocess_input, resize_image, show_config
-from utils.utils_metrics import f_score, mcc_score, dice_score
+from utils.utils import get_lr, cvtColor, preprocess_input, preprocess_input_tensor, resize_image, show_config
+from utils.utils_metrics import ConfusionMatrix, RunningMetrics
+from utils.utils_compile import to_channels_last
+from utils.utils_prefetch import DevicePrefetcher
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -17,10 +22,72 @@ from PIL import Image
 from torchvision import transforms
 
 
+#-------------------------------#
+#   训练精度与autocast使用的数据类型
+#   fp16只能在GPU上使用，需要GradScaler防止梯度下溢
+#   bf16在GPU与CPU上都可以使用，数值范围与fp32相同，不需要GradScaler
+#-------------------------------#
+PRECISIONS = {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+def get_precision(precision):
+    #-------------------------------#
+    #   兼容原来的fp16=True/False
+    #-------------------------------#
+    if precision is True:
+        return "fp16"
+    if precision is False or precision is None:
+        return "fp32"
+    if precision not in PRECISIONS:
+        raise ValueError("Unsupported precision '%s', use 'fp32', 'fp16' or 'bf16'." % precision)
+    return precision
+
+def autocast_context(precision, cuda):
+    dtype = PRECISIONS[get_precision(precision)]
+    if dtype is None:
+        return contextlib.nullcontext()
+    if dtype == torch.float16 and not cuda:
+        raise ValueError("fp16 autocast requires CUDA, use bf16 for CPU training.")
+    return torch.autocast(device_type='cuda' if cuda else 'cpu', dtype=dtype)
+
+#-------------------------------#
+#   只有GPU上的fp16需要GradScaler，bf16与fp32返回None直接反向传播
+#-------------------------------#
+def get_grad_scaler(precision, cuda):
+    fp16 = get_precision(precision) == "fp16"
+    if fp16 and not cuda:
+        raise ValueError("fp16 training requires CUDA, use bf16 for CPU training.")
+    return torch.amp.GradScaler('cuda', enabled=fp16) if fp16 else None
+
+#-------------------------------#
+#   把一个epoch的指标追加到result.csv
+#   已有文件的表头与当前的列不同时（例如旧版本的result.csv），
+#   按列名合并后重写整个文件，避免数据与表头错位
+#-------------------------------#
+def append_epoch_csv(csv_file, epoch_data):
+    epoch_df = pd.DataFrame([epoch_data])
+    if not os.path.isfile(csv_file) or os.path.getsize(csv_file) == 0:
+        epoch_df.to_csv(csv_file, mode='w', header=True, index=False)
+        return
+    with open(csv_file, 'r', newline='') as f:
+        header = next(csv.reader(f), [])
+    if header == list(epoch_df.columns):
+        epoch_df.to_csv(csv_file, mode='a', header=False, index=False)
+    else:
+        history = pd.read_csv(csv_file)
+        pd.concat([history, epoch_df], ignore_index=True).to_csv(csv_file, mode='w', header=True, index=False)
+
 # ----------------------------------已改为多模态输入------------------------------ #
-def fit_one_epoch_no_val(model_train, model, loss_history, optimizer, epoch, epoch_step, gen, Epoch, cuda, dice_loss, focal_loss, cls_weights, num_classes, fp16, scaler, save_period, save_dir, local_rank=0):
-    total_loss      = 0
-    total_f_score   = 0  
+#   precision   "fp32"、"fp16"或"bf16"，前向传播与损失计算都在autocast中进行，
+#               scaler不为None时使用GradScaler进行反向传播，只有GPU上的fp16需要
+#   channels_last   输入转换为channels_last内存格式，模型需要已经转换
+#   accumulation_steps  梯度累积的步数，每accumulation_steps个batch更新一次参数，
+#                       等效的batch_size为batch_size * accumulation_steps
+def fit_one_epoch_no_val(model_train, model, loss_history, optimizer, epoch, epoch_step, gen, Epoch, cuda, dice_loss, focal_loss, cls_weights, num_classes, precision, scaler, save_period, save_dir, local_rank=0, input_mean=None, input_std=None, gpu_augment=None, log_interval=10, channels_last=False, accumulation_steps=1):
+    #-------------------------------#
+    #   损失与混淆矩阵在设备上累加，只在每log_interval步与epoch结束时同步
+    #-------------------------------#
+    running         = RunningMetrics(['Loss'])
+    confusion       = ConfusionMatrix(num_classes)
 
     file_name = "result.csv"
     # 使用os.path.join组合完整的文件路径
@@ -31,109 +98,127 @@ def fit_one_epoch_no_val(model_train, model, loss_history, optimizer, epoch, epo
         print('Start Train')
         pbar = tqdm(total=epoch_step,desc=f'Epoch {epoch + 1}/{Epoch}',postfix=dict,mininterval=0.3)
     model_train.train()
-    for iteration, batch in enumerate(gen):
-        if iteration >= epoch_step: 
-            break
+    #-------------------------------#
+    #   种类权重在整个epoch中不变，只拷贝一次
+    #-------------------------------#
+    weights = torch.from_numpy(cls_weights)
+    if cuda:
+        weights = weights.cuda(local_rank)
+    #-------------------------------#
+    #   下一个batch的拷贝与当前batch的计算重叠
+    #   只取epoch_step个batch，最后一步之后不再预取
+    #-------------------------------#
+    prefetcher = DevicePrefetcher(gen, torch.device('cuda', local_rank) if cuda else None, max_steps=epoch_step)
+    for iteration, batch in enumerate(prefetcher):
         imgs_A, imgs_B, pngs, labels = batch
         with torch.no_grad():
-            weights = torch.from_numpy(cls_weights)
-            if cuda:
-                imgs_A   = imgs_A.cuda(local_rank)
-                imgs_B   = imgs_B.cuda(local_rank)
-                pngs     = pngs.cuda(local_rank)
-                labels   = labels.cuda(local_rank)
-                weights  = weights.cuda(local_rank)
-                # image    = cvtColor(imgs_A)
-
-        optimizer.zero_grad()
-        if not fp16:
-            #----------------------#
-            #   前向传播
-            #----------------------#
-            outputs = model_train(imgs_A, imgs_B)
-            #----------------------#
-            #   损失计算
-            #----------------------#
-            if focal_loss:
-                loss = Focal_Loss(outputs, pngs, weights, num_classes = num_classes)
-            else:
-                loss = CE_Loss(outputs, pngs, weights, num_classes = num_classes)
-
-            if dice_loss:
-                main_dice = Dice_loss(outputs, labels)
-                loss      = loss + main_dice
-
-            with torch.no_grad():
-                #-------------------------------#
-                #   计算f_score、MCC、dice_score
-                #-------------------------------#
-                _f_score = f_score(outputs, labels)
-                _mcc = mcc_score(outputs, labels)
-                _dice = dice_score(outputs, labels)
-
-            loss.backward()
-            optimizer.step()
-        else:
-            from torch.cuda.amp import autocast
-            with autocast():
+            #-------------------------------#
+            #   uint8_images时在设备上除以255，
+            #   浮点输入已在数据集中归一化
+            #-------------------------------#
+            imgs_A = preprocess_input_tensor(imgs_A)
+            imgs_B = preprocess_input_tensor(imgs_B)
+            pngs = pngs.long()
+            #-------------------------------#
+            #   在设备上对整个batch进行数据增强，
+            #   增强后的one_hot标签由种类图重新计算
+            #-------------------------------#
+            if gpu_augment is not None:
+                imgs_A, imgs_B, pngs = gpu_augment(imgs_A, imgs_B, pngs)
+                if labels is not None:
+                    labels = labels_to_one_hot(pngs, num_classes)
+            #-------------------------------#
+            #   compact_labels时只传输了uint8的种类图，
+            #   损失函数与指标直接使用种类图，在设备上计算one_hot
+            #-------------------------------#
+            if labels is None:
+                labels = pngs
+            #-------------------------------#
+            #   可选的标准化
+            #-------------------------------#
+            imgs_A = preprocess_input_tensor(imgs_A, input_mean, input_std)
+            imgs_B = preprocess_input_tensor(imgs_B, input_mean, input_std)
+            #-------------------------------#
+            #   与channels_last的模型保持相同的内存格式
+            #-------------------------------#
+            imgs_A = to_channels_last(imgs_A, channels_last)
+            imgs_B = to_channels_last(imgs_B, channels_last)
+
+        #-------------------------------#
+        #   梯度累积，每组的第一个batch清空梯度，最后一个batch更新参数
+        #   DDP中不更新参数的batch跳过梯度同步
+        #-------------------------------#
+        if iteration % accumulation_steps == 0:
+            optimizer.zero_grad()
+        update  = (iteration + 1) % accumulation_steps == 0 or iteration + 1 == epoch_step
+        sync    = model_train.no_sync() if not update and hasattr(model_train, "no_sync") else contextlib.nullcontext()
+        with sync:
+            with autocast_context(precision, cuda):
                 #----------------------#
                 #   前向传播
                 #----------------------#
                 outputs = model_train(imgs_A, imgs_B)
-
                 #----------------------#
                 #   损失计算
                 #----------------------#
-            if focal_loss:
-                loss = Focal_Loss(outputs, pngs, weights, num_classes = num_classes)
-            else:
-                loss = CE_Loss(outputs, pngs, weights, num_classes = num_classes)
+                if focal_loss:
+                    loss = Focal_Loss(outputs, pngs, weights, num_classes = num_classes)
+                else:
+                    loss = CE_Loss(outputs, pngs, weights, num_classes = num_classes)
 
                 if dice_loss:
                     main_dice = Dice_loss(outputs, labels)
                     loss      = loss + main_dice
 
-                with torch.no_grad():
-                    #-------------------------------#
-                    #   计算f_score、MCC、dice
-                    #-------------------------------#
-                    _f_score = f_score(outputs, labels)
-                    _mcc = mcc_score(outputs, labels)
-                    _dice = dice_score(outputs, labels)
-
             #----------------------#
             #   反向传播
             #----------------------#
-            scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scaler.update()
+            if scaler is not None:
+                scaler.scale(loss / accumulation_steps).backward()
+            else:
+                (loss / accumulation_steps).backward()
+
+        if update:
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
 
-        total_loss      += loss.item()
-        total_f_score   += _f_score.item()
+        with torch.no_grad():
+            #-------------------------------#
+            #   累加混淆矩阵，f_score、MCC、dice等在epoch结束时由它计算
+            #-------------------------------#
+            running.update(loss.detach().float().view(1))
+            confusion.update(outputs.detach(), labels)
         
         if local_rank == 0:
-            pbar.set_postfix(**{'total_loss': total_loss / (iteration + 1), 
-                                'f_score'   : total_f_score / (iteration + 1),
-                                'lr'        : get_lr(optimizer)})
+            if (iteration + 1) % log_interval == 0 or iteration + 1 == epoch_step:
+                means = running.mean()
+                pbar.set_postfix(**{'total_loss': means['Loss'], 
+                                    'f_score'   : confusion.compute()['F-Score'],
+                                    'lr'        : get_lr(optimizer)})
             pbar.update(1)
 
+    #-------------------------------#
+    #   分布式训练时汇总所有进程的损失与混淆矩阵，
+    #   result.csv中记录的是整个数据集上的指标
+    #-------------------------------#
+    if dist.is_available() and dist.is_initialized():
+        running.all_reduce()
+        confusion.all_reduce()
+    means = running.mean()
+    means.update(confusion.compute())
     if local_rank == 0:
         pbar.close()
-        loss_history.append_loss(epoch + 1, total_loss/ epoch_step)
+        loss_history.append_loss(epoch + 1, means['Loss'])
         print('Epoch:'+ str(epoch + 1) + '/' + str(Epoch))
-        print('Total Loss: %.3f' % (total_loss / epoch_step))
+        print('Total Loss: %.3f' % means['Loss'])
         
-        # 在每个epoch结束时计算并记录loss和f_score到csv表中
-        loss_value = total_loss / epoch_step
-        f_score_value = total_f_score / epoch_step
-        epoch_data = {'Epoch': epoch + 1, 'Loss': loss_value, 'F-Score': f_score_value, 'MCC': _mcc.item(), 'Dice': _dice.item()}
-        epoch_df = pd.DataFrame([epoch_data])  # 直接创建包含当前epoch数据的DataFrame
-
-        # 检查文件是否存在，如果不存在，则先创建文件并写入表头
-        if not os.path.isfile(csv_file):
-            epoch_df.to_csv(csv_file, mode='w', header=True, index=False)
-        else:
-            epoch_df.to_csv(csv_file, mode='a', header=False, index=False)
+        # 在每个epoch结束时记录loss的平均值与由整个epoch的混淆矩阵得到的指标到csv表中
+        epoch_data = {'Epoch': epoch + 1, 'Loss': means['Loss'], 'F-Score': means['F-Score'], 'MCC': means['MCC'],
+                      'mIoU': means['mIoU'], 'Precision': means['Precision'], 'Recall': means['Recall']}
+        append_epoch_csv(csv_file, epoch_data)
 
         #----------------------#
         #   可视化
@@ -143,7 +228,7 @@ def fit_one_epoch_no_val(model_train, model, loss_history, optimizer, epoch, epo
         #---------------------------------------------------#
         #   取出每一个像素点的种类
         #---------------------------------------------------#
-        pr = F.softmax(pr.permute(1,2,0), dim=-1).cpu().detach().numpy()
+        pr = F.softmax(pr.float().permute(1,2,0), dim=-1).cpu().detach().numpy()
         #---------------------------------------------------#
         #   取出每一个像素点的种类
         #---------------------------------------------------#
@@ -179,6 +264,7 @@ def fit_one_epoch_no_val(model_train, model, loss_history, optimizer, epoch, epo
         # 后台显示混合后的图像
         # blend_image.show()
         # 保存图片
+        os.makedirs(os.path.join(save_dir, "segimage"), exist_ok=True)
         save_path = os.path.join(save_dir, "segimage", f"visualization_{epoch + 1}.png")
         seg_image_pil.save(save_path)
         
@@ -188,9 +274,9 @@ def fit_one_epoch_no_val(model_train, model, loss_history, optimizer, epoch, epo
         #   保存权值
         #-----------------------------------------------#
         if (epoch + 1) % save_period == 0 or epoch + 1 == Epoch:
-            torch.save(model.state_dict(), os.path.join(save_dir, 'ep%03d-loss%.3f.pth'%((epoch + 1), total_loss / epoch_step)))
+            torch.save(model.state_dict(), os.path.join(save_dir, 'ep%03d-loss%.3f.pth'%((epoch + 1), means['Loss'])))
 
-        if len(loss_history.losses) <= 1 or (total_loss / epoch_step) <= min(loss_history.losses):
+        if len(loss_history.losses) <= 1 or means['Loss'] <= min(loss_history.losses):
             print('Save best model to best_epoch_weights.pth')
             torch.save(model.state_dict(), os.path.join(save_dir, "best_epoch_weights.pth"))
             
@@ -0,0 +1,271 @@
+import collections
+import csv
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+
+def count_gpus():
+    try:
+        import torch
+        return torch.cuda.device_count()
+    except Exception:
+        return 0
+
+#---------------------------------------------------#
+#   默认的最大并发训练数
+#   有GPU时每张卡同时只运行一个训练，
+#   只有CPU时一个训练已经会占满所有核心，因此只运行一个
+#---------------------------------------------------#
+def default_max_jobs():
+    return max(count_gpus(), 1)
+
+#---------------------------------------------------#
+#   训练任务可以使用的GPU编号
+#   已经设置CUDA_VISIBLE_DEVICES时在其中分配，编号与子进程看到的一致
+#---------------------------------------------------#
+def visible_devices():
+    num_gpus = count_gpus()
+    visible  = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible:
+        return [device.strip() for device in visible.split(",") if device.strip()][:num_gpus]
+    return [str(i) for i in range(num_gpus)]
+
+#---------------------------------------------------#
+#   GPU池
+#   每个训练任务按进程数占用GPU，空闲的GPU不足时等待，
+#   等待的任务按先后顺序获得GPU，进程数多的任务不会一直被后来的任务抢先
+#---------------------------------------------------#
+class DevicePool(object):
+    def __init__(self, devices):
+        self.devices    = list(devices)
+        self.free       = list(devices)
+        self.waiting    = collections.deque()
+        self.cond       = threading.Condition()
+
+    def __len__(self):
+        return len(self.devices)
+
+    #---------------------------------------------------#
+    #   等待n张GPU空闲并占用，cancelled()为True时放弃并返回None
+    #---------------------------------------------------#
+    def acquire(self, n, cancelled=lambda: False):
+        if n > len(self.devices):
+            raise ValueError("需要{}张GPU，但只有{}张可用。".format(n, len(self.devices)))
+        ticket = object()
+        with self.cond:
+            self.waiting.append(ticket)
+            try:
+                while self.waiting[0] is not ticket or len(self.free) < n:
+                    if cancelled():
+                        return None
+                    self.cond.wait(timeout=1)
+                devices, self.free = self.free[:n], self.free[n:]
+                return devices
+            finally:
+                self.waiting.remove(ticket)
+                self.cond.notify_all()
+
+    def release(self, devices):
+        with self.cond:
+            self.free.extend(devices)
+            self.cond.notify_all()
+
+#---------------------------------------------------#
+#   读取训练过程中写入的result.csv，返回最新一个epoch的指标
+#---------------------------------------------------#
+def read_latest_metrics(csv_file):
+    if not os.path.isfile(csv_file):
+        return None
+    last_row = None
+    with open(csv_file, mode='r', newline='') as f:
+        for row in csv.DictReader(f):
+            last_row = row
+    if last_row is None:
+        return None
+    metrics = {}
+    for key, value in last_row.items():
+        try:
+            metrics[key] = float(value)
+        except (TypeError, ValueError):
+            metrics[key] = value
+    return metrics
+
+
+#---------------------------------------------------#
+#   一个训练任务
+#   每个任务的权值、日志与result.csv保存在jobs_root/任务id下，使用绝对路径，
+#   应用与在cwd中运行的训练进程读写同一个文件夹，通过--save_dir传给训练脚本
+#   nproc大于1时用torch.distributed.run启动nproc个进程进行分布式训练
+#---------------------------------------------------#
+class TrainJob(object):
+    def __init__(self, args, jobs_root, total_epochs=None, nproc=1):
+        self.id             = uuid.uuid4().hex[:12]
+        self.save_dir       = os.path.abspath(os.path.join(jobs_root, self.id))
+        self.nproc          = nproc
+        if nproc > 1:
+            launcher        = [sys.executable, '-m', 'torch.distributed.run', '--standalone', '--nproc_per_node', str(nproc)]
+            self.command    = launcher + list(args) + ['--distributed', '--save_dir', self.save_dir]
+        else:
+            self.command    = [sys.executable] + list(args) + ['--save_dir', self.save_dir]
+        self.total_epochs   = total_epochs
+        self.state          = "queued"
+        self.returncode     = None
+        self.device         = None
+        self.process        = None
+        self.cancelled      = False
+        self.created_at     = time.time()
+        self.started_at     = None
+        self.finished_at    = None
+
+    @property
+    def log_path(self):
+        return os.path.join(self.save_dir, "train.log")
+
+    def to_dict(self):
+        metrics = read_latest_metrics(os.path.join(self.save_dir, "result.csv"))
+        epoch   = None
+        if metrics is not None and isinstance(metrics.get('Epoch'), float):
+            epoch = int(metrics['Epoch'])
+        return {
+            'id'            : self.id,
+            'state'         : self.state,
+            'epoch'         : epoch,
+            'total_epochs'  : self.total_epochs,
+            'metrics'       : metrics,
+            'returncode'    : self.returncode,
+            'device'        : self.device,
+            'nproc'         : self.nproc,
+            'save_dir'      : self.save_dir,
+            'log_path'      : self.log_path,
+            'created_at'    : self.created_at,
+            'started_at'    : self.started_at,
+            'finished_at'   : self.finished_at,
+        }
+
+
+#---------------------------------------------------#
+#   训练任务管理器
+#   submit立即返回任务，由固定数量的工作线程依次启动训练进程，
+#   同时运行的训练数不超过max_jobs，排队的任务数不超过max_queued
+#   有GPU时每个任务从GPU池中占用nproc张GPU，同时运行的训练使用的GPU总数不超过GPU数量
+#---------------------------------------------------#
+class TrainJobManager(object):
+    def __init__(self, max_jobs=None, max_queued=16, cwd=None):
+        self.max_jobs   = max_jobs if max_jobs is not None else default_max_jobs()
+        self.max_queued = max_queued
+        self.cwd        = cwd if cwd is not None else os.getcwd()
+        self.jobs       = {}
+        self.lock       = threading.Lock()
+        self.pending    = queue.Queue()
+        self.devices    = DevicePool(visible_devices())
+        self.workers    = []
+        for worker_id in range(self.max_jobs):
+            worker = threading.Thread(target=self._worker_loop, args=(worker_id,), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, args, jobs_root, total_epochs=None, nproc=1):
+        if len(self.devices) > 0 and nproc > len(self.devices):
+            raise ValueError("nproc不能大于GPU数量{}。".format(len(self.devices)))
+        with self.lock:
+            queued = sum(1 for job in self.jobs.values() if job.state == "queued")
+            if queued >= self.max_queued:
+                raise RuntimeError("排队中的训练任务过多，请稍后再试。")
+            job = TrainJob(args, jobs_root, total_epochs, nproc)
+            self.jobs[job.id] = job
+        self.pending.put(job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda job: job.created_at)
+
+    #---------------------------------------------------#
+    #   最近一个开始运行的任务，用于定位最新的可视化结果
+    #---------------------------------------------------#
+    def latest_started(self):
+        with self.lock:
+            started = [job for job in self.jobs.values() if job.started_at is not None]
+        return max(started, key=lambda job: job.started_at) if started else None
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        with self.lock:
+            job.cancelled = True
+            if job.state == "queued":
+                job.state       = "cancelled"
+                job.finished_at = time.time()
+            process = job.process
+        if process is not None and process.poll() is None:
+            process.terminate()
+        return job
+
+    def _worker_loop(self, worker_id):
+        while True:
+            job = self.pending.get()
+            try:
+                self._run(job, worker_id)
+            finally:
+                self.pending.task_done()
+
+    def _run(self, job, worker_id):
+        #---------------------------------------------------#
+        #   有GPU时占用nproc张空闲的GPU，分布式训练的每个进程使用其中一张，
+        #   没有足够的空闲GPU时任务保持排队状态
+        #---------------------------------------------------#
+        devices = []
+        if len(self.devices) > 0:
+            devices = self.devices.acquire(job.nproc, cancelled=lambda: job.cancelled)
+            if devices is None:
+                return
+        try:
+            self._run_on(job, devices)
+        finally:
+            self.devices.release(devices)
+
+    def _run_on(self, job, devices):
+        with self.lock:
+            if job.cancelled:
+                return
+            job.state       = "running"
+            job.started_at  = time.time()
+
+        env = os.environ.copy()
+        if devices:
+            job.device = ",".join(devices)
+            env["CUDA_VISIBLE_DEVICES"] = job.device
+
+        os.makedirs(job.save_dir, exist_ok=True)
+        with open(job.log_path, 'ab') as log_file:
+            try:
+                process = subprocess.Popen(job.command, cwd=self.cwd, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+            except OSError as e:
+                log_file.write(str(e).encode())
+                with self.lock:
+                    job.state       = "failed"
+                    job.finished_at = time.time()
+                return
+            with self.lock:
+                job.process = process
+                if job.cancelled:
+                    process.terminate()
+            returncode = process.wait()
+
+        with self.lock:
+            job.returncode  = returncode
+            job.finished_at = time.time()
+            if job.cancelled:
+                job.state = "cancelled"
+            else:
+                job.state = "succeeded" if returncode == 0 else "failed"
@@ -1,18 +1,24 @@
 import csv
 import os
+from concurrent.futures import ProcessPoolExecutor
 from os.path import join
 
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
 from PIL import Image
 
+from nets.unet_training import labels_to_one_hot
+
 #--------------------------------------------#
 #   计算f_score
 #--------------------------------------------#
 def f_score(inputs, target, beta=1, smooth = 1e-5, threhold = 0.5):
     n, c, h, w = inputs.size()
+    if target.dim() == 3:
+        target = labels_to_one_hot(target, c)
     nt, ht, wt, ct = target.size()
     if h != ht and w != wt:
         inputs = F.interpolate(inputs, size=(ht, wt), mode="bilinear", align_corners=True)
@@ -34,6 +40,8 @@ def f_score(inputs, target, beta=1, smooth = 1e-5, threhold = 0.5):
 #--------------------------------------------#
 def mcc_score(inputs, target, smooth=1e-5, threshold=0.5):
     n, c, h, w = inputs.size()
+    if target.dim() == 3:
+        target = labels_to_one_hot(target, c)
     nt, ht, wt, ct = target.size()
     if h != ht and w != wt:
         inputs = F.interpolate(inputs, size=(ht, wt), mode="bilinear", align_corners=True)
@@ -58,6 +66,8 @@ def mcc_score(inputs, target, smooth=1e-5, threshold=0.5):
 #--------------------------------------------#
 def dice_score(inputs, target, smooth=1e-5, threshold=0.5):
     n, c, h, w = inputs.size()
+    if target.dim() == 3:
+        target = labels_to_one_hot(target, c)
     nt, ht, wt, ct = target.size()
     if h != ht and w != wt:
         inputs = F.interpolate(inputs, size=(ht, wt), mode="bilinear", align_corners=True)
@@ -83,17 +93,109 @@ def dice_score(inputs, target, smooth=1e-5, threshold=0.5):
     dice_coeff = torch.mean(dice)  
     return dice_coeff
 
+#--------------------------------------------#
+#   在设备上累加整个epoch的混淆矩阵
+#   每个batch只做一次argmax与bincount，不做softmax与阈值化，
+#   update不会同步设备，compute时拷贝一次C x C的矩阵，
+#   由它得到整个epoch精确的F1、MCC、IoU、precision与recall
+#   逐类的Dice系数2TP / (2TP + FP + FN)与F1相同，因此只给出F-Score
+#   hist[i, j]为标签是i、预测为j的像素数，标签不小于num_classes的像素被忽略
+#--------------------------------------------#
+class ConfusionMatrix(object):
+    def __init__(self, num_classes):
+        self.num_classes    = num_classes
+        self.hist           = None
+
+    def reset(self):
+        self.hist = None
+
+    def update(self, inputs, target):
+        n, c, h, w = inputs.size()
+        #--------------------------------------------#
+        #   one_hot标签最后一维为忽略的区域，argmax后正好是num_classes
+        #--------------------------------------------#
+        if target.dim() == 4:
+            target = target.argmax(-1)
+        ht, wt = target.size()[1:]
+        if h != ht and w != wt:
+            inputs = F.interpolate(inputs, size=(ht, wt), mode="bilinear", align_corners=True)
+        with torch.no_grad():
+            pred    = inputs.argmax(1).view(-1)
+            target  = target.reshape(-1).long()
+            k       = (target >= 0) & (target < self.num_classes)
+            hist    = torch.bincount(self.num_classes * target[k] + pred[k], minlength=self.num_classes ** 2)
+            hist    = hist.view(self.num_classes, self.num_classes)
+            self.hist = hist if self.hist is None else self.hist + hist
+
+    #--------------------------------------------#
+    #   分布式训练时把各个进程的混淆矩阵相加，
+    #   所有进程都需要调用，之后compute得到整个数据集上的指标
+    #--------------------------------------------#
+    def all_reduce(self):
+        if self.hist is not None:
+            dist.all_reduce(self.hist)
+
+    def compute(self, smooth=1e-5):
+        if self.hist is None:
+            hist = np.zeros((self.num_classes, self.num_classes), np.float64)
+        else:
+            hist = self.hist.cpu().numpy().astype(np.float64)
+        tp  = np.diag(hist)
+        fp  = hist.sum(0) - tp
+        fn  = hist.sum(1) - tp
+        tn  = hist.sum() - tp - fp - fn
+
+        precision   = (tp + smooth) / (tp + fp + smooth)
+        recall      = (tp + smooth) / (tp + fn + smooth)
+        f1          = (2 * tp + smooth) / (2 * tp + fp + fn + smooth)
+        iou         = (tp + smooth) / (tp + fp + fn + smooth)
+        mcc         = (tp * tn - fp * fn) / (np.sqrt((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn)) + smooth)
+        return {
+            'F-Score'   : float(np.mean(f1)),
+            'MCC'       : float(np.mean(mcc)),
+            'mIoU'      : float(np.mean(iou)),
+            'Precision' : float(np.mean(precision)),
+            'Recall'    : float(np.mean(recall)),
+            'Accuracy'  : float(per_Accuracy(hist)),
+        }
+
+#--------------------------------------------#
+#   在设备上累加每一步的损失与指标
+#   update不会同步设备，只有调用mean时才把结果拷贝回主机
+#--------------------------------------------#
+class RunningMetrics(object):
+    def __init__(self, names):
+        self.names  = names
+        self.sums   = None
+        self.count  = 0
+
+    def update(self, values):
+        values = values.detach().float()
+        self.sums   = values if self.sums is None else self.sums + values
+        self.count  += 1
+
+    def mean(self):
+        if self.sums is None:
+            return {name: 0.0 for name in self.names}
+        return dict(zip(self.names, (self.sums / self.count).tolist()))
+
+    def all_reduce(self):
+        if self.sums is not None:
+            dist.all_reduce(self.sums)
+            self.count *= dist.get_world_size()
+
 # 设标签宽W，长H
 def fast_hist(a, b, n):
     #--------------------------------------------------------------------------------#
     #   a是转化成一维数组的标签，形状(H×W,)；b是转化成一维数组的预测结果，形状(H×W,)
+    #   uint8的标签与预测只在掩膜之后转换为int32，不会产生整张图的int64副本
     #--------------------------------------------------------------------------------#
     k = (a >= 0) & (a < n)
     #--------------------------------------------------------------------------------#
     #   np.bincount计算了从0到n**2-1这n**2个数中每个数出现的次数，返回值形状(n, n)
     #   返回中，写对角线上的为分类正确的像素点
     #--------------------------------------------------------------------------------#
-    return np.bincount(n * a[k].astype(int) + b[k], minlength=n ** 2).reshape(n, n)  
+    return np.bincount(n * a[k].astype(np.int32) + b[k].astype(np.int32), minlength=n ** 2).reshape(n, n)  
 
 def per_class_iu(hist):
     return np.diag(hist) / np.maximum((hist.sum(1) + hist.sum(0) - np.diag(hist)), 1) 
@@ -107,12 +209,38 @@ def per_class_Precision(hist):
 def per_Accuracy(hist):
     return np.sum(np.diag(hist)) / np.maximum(np.sum(hist), 1) 
 
-def compute_mIoU(gt_dir, pred_dir, png_name_list, num_classes, name_classes=None):  
+#------------------------------------------------#
+#   单张图片的hist与逐类别IoU，供进程池调用
+#   图像分割结果与标签大小不一样时返回None
+#   该图片中标签与预测都没有出现的类别IoU为NaN
+#------------------------------------------------#
+def image_hist(gt_path, pred_path, num_classes):
+    pred    = np.asarray(Image.open(pred_path))
+    label   = np.asarray(Image.open(gt_path))
+    if label.size != pred.size:
+        return None, None
+    hist    = fast_hist(label.reshape(-1), pred.reshape(-1), num_classes)
+    union   = hist.sum(1) + hist.sum(0) - np.diag(hist)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ious = np.where(union > 0, np.diag(hist) / union, np.nan)
+    return hist, ious
+
+def _image_hist_star(args):
+    return image_hist(*args)
+
+#------------------------------------------------#
+#   num_workers     解码与统计使用的进程数，为None时使用全部CPU核心，
+#                   为0时在当前进程中依次计算
+#   per_image_path  不为None时把每张图片的逐类别IoU按mIoU从低到高保存为csv，
+#                   方便找出效果最差的图片
+#------------------------------------------------#
+def compute_mIoU(gt_dir, pred_dir, png_name_list, num_classes, name_classes=None, num_workers=None, per_image_path=None):  
     print('Num classes', num_classes)  
     #-----------------------------------------#
     #   创建一个全是0的矩阵，是一个混淆矩阵
     #-----------------------------------------#
-    hist = np.zeros((num_classes, num_classes))
+    hist = np.zeros((num_classes, num_classes), np.int64)
+    per_image = []
     
     #------------------------------------------------#
     #   获得验证集标签路径列表，方便直接读取
@@ -120,42 +248,48 @@ def compute_mIoU(gt_dir, pred_dir, png_name_list, num_classes, name_classes=None
     #------------------------------------------------#
     gt_imgs     = [join(gt_dir, x + ".png") for x in png_name_list]  
     pred_imgs   = [join(pred_dir, x + ".png") for x in png_name_list]  
+    tasks       = [(gt_imgs[ind], pred_imgs[ind], num_classes) for ind in range(len(gt_imgs))]
 
     #------------------------------------------------#
-    #   读取每一个（图片-标签）对
+    #   在进程池中读取每一个（图片-标签）对并计算hist，
+    #   结果按顺序返回后在主进程中累加
     #------------------------------------------------#
-    for ind in range(len(gt_imgs)): 
-        #------------------------------------------------#
-        #   读取一张图像分割结果，转化成numpy数组
-        #------------------------------------------------#
-        pred = np.array(Image.open(pred_imgs[ind]))  
-        #------------------------------------------------#
-        #   读取一张对应的标签，转化成numpy数组
-        #------------------------------------------------#
-        label = np.array(Image.open(gt_imgs[ind]))  
-
-        # 如果图像分割结果与标签的大小不一样，这张图片就不计算
-        if len(label.flatten()) != len(pred.flatten()):  
-            print(
-                'Skipping: len(gt) = {:d}, len(pred) = {:d}, {:s}, {:s}'.format(
-                    len(label.flatten()), len(pred.flatten()), gt_imgs[ind],
-                    pred_imgs[ind]))
-            continue
-
-        #------------------------------------------------#
-        #   对一张图片计算21×21的hist矩阵，并累加
-        #------------------------------------------------#
-        hist += fast_hist(label.flatten(), pred.flatten(), num_classes)  
-        # 每计算10张就输出一下目前已计算的图片中所有类别平均的mIoU值
-        if name_classes is not None and ind > 0 and ind % 10 == 0: 
-            print('{:d} / {:d}: mIou-{:0.2f}%; mPA-{:0.2f}%; Accuracy-{:0.2f}%'.format(
-                    ind, 
-                    len(gt_imgs),
-                    100 * np.nanmean(per_class_iu(hist)),
-                    100 * np.nanmean(per_class_PA_Recall(hist)),
-                    100 * per_Accuracy(hist)
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = min(num_workers, len(tasks))
+    if num_workers > 1:
+        executor    = ProcessPoolExecutor(max_workers=num_workers)
+        results     = executor.map(_image_hist_star, tasks, chunksize=max(1, len(tasks) // (num_workers * 4)))
+    else:
+        executor    = None
+        results     = map(_image_hist_star, tasks)
+
+    try:
+        for ind, (image_hist_, ious) in enumerate(results): 
+            # 如果图像分割结果与标签的大小不一样，这张图片就不计算
+            if image_hist_ is None:
+                print('Skipping: size of gt != size of pred, {:s}, {:s}'.format(gt_imgs[ind], pred_imgs[ind]))
+                continue
+
+            #------------------------------------------------#
+            #   累加每张图片num_classes×num_classes的hist矩阵
+            #------------------------------------------------#
+            hist += image_hist_
+            if per_image_path is not None:
+                per_image.append((png_name_list[ind], ious))
+            # 每计算10张就输出一下目前已计算的图片中所有类别平均的mIoU值
+            if name_classes is not None and ind > 0 and ind % 10 == 0: 
+                print('{:d} / {:d}: mIou-{:0.2f}%; mPA-{:0.2f}%; Accuracy-{:0.2f}%'.format(
+                        ind, 
+                        len(gt_imgs),
+                        100 * np.nanmean(per_class_iu(hist)),
+                        100 * np.nanmean(per_class_PA_Recall(hist)),
+                        100 * per_Accuracy(hist)
+                    )
                 )
-            )
+    finally:
+        if executor is not None:
+            executor.shutdown()
     #------------------------------------------------#
     #   计算所有验证集图片的逐类别mIoU值
     #------------------------------------------------#
@@ -174,7 +308,28 @@ def compute_mIoU(gt_dir, pred_dir, png_name_list, num_classes, name_classes=None
     #   在所有验证集图像上求所有类别平均的mIoU值，计算时忽略NaN值
     #-----------------------------------------------------------------#
     print('===> mIoU: ' + str(round(np.nanmean(IoUs) * 100, 2)) + '; mPA: ' + str(round(np.nanmean(PA_Recall) * 100, 2)) + '; Accuracy: ' + str(round(per_Accuracy(hist) * 100, 2)))  
-    return np.array(hist, np.int), IoUs, PA_Recall, Precision
+
+    if per_image_path is not None:
+        save_per_image_iou(per_image_path, per_image, num_classes, name_classes)
+    return hist, IoUs, PA_Recall, Precision
+
+#------------------------------------------------#
+#   按mIoU从低到高保存每张图片的逐类别IoU
+#------------------------------------------------#
+def save_per_image_iou(output_path, per_image, num_classes, name_classes=None):
+    if name_classes is None:
+        name_classes = [str(c) for c in range(num_classes)]
+    rows = []
+    for name, ious in per_image:
+        miou = np.nanmean(ious) if not np.all(np.isnan(ious)) else float('nan')
+        rows.append((miou, name, ious))
+    rows.sort(key=lambda row: (np.isnan(row[0]), row[0]))
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['image', 'mIoU'] + list(name_classes))
+        for miou, name, ious in rows:
+            writer.writerow([name, miou] + ['' if np.isnan(iou) else iou for iou in ious])
+    print("Save per image IoU out to " + output_path)
 
 def adjust_axes(r, t, fig, axes):
     bb                  = t.get_window_extent(renderer=r)
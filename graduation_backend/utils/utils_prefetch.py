@@ -0,0 +1,71 @@
+import itertools
+
+import torch
+
+
+#---------------------------------------------------#
+#   把batch中的张量移动到设备上，None等非张量原样保留
+#---------------------------------------------------#
+def batch_to_device(batch, device, non_blocking=True):
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(batch_to_device(item, device, non_blocking) for item in batch)
+    return batch
+
+def record_stream(batch, stream):
+    if isinstance(batch, torch.Tensor):
+        batch.record_stream(stream)
+    elif isinstance(batch, (list, tuple)):
+        for item in batch:
+            record_stream(item, stream)
+
+
+#---------------------------------------------------#
+#   预取下一个batch的DataLoader包装
+#   使用GPU时在单独的CUDA stream上把下一个batch从锁页内存异步拷贝到显存，
+#   与当前batch的计算重叠；没有GPU时没有可以重叠的拷贝，直接逐个返回batch
+#   device为None时不移动数据
+#   max_steps   最多返回的batch数，达到后不再预取下一个batch，
+#               避免每个epoch多拷贝一个用不到的batch
+#---------------------------------------------------#
+class DevicePrefetcher(object):
+    def __init__(self, loader, device=None, max_steps=None):
+        self.loader     = loader
+        self.device     = torch.device(device) if device is not None else None
+        self.stream     = torch.cuda.Stream(device=self.device) if self.device is not None and self.device.type == 'cuda' else None
+        self.max_steps  = max_steps
+
+    def __len__(self):
+        if self.max_steps is None:
+            return len(self.loader)
+        return min(len(self.loader), self.max_steps)
+
+    def _preload(self, iterator):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return batch_to_device(batch, self.device)
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in itertools.islice(self.loader, self.max_steps):
+                yield batch if self.device is None else batch_to_device(batch, self.device, non_blocking=False)
+            return
+        if self.max_steps is not None and self.max_steps <= 0:
+            return
+        iterator    = iter(self.loader)
+        batch       = self._preload(iterator)
+        step        = 0
+        while batch is not None:
+            #---------------------------------------------------#
+            #   等待拷贝完成，并告诉分配器这些张量会在计算流上使用
+            #---------------------------------------------------#
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            record_stream(batch, torch.cuda.current_stream(self.device))
+            step        += 1
+            next_batch  = self._preload(iterator) if self.max_steps is None or step < self.max_steps else None
+            yield batch
+            batch       = next_batch
@@ -0,0 +1,198 @@
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import torch
+
+from utils.utils import available_memory_mb
+
+
+#---------------------------------------------------#
+#   常驻内存的模型池
+#   以(权值路径, 种类数)为键，模型只在第一次请求时加载，之后的请求直接复用。
+#   max_models      最多同时常驻的模型数量
+#   min_free_mb     加载新模型前剩余内存低于该值时，按最近最少使用淘汰旧模型
+#---------------------------------------------------#
+class ModelPool(object):
+    def __init__(self, factory, max_models=2, min_free_mb=1024, cuda=False):
+        self.factory        = factory
+        self.max_models     = max_models
+        self.min_free_mb    = min_free_mb
+        self.cuda           = cuda
+        self.models         = OrderedDict()
+        self.lock           = threading.Lock()
+        self.loading        = {}
+        self.loads          = 0
+        self.evictions      = 0
+
+    @staticmethod
+    def make_key(model_path, num_classes):
+        return (os.path.abspath(model_path), int(num_classes))
+
+    def get(self, model_path, num_classes):
+        key = self.make_key(model_path, num_classes)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+            #---------------------------------------------------#
+            #   同一个模型只加载一次，其余请求等待加载完成
+            #---------------------------------------------------#
+            load_lock = self.loading.setdefault(key, threading.Lock())
+
+        with load_lock:
+            with self.lock:
+                if key in self.models:
+                    self.models.move_to_end(key)
+                    return self.models[key]
+                self._evict_for_new_model()
+            model = self.factory(model_path=key[0], num_classes=key[1])
+            with self.lock:
+                self.models[key] = model
+                self.loads += 1
+                self.loading.pop(key, None)
+        return model
+
+    def _evict_for_new_model(self):
+        while self.models and len(self.models) >= self.max_models:
+            self._evict_oldest()
+        if self.min_free_mb is not None:
+            while self.models:
+                free_mb = available_memory_mb(self.cuda)
+                if free_mb is None or free_mb >= self.min_free_mb:
+                    break
+                self._evict_oldest()
+
+    def _evict_oldest(self):
+        _, model = self.models.popitem(last=False)
+        self.evictions += 1
+        del model
+        gc.collect()
+        if self.cuda and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'models'    : [{'model_path': key[0], 'num_classes': key[1]} for key in self.models.keys()],
+                'loads'     : self.loads,
+                'evictions' : self.evictions,
+            }
+
+
+#---------------------------------------------------#
+#   等待批处理的单个请求
+#---------------------------------------------------#
+class _BatchRequest(object):
+    def __init__(self, model, image, image_B):
+        self.model      = model
+        self.image      = image
+        self.image_B    = image_B
+        self.arrival    = time.time()
+        self.done       = threading.Event()
+        self.result     = None
+        self.error      = None
+
+    #---------------------------------------------------#
+    #   同一个模型的请求才能拼成一个batch，
+    #   letterbox之后它们的输入大小都是该模型的input_shape
+    #---------------------------------------------------#
+    @property
+    def group_key(self):
+        return id(self.model)
+
+
+#---------------------------------------------------#
+#   推理请求的动态批处理
+#   后台线程收集并发到达的请求，攒够max_batch_size张，
+#   或最早的请求已等待max_delay_ms毫秒后，按模型分组进行一次批量前向传播，
+#   再把结果分发回各个等待中的请求
+#---------------------------------------------------#
+class MicroBatcher(object):
+    def __init__(self, max_batch_size=8, max_delay_ms=10):
+        self.max_batch_size = max_batch_size
+        self.max_delay      = max_delay_ms / 1000
+        self.pending        = deque()
+        self.cond           = threading.Condition()
+        self.requests       = 0
+        self.batches        = 0
+        self.batched_images = 0
+        self.max_depth      = 0
+        self.wait_time      = 0.0
+        self.worker         = threading.Thread(target=self._worker_loop, daemon=True)
+        self.worker.start()
+
+    #---------------------------------------------------#
+    #   提交一对模态A、模态B图片并阻塞等待，返回get_miou_png_batch的结果
+    #---------------------------------------------------#
+    def submit(self, model, image, image_B):
+        if image_B is None:
+            raise ValueError("融合网络需要模态A与模态B同时输入，请传入image_B。")
+        request = _BatchRequest(model, image, image_B)
+        with self.cond:
+            self.pending.append(request)
+            self.requests   += 1
+            self.max_depth  = max(self.max_depth, len(self.pending))
+            self.cond.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self):
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            deadline = self.pending[0].arrival + self.max_delay
+            while len(self.pending) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            batch = [self.pending.popleft() for _ in range(min(self.max_batch_size, len(self.pending)))]
+        return batch
+
+    def _worker_loop(self):
+        while True:
+            batch   = self._collect()
+            groups  = OrderedDict()
+            for request in batch:
+                groups.setdefault(request.group_key, []).append(request)
+            for requests in groups.values():
+                self._run(requests)
+
+    def _run(self, requests):
+        start   = time.time()
+        model   = requests[0].model
+        images  = [request.image for request in requests]
+        images_B = [request.image_B for request in requests]
+        try:
+            results = model.get_miou_png_batch(images, batch_size=len(requests), images_B=images_B)
+        except Exception as e:
+            for request in requests:
+                request.error = e
+                request.done.set()
+            return
+        with self.cond:
+            self.batches        += 1
+            self.batched_images += len(requests)
+            self.wait_time      += sum(start - request.arrival for request in requests)
+        for request, result in zip(requests, results):
+            request.result = result
+            request.done.set()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'queue_depth'       : len(self.pending),
+                'max_queue_depth'   : self.max_depth,
+                'requests'          : self.requests,
+                'batches'           : self.batches,
+                'mean_batch_size'   : self.batched_images / self.batches if self.batches > 0 else 0.0,
+                'batch_fill_ratio'  : self.batched_images / (self.batches * self.max_batch_size) if self.batches > 0 else 0.0,
+                'mean_wait_ms'      : self.wait_time / self.batched_images * 1000 if self.batched_images > 0 else 0.0,
+                'max_batch_size'    : self.max_batch_size,
+                'max_delay_ms'      : self.max_delay * 1000,
+            }
@@ -0,0 +1,277 @@
+import hashlib
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+
+COPY_BUFSIZE = 1024 * 1024
+
+
+#---------------------------------------------------#
+#   只保留文件名部分，防止路径穿越
+#---------------------------------------------------#
+def safe_filename(filename):
+    filename = os.path.basename(str(filename).replace('\\', '/')).strip()
+    if filename in ('', '.', '..'):
+        raise ValueError("文件名不合法")
+    return filename
+
+#---------------------------------------------------#
+#   流式计算文件的sha256
+#---------------------------------------------------#
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BUFSIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+#---------------------------------------------------#
+#   一次分块上传
+#   数据直接追加写入upload_dir/id.part，上传状态保存在id.json中，
+#   服务重启后也可以根据offset继续上传
+#---------------------------------------------------#
+class UploadSession(object):
+    def __init__(self, upload_dir, filename, size, upload_id=None, received=0, created_at=None):
+        self.id         = upload_id if upload_id is not None else uuid.uuid4().hex[:12]
+        self.upload_dir = upload_dir
+        self.filename   = filename
+        self.size       = size
+        self.received   = received
+        self.created_at = created_at if created_at is not None else time.time()
+        self.lock       = threading.Lock()
+        #---------------------------------------------------#
+        #   按顺序到达的分块增量计算sha256，
+        #   重启后无法恢复该状态，finalize时再从文件重新计算
+        #---------------------------------------------------#
+        self.digest     = hashlib.sha256() if received == 0 else None
+
+    @property
+    def part_path(self):
+        return os.path.join(self.upload_dir, self.id + '.part')
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.upload_dir, self.id + '.json')
+
+    def save_meta(self):
+        meta = {'id': self.id, 'filename': self.filename, 'size': self.size, 'received': self.received, 'created_at': self.created_at}
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    @classmethod
+    def load_meta(cls, upload_dir, upload_id):
+        with open(os.path.join(upload_dir, upload_id + '.json')) as f:
+            meta = json.load(f)
+        session = cls(upload_dir, meta['filename'], meta['size'], upload_id=meta['id'], created_at=meta['created_at'])
+        #---------------------------------------------------#
+        #   以实际写入磁盘的长度为准
+        #---------------------------------------------------#
+        session.received    = os.path.getsize(session.part_path) if os.path.isfile(session.part_path) else 0
+        session.digest      = hashlib.sha256() if session.received == 0 else None
+        return session
+
+    def to_dict(self):
+        return {
+            'upload_id' : self.id,
+            'filename'  : self.filename,
+            'size'      : self.size,
+            'offset'    : self.received,
+            'complete'  : self.size is not None and self.received >= self.size,
+            'created_at': self.created_at,
+        }
+
+
+#---------------------------------------------------#
+#   分块上传管理器
+#   init创建上传，write_chunk在指定offset处写入一块数据，
+#   finalize校验sha256后把文件移动到目标文件夹
+#---------------------------------------------------#
+class UploadManager(object):
+    def __init__(self, upload_dir):
+        self.upload_dir = upload_dir
+        self.sessions   = {}
+        self.lock       = threading.Lock()
+        os.makedirs(upload_dir, exist_ok=True)
+
+    def init(self, filename, size=None):
+        session = UploadSession(self.upload_dir, safe_filename(filename), int(size) if size is not None else None)
+        open(session.part_path, 'wb').close()
+        session.save_meta()
+        with self.lock:
+            self.sessions[session.id] = session
+        return session
+
+    def get(self, upload_id):
+        if not upload_id.isalnum():
+            return None
+        with self.lock:
+            session = self.sessions.get(upload_id)
+            if session is None and os.path.isfile(os.path.join(self.upload_dir, upload_id + '.json')):
+                session = UploadSession.load_meta(self.upload_dir, upload_id)
+                self.sessions[upload_id] = session
+        return session
+
+    #---------------------------------------------------#
+    #   把stream中的数据写入offset处，不在内存中缓存整个分块
+    #   offset必须等于已经收到的长度，否则抛出ValueError，
+    #   客户端可以通过get查询当前offset后继续上传
+    #---------------------------------------------------#
+    def write_chunk(self, session, offset, stream):
+        with session.lock:
+            if offset != session.received:
+                raise ValueError("offset与已上传的长度{}不一致".format(session.received))
+            with open(session.part_path, 'r+b') as f:
+                f.seek(offset)
+                f.truncate()
+                while True:
+                    block = stream.read(COPY_BUFSIZE)
+                    if not block:
+                        break
+                    if session.size is not None and session.received + len(block) > session.size:
+                        raise ValueError("上传的数据超过了声明的文件大小")
+                    f.write(block)
+                    if session.digest is not None:
+                        session.digest.update(block)
+                    session.received += len(block)
+            session.save_meta()
+            return session.received
+
+    def finalize(self, session, dest_dir, sha256=None):
+        with session.lock:
+            if session.size is not None and session.received != session.size:
+                raise ValueError("文件尚未上传完成，已上传{}/{}".format(session.received, session.size))
+            if sha256 is not None:
+                actual = session.digest.hexdigest() if session.digest is not None else file_sha256(session.part_path)
+                if actual.lower() != sha256.lower():
+                    raise ValueError("sha256校验失败")
+            os.makedirs(dest_dir, exist_ok=True)
+            dest_path = os.path.join(dest_dir, session.filename)
+            #---------------------------------------------------#
+            #   不覆盖同名文件，同名的zip可能仍在解压
+            #   上传保留在会话中，可以稍后再次finalize
+            #---------------------------------------------------#
+            with self.lock:
+                if os.path.exists(dest_path):
+                    raise ValueError("{}已存在，可能仍在解压，请稍后再试或更换文件名".format(session.filename))
+                shutil.move(session.part_path, dest_path)
+            os.remove(session.meta_path)
+        with self.lock:
+            self.sessions.pop(session.id, None)
+        return dest_path
+
+
+#---------------------------------------------------#
+#   一次zip解压任务
+#---------------------------------------------------#
+class ExtractJob(object):
+    def __init__(self, zip_path, dest_dir, remove_zip=True):
+        self.id             = uuid.uuid4().hex[:12]
+        self.zip_path       = zip_path
+        self.dest_dir       = dest_dir
+        self.remove_zip     = remove_zip
+        self.state          = "queued"
+        self.total_bytes    = None
+        self.done_bytes     = 0
+        self.total_files    = None
+        self.done_files     = 0
+        self.error          = None
+        self.created_at     = time.time()
+        self.finished_at    = None
+
+    def to_dict(self):
+        progress = self.done_bytes / self.total_bytes if self.total_bytes else (1.0 if self.state == "succeeded" else 0.0)
+        return {
+            'id'            : self.id,
+            'state'         : self.state,
+            'zip'           : os.path.basename(self.zip_path),
+            'progress'      : progress,
+            'done_bytes'    : self.done_bytes,
+            'total_bytes'   : self.total_bytes,
+            'done_files'    : self.done_files,
+            'total_files'   : self.total_files,
+            'error'         : self.error,
+            'created_at'    : self.created_at,
+            'finished_at'   : self.finished_at,
+        }
+
+
+#---------------------------------------------------#
+#   后台解压
+#   由一个工作线程依次解压，每个成员以流的方式写入目标文件夹，
+#   不会阻塞其它请求，也不会把整个成员读入内存
+#---------------------------------------------------#
+class ExtractManager(object):
+    def __init__(self):
+        self.jobs       = {}
+        self.lock       = threading.Lock()
+        self.pending    = queue.Queue()
+        self.worker     = threading.Thread(target=self._worker_loop, daemon=True)
+        self.worker.start()
+
+    def submit(self, zip_path, dest_dir, remove_zip=True):
+        with self.lock:
+            for job in self.jobs.values():
+                if job.zip_path == zip_path and job.state in ("queued", "running"):
+                    return job
+            job = ExtractJob(zip_path, dest_dir, remove_zip)
+            self.jobs[job.id] = job
+        self.pending.put(job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda job: job.created_at)
+
+    def _worker_loop(self):
+        while True:
+            job = self.pending.get()
+            try:
+                job.state = "running"
+                self._extract(job)
+                job.state = "succeeded"
+            except Exception as e:
+                job.error = str(e)
+                job.state = "failed"
+            finally:
+                job.finished_at = time.time()
+                self.pending.task_done()
+
+    def _extract(self, job):
+        dest_root = os.path.realpath(job.dest_dir)
+        with zipfile.ZipFile(job.zip_path, 'r') as zip_ref:
+            members         = zip_ref.infolist()
+            job.total_files = len(members)
+            job.total_bytes = sum(member.file_size for member in members)
+            for member in members:
+                #---------------------------------------------------#
+                #   拒绝会写到目标文件夹之外的成员
+                #---------------------------------------------------#
+                target = os.path.realpath(os.path.join(dest_root, member.filename))
+                if os.path.commonpath([target, dest_root]) != dest_root:
+                    raise ValueError("zip中包含不安全的路径: {}".format(member.filename))
+                if member.is_dir():
+                    os.makedirs(target, exist_ok=True)
+                else:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    with zip_ref.open(member) as src, open(target, 'wb') as dst:
+                        while True:
+                            block = src.read(COPY_BUFSIZE)
+                            if not block:
+                                break
+                            dst.write(block)
+                            job.done_bytes += len(block)
+                job.done_files += 1
+        if job.remove_zip:
+            os.remove(job.zip_path)